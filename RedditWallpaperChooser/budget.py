@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Fair budgeting of the accepted wallpapers across subreddits.
+"""
+
+import logging
+import math
+
+from RedditWallpaperChooser import constants
+
+__author__ = 'aldur'
+
+logger = logging.getLogger(__name__)
+
+
+def apportion(total, weights):
+    """
+    Split an integer total proportionally to the weights (largest remainder method).
+
+    :param total: The total to be split.
+    :param weights: A dictionary of positive weights.
+    :return: A dictionary of integer shares, summing to `total`.
+    """
+    if not weights:
+        return {}
+    weight_sum = float(sum(weights.values()))
+    exact = {key: total * weight / weight_sum for key, weight in weights.items()}
+    shares = {key: int(math.floor(value)) for key, value in exact.items()}
+    left = total - sum(shares.values())
+    for key in sorted(exact, key=lambda k: (shares[k] - exact[k], k))[:left]:
+        shares[key] += 1
+    return shares
+
+
+class Budget(object):
+
+    """
+    A target number of accepted wallpapers, split across subreddits according to their weights.
+
+    Each subreddit is paged until its quota of accepted wallpapers is met.
+    When a subreddit runs out of posts, the rest of its quota goes to the other subreddits.
+    The `limit` of each listing request is sized on what is left, according to the acceptance rate observed so far.
+    """
+
+    def __init__(self, total, weights):
+        """
+        :param total: The target number of accepted wallpapers.
+        :param weights: The weight of each subreddit.
+        """
+        self.total = total
+        self.weights = dict(weights)
+        self.quotas = apportion(total, self.weights)
+
+        self.accepted = dict.fromkeys(self.weights, 0)
+        self.posts = dict.fromkeys(self.weights, 0)
+        # The 'after' token of the next page of each subreddit.
+        self.after = {}
+        # Subreddits with no more posts to offer.
+        self.exhausted = set()
+
+    def remaining(self, subreddit):
+        """
+        :return: How many wallpapers are still to be accepted from the subreddit.
+        """
+        return max(self.quotas[subreddit] - self.accepted[subreddit], 0)
+
+    @property
+    def met(self):
+        """
+        True once no more wallpapers are needed, or no subreddit can provide them.
+        """
+        return sum(self.accepted.values()) >= self.total or all(
+            subreddit in self.exhausted or not self.remaining(subreddit) for subreddit in self.weights
+        )
+
+    def page_limit(self, subreddit):
+        """
+        :return: The number of posts to request in the next listing page of the subreddit.
+        """
+        maximum = constants.REDDIT_PAGE_LIMIT
+        if not self.accepted[subreddit]:
+            # Either the first page, or nothing accepted so far: the acceptance rate is unknown.
+            return maximum
+
+        rate = self.accepted[subreddit] / float(self.posts[subreddit])
+        needed = self.remaining(subreddit) / rate * constants.BUDGET_MARGIN
+        # Rounded to a few steps only, so that the listing cache stays effective across runs.
+        step = constants.BUDGET_LIMIT_STEP
+        return int(min(max(math.ceil(needed / step) * step, step), maximum))
+
+    def record(self, subreddit, posts, accepted):
+        """
+        Record a listing page.
+
+        :param subreddit: The subreddit.
+        :param posts: The number of posts in the page.
+        :param accepted: The number of wallpapers accepted from the page.
+        """
+        self.posts[subreddit] += posts
+        self.accepted[subreddit] += accepted
+
+    def finish(self, subreddit):
+        """
+        Mark a subreddit as exhausted, and share the rest of its quota among the others.
+
+        :param subreddit: The subreddit.
+        """
+        self.exhausted.add(subreddit)
+        surplus = self.remaining(subreddit)
+        if not surplus:
+            return
+
+        self.quotas[subreddit] -= surplus
+        active = {s: w for s, w in self.weights.items() if s not in self.exhausted}
+        for s, share in apportion(surplus, active).items():
+            self.quotas[s] += share
+        logger.debug("Sharing %d wallpapers of the quota of 'r/%s' with %d subreddits.",
+                     surplus, subreddit, len(active))
+
+    def resumable(self):
+        """
+        :return: The subreddits that can still provide wallpapers.
+        """
+        return [s for s in self.weights if s not in self.exhausted and self.remaining(s)]
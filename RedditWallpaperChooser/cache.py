@@ -0,0 +1,665 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Persistent index of the stored wallpapers.
+"""
+
+import collections
+import glob
+import json
+import logging
+import os
+import os.path
+import sqlite3
+import time
+
+import RedditWallpaperChooser.reddit
+import RedditWallpaperChooser.wallpaper
+from RedditWallpaperChooser import constants, utils
+
+__author__ = 'aldur'
+
+logger = logging.getLogger(__name__)
+
+CacheEntry = collections.namedtuple(
+    "CacheEntry",
+    "url, id, title, subreddit, width, height, image_type, byte_size, downloaded_at, content_hash, last_used, score, "
+    "linked_to"
+)
+
+# The columns weighting a wallpaper (see `sampling.weight`).
+Candidate = collections.namedtuple(
+    "Candidate", "url, downloaded_at, score, last_used"
+)
+
+PartialEntry = collections.namedtuple(
+    "PartialEntry", "url, validator, byte_size, updated_at"
+)
+
+ListingEntry = collections.namedtuple(
+    "ListingEntry", "etag, last_modified, fetched_at, page"
+)
+
+_LISTING_SCHEMA = """
+CREATE TABLE IF NOT EXISTS listing_pages (
+    key TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    fetched_at REAL NOT NULL,
+    walls TEXT NOT NULL,
+    after TEXT,
+    names TEXT NOT NULL
+)
+"""
+
+_LISTING_INDEX = "CREATE INDEX IF NOT EXISTS listing_pages_fetched_at ON listing_pages (fetched_at)"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS wallpapers (
+    url TEXT PRIMARY KEY,
+    id TEXT NOT NULL,
+    title TEXT,
+    subreddit TEXT,
+    width INTEGER,
+    height INTEGER,
+    image_type TEXT NOT NULL,
+    byte_size INTEGER,
+    downloaded_at REAL,
+    content_hash TEXT,
+    last_used REAL,
+    score INTEGER,
+    linked_to TEXT
+)
+"""
+
+_SUBREDDIT_INDEX = "CREATE INDEX IF NOT EXISTS wallpapers_subreddit ON wallpapers (subreddit COLLATE NOCASE)"
+
+_VARIANTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS variants (
+    id TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    PRIMARY KEY (id, width, height)
+)
+"""
+
+_REJECTED_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rejected (
+    url TEXT PRIMARY KEY,
+    reason TEXT NOT NULL,
+    rejected_at REAL NOT NULL,
+    quarantined_bytes INTEGER
+)
+"""
+
+_JOURNALS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS journals (
+    segment TEXT PRIMARY KEY,
+    offset INTEGER NOT NULL
+)
+"""
+
+_PARTIALS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS partials (
+    id TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    validator TEXT,
+    byte_size INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+)
+"""
+
+# Version of the index, stored as its `user_version`: lower ones still have to be migrated.
+_SCHEMA_VERSION = 1
+
+
+class CacheIndex(object):
+
+    """
+    An SQLite index of the wallpapers stored in the output folder.
+
+    The whole index is loaded in memory at start-up, so that lookups never touch the disk;
+    otherwise (see `preload`), the wallpapers are only read on demand, by `select` and `load`.
+    New entries are written back in batched transactions.
+    `generation` changes whenever a wallpaper is added to or removed from the index.
+    If `executor` (a single-thread executor) is set, batches are written there, off the caller thread.
+    Rejected downloads are recorded too, so that they are not downloaded again,
+    along with the bytes of the ones kept in quarantine,
+    as are the interrupted downloads (with the validator they can be resumed with)
+    and how far the journal segments of the other cluster nodes have been imported.
+    """
+
+    def __init__(self, output_path, filename=constants.CACHE_INDEX_FILENAME, migrate=True, preload=True):
+        """
+        :param output_path: The folder storing the wallpapers.
+        :param filename: The index file name.
+        :param migrate: If False, the folders of previous versions are left as they are (e.g. to only read the index).
+        :param preload: If False, the wallpapers and their variants are not loaded, e.g. to choose one of them.
+        """
+        assert output_path
+        self.output_path = output_path
+        self.path = os.path.join(output_path, filename)
+
+        # Once loaded, the index can be written from another thread (see `executor`).
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.executor = None
+        self.connection.execute(_SCHEMA)
+        self.connection.execute(_SUBREDDIT_INDEX)
+        self.connection.execute(_VARIANTS_SCHEMA)
+        self.connection.execute(_REJECTED_SCHEMA)
+        self.connection.execute(_JOURNALS_SCHEMA)
+        self.connection.execute(_PARTIALS_SCHEMA)
+
+        # The imported bytes of each journal segment (see `cluster.Cluster.sync`).
+        self.journal_offsets = dict(self.connection.execute("SELECT segment, offset FROM journals"))
+        # The updated offsets, None for the deleted segments.
+        self._pending_offsets = {}
+
+        # The interrupted downloads, by wallpaper identifier.
+        self.partials = {
+            row[0]: PartialEntry(*row[1:])
+            for row in self.connection.execute("SELECT id, {} FROM partials".format(", ".join(PartialEntry._fields)))
+        }
+        # The updated partial downloads, None for the removed ones.
+        self._pending_partials = {}
+
+        # The reason of each rejected URL, and the (rejected_at, byte_size) of the quarantined ones.
+        self.rejected = {}
+        self.quarantined = {}
+        for url, reason, rejected_at, quarantined_bytes in self.connection.execute(
+                "SELECT url, reason, rejected_at, quarantined_bytes FROM rejected"
+        ):
+            self.rejected[url] = reason
+            if quarantined_bytes is not None:
+                self.quarantined[url] = (rejected_at, quarantined_bytes)
+        self._pending_rejections = []
+
+        self.preloaded = preload
+        self.variants = collections.defaultdict(set)
+        if preload:
+            for wallpaper_id, width, height in self.connection.execute("SELECT id, width, height FROM variants"):
+                self.variants[wallpaper_id].add(utils.Size(width, height))
+        self._pending_variants = []
+        self._pending_removals = []
+        self.generation = 0
+
+        self.by_hash = {}
+        self.by_id = {}
+        self.entries = {}
+        if preload:
+            self.entries = {
+                row[0]: CacheEntry(*row)
+                for row in self.connection.execute("SELECT {} FROM wallpapers".format(
+                    ", ".join(CacheEntry._fields)
+                ))
+            }
+        self._pending = []
+
+        # The folders of previous versions are migrated once, on the first start-up.
+        if migrate and self.connection.execute("PRAGMA user_version").fetchone()[0] < _SCHEMA_VERSION:
+            self._migrate_sidecars()
+            self._migrate_ids()
+            self.connection.execute("PRAGMA user_version = {}".format(_SCHEMA_VERSION))
+
+        self.by_hash = {
+            entry.content_hash: entry
+            for entry in self.entries.values()
+            if entry.content_hash is not None
+        }
+        self.by_id = {entry.id: entry for entry in self.entries.values()}
+        logger.debug("Loaded %d entries from the cache index.", len(self.entries))
+
+    def __contains__(self, url):
+        return url in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, url):
+        """
+        :param url: The wallpaper URL.
+        :return: The cache entry for `url`, or None.
+        """
+        return self.entries.get(url)
+
+    def find_by_id(self, wallpaper_id):
+        """
+        :param wallpaper_id: The wallpaper identifier.
+        :return: The cache entry having that identifier, or None.
+        """
+        return self.by_id.get(wallpaper_id)
+
+    def find_by_hash(self, content_hash):
+        """
+        :param content_hash: The hex digest of an image content.
+        :return: A cache entry having that content, or None.
+        """
+        return self.by_hash.get(content_hash)
+
+    def select(self, subreddits=None, min_size=None, target_ratio=None, ratio_tolerance=0.0):
+        """
+        Read from the index the wallpapers fitting the filters, as `sampling.Chooser._fits` does, but in SQLite.
+
+        :param subreddits: If set, only the wallpapers of these (lowercase) subreddits.
+        :param min_size: If set, only the wallpapers bigger than this size.
+        :param target_ratio: If set, only the wallpapers having this aspect ratio.
+        :param ratio_tolerance: The accepted relative deviation from `target_ratio`.
+        :return: An iterator over the Candidate of each wallpaper.
+        """
+        conditions = []
+        parameters = []
+        if subreddits:
+            conditions.append("subreddit COLLATE NOCASE IN ({})".format(", ".join("?" * len(subreddits))))
+            parameters.extend(subreddits)
+        if min_size:
+            conditions.append("width >= ? AND height >= ?")
+            parameters.extend(min_size)
+        if target_ratio:
+            # As `filtering.ratio_fits`.
+            if ratio_tolerance:
+                conditions.append("abs(CAST(width AS REAL) / height - ?) <= ?")
+                parameters.extend((target_ratio, ratio_tolerance * target_ratio))
+            else:
+                conditions.append("round(CAST(width AS REAL) / height, 5) = ?")
+                parameters.append(target_ratio)
+            conditions.append("width > 0 AND height > 0")
+
+        return map(Candidate._make, self.connection.execute("SELECT {} FROM wallpapers{}".format(
+            ", ".join(Candidate._fields), " WHERE " + " AND ".join(conditions) if conditions else ""
+        ), parameters))
+
+    def load(self, url):
+        """
+        Read a wallpaper, and its variants, into memory: needed before using it, unless the index is preloaded.
+
+        :param url: The wallpaper URL.
+        :return: The cache entry for `url`, or None.
+        """
+        if self.preloaded or url in self.entries:
+            return self.entries.get(url)
+
+        row = self.connection.execute("SELECT {} FROM wallpapers WHERE url = ?".format(
+            ", ".join(CacheEntry._fields)
+        ), (url,)).fetchone()
+        if row is None:
+            return None
+        entry = self.entries[url] = self.by_id[row[1]] = CacheEntry(*row)
+        for width, height in self.connection.execute("SELECT width, height FROM variants WHERE id = ?", (entry.id,)):
+            self.variants[entry.id].add(utils.Size(width, height))
+        return entry
+
+    def add(self, entry):
+        """
+        Add (or replace) an entry; it will be persisted with the next batch.
+
+        :param entry: A CacheEntry.
+        """
+        if entry.url not in self.entries:
+            self.generation += 1
+        self.entries[entry.url] = entry
+        self.by_id[entry.id] = entry
+        if entry.content_hash is not None:
+            known = self.by_hash.get(entry.content_hash)
+            if known is None or known.url == entry.url:
+                self.by_hash[entry.content_hash] = entry
+        self._pending.append(entry)
+        if len(self._pending) >= constants.CACHE_INDEX_BATCH_SIZE:
+            self.flush()
+
+    def touch(self, url, when=None):
+        """
+        Mark a wallpaper as used, e.g. because it has been chosen.
+
+        :param url: The wallpaper URL.
+        :param when: The time of use (defaults to now).
+        """
+        entry = self.entries.get(url)
+        if entry is not None:
+            self.add(entry._replace(last_used=time.time() if when is None else when))
+
+    def remove(self, url):
+        """
+        Remove a wallpaper, along with its variants, from the index.
+
+        :param url: The wallpaper URL.
+        """
+        entry = self.entries.pop(url)
+        self.generation += 1
+        self.by_id.pop(entry.id, None)
+        known = self.by_hash.get(entry.content_hash)
+        if known is not None and known.url == url:
+            del self.by_hash[entry.content_hash]
+        self.variants.pop(entry.id, None)
+
+        self._pending = [e for e in self._pending if e.url != url]
+        self._pending_variants = [v for v in self._pending_variants if v[0] != entry.id]
+        self._pending_removals.append((url, entry.id))
+        if len(self._pending_removals) >= constants.CACHE_INDEX_BATCH_SIZE:
+            self.flush()
+
+    def reject(self, url, reason, quarantined_bytes=None):
+        """
+        Record that the download of a URL has been rejected; it will be persisted with the next batch.
+
+        :param url: The wallpaper URL.
+        :param reason: Why it has been rejected.
+        :param quarantined_bytes: If set, the size of the download kept in quarantine.
+        """
+        now = time.time()
+        self.rejected[url] = reason
+        if quarantined_bytes is None:
+            self.quarantined.pop(url, None)
+        else:
+            self.quarantined[url] = (now, quarantined_bytes)
+        self._pending_rejections.append((url, reason, now, quarantined_bytes))
+
+    def release_quarantined(self, url):
+        """
+        Record that the quarantined download of a URL has been deleted: the URL stays rejected.
+
+        :param url: The wallpaper URL.
+        """
+        rejected_at, _ = self.quarantined.pop(url)
+        self._pending_rejections.append((url, self.rejected[url], rejected_at, None))
+
+    def set_partial(self, wallpaper_id, partial):
+        """
+        Record an interrupted download, to be resumed later; it will be persisted with the next batch.
+
+        :param wallpaper_id: The wallpaper identifier.
+        :param partial: A PartialEntry, or None once the partial download is gone.
+        """
+        if partial is None:
+            if self.partials.pop(wallpaper_id, None) is None:
+                return
+        else:
+            self.partials[wallpaper_id] = partial
+        self._pending_partials[wallpaper_id] = partial
+
+    def set_journal_offset(self, segment, offset):
+        """
+        Record how far a journal segment has been imported; it will be persisted with the next batch,
+        along with the entries imported from it.
+
+        :param segment: The segment file name.
+        :param offset: The imported bytes, or None once the segment has been deleted.
+        """
+        if offset is None:
+            self.journal_offsets.pop(segment, None)
+        else:
+            self.journal_offsets[segment] = offset
+        self._pending_offsets[segment] = offset
+
+    def add_variants(self, wallpaper_id, sizes):
+        """
+        Record the variants rendered for a wallpaper; they will be persisted with the next batch.
+
+        :param wallpaper_id: The wallpaper identifier.
+        :param sizes: The sizes of the rendered variants.
+        """
+        new_sizes = set(sizes) - self.variants[wallpaper_id]
+        self.variants[wallpaper_id] |= new_sizes
+        self._pending_variants.extend((wallpaper_id, s.width, s.height) for s in new_sizes)
+
+    def flush(self):
+        """
+        Persist the pending entries in a single transaction.
+        If `executor` is set, the transaction runs there and this returns at once:
+        as the executor runs a single thread, transactions are written in order.
+
+        :return: The future of the transaction (None without an executor),
+            done once every batch flushed so far has been written.
+        """
+        batch = (
+            self._pending, self._pending_variants, self._pending_removals, self._pending_rejections,
+            self._pending_offsets, self._pending_partials,
+        )
+        self._pending = []
+        self._pending_variants = []
+        self._pending_removals = []
+        self._pending_rejections = []
+        self._pending_offsets = {}
+        self._pending_partials = {}
+
+        if self.executor is None:
+            self._write(*batch)
+            return None
+        future = self.executor.submit(self._write, *batch)
+        future.add_done_callback(_log_failure)
+        return future
+
+    def _write(self, entries, variants, removals, rejections, offsets, partials):
+        if not (entries or variants or removals or rejections or offsets or partials):
+            return
+
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM wallpapers WHERE url = ?", ((url,) for url, _ in removals)
+            )
+            self.connection.executemany(
+                "DELETE FROM variants WHERE id = ?", ((i,) for _, i in removals)
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO wallpapers ({}) VALUES ({})".format(
+                    ", ".join(CacheEntry._fields), ", ".join("?" * len(CacheEntry._fields))
+                ),
+                entries
+            )
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO variants VALUES (?, ?, ?)", variants
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO rejected VALUES (?, ?, ?, ?)", rejections
+            )
+            self.connection.executemany(
+                "DELETE FROM journals WHERE segment = ?",
+                ((segment,) for segment, offset in offsets.items() if offset is None)
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO journals VALUES (?, ?)",
+                ((segment, offset) for segment, offset in offsets.items() if offset is not None)
+            )
+            self.connection.executemany(
+                "DELETE FROM partials WHERE id = ?",
+                ((wallpaper_id,) for wallpaper_id, partial in partials.items() if partial is None)
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO partials VALUES (?, ?, ?, ?, ?)",
+                ((wallpaper_id,) + tuple(partial) for wallpaper_id, partial in partials.items() if partial is not None)
+            )
+        logger.debug(
+            "Flushed %d entries, %d variants, %d removals, %d rejections, %d journal offsets "
+            "and %d partial downloads to the cache index.",
+            len(entries), len(variants), len(removals), len(rejections), len(offsets), len(partials),
+        )
+
+    def close(self):
+        """
+        Flush the pending entries and close the index.
+        """
+        self.flush()
+        self.connection.close()
+
+    def _migrate_sidecars(self):
+        """
+        Import the per-wallpaper JSON info files of previous versions, then remove them.
+        Any other JSON file (e.g. the metrics) is kept.
+        """
+        sidecars = glob.glob(os.path.join(self.output_path, "*.json"))
+        if not sidecars:
+            return
+
+        imported = []
+        for sidecar in sidecars:
+            try:
+                with open(sidecar) as f:
+                    info = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning("Can't import '%s', keeping it: %s.", sidecar, e)
+                continue
+
+            wallpaper_id = os.path.splitext(os.path.basename(sidecar))[0]
+            image_type = info.get("image_type") if isinstance(info, dict) else None
+            image_path = os.path.join(self.output_path, "{}.{}".format(wallpaper_id, image_type))
+            if not (image_type and info.get("url") and os.path.exists(image_path)):
+                logger.info("'%s' is not a wallpaper info file, keeping it.", sidecar)
+                continue
+
+            stat = os.stat(image_path)
+            self.add(CacheEntry(
+                url=info["url"],
+                id=wallpaper_id,
+                title=info.get("title"),
+                subreddit=info.get("subreddit"),
+                width=info.get("width"),
+                height=info.get("height"),
+                image_type=image_type,
+                byte_size=stat.st_size,
+                downloaded_at=stat.st_mtime,
+                content_hash=None,
+                last_used=stat.st_mtime,
+                score=None,
+                linked_to=None,
+            ))
+            imported.append(sidecar)
+
+        # Persist before deleting anything.
+        self.flush()
+        logger.info("Imported %d wallpaper info files into the cache index.", len(imported))
+        for sidecar in imported:
+            os.unlink(sidecar)
+
+    def _migrate_ids(self):
+        """
+        Rename the wallpapers stored with the adler32-based identifiers of previous versions.
+        """
+        for entry in list(self.entries.values()):
+            new_id = utils.url_id(entry.url)
+            if entry.id == new_id:
+                continue
+
+            old_path = os.path.join(self.output_path, "{}.{}".format(entry.id, entry.image_type))
+            new_path = os.path.join(self.output_path, "{}.{}".format(new_id, entry.image_type))
+            try:
+                os.replace(old_path, new_path)
+            except FileNotFoundError:
+                logger.debug("Dropping '%s' from the cache index: file is missing.", entry.url)
+                with self.connection:
+                    self.connection.execute("DELETE FROM wallpapers WHERE url = ?", (entry.url,))
+                del self.entries[entry.url]
+                continue
+
+            self.add(entry._replace(id=new_id))
+        self.flush()
+
+
+class ListingCache(object):
+
+    """
+    An SQLite cache of the parsed subreddit listing pages, along with their validators.
+    Its methods block on the disk: run them off the event loop (see `fileio.FileIO.query`).
+    """
+
+    def __init__(self, output_path, filename=constants.LISTING_CACHE_FILENAME, max_age=0):
+        """
+        :param output_path: The folder storing the cache.
+        :param filename: The cache file name.
+        :param max_age: Pages not fetched, nor revalidated, for this many seconds are deleted (0 keeps them).
+        """
+        assert output_path
+        assert max_age >= 0, "Malformed listing cache retention."
+        self.path = os.path.join(output_path, filename)
+        self.max_age = max_age
+
+        # Used by a single thread at a time, e.g. the database thread of `fileio.FileIO`.
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(_LISTING_SCHEMA)
+            self.connection.execute(_LISTING_INDEX)
+            self._prune()
+
+    @staticmethod
+    def key(url, params, filters=None):
+        """
+        :param url: The listing URL.
+        :param params: The query parameters.
+        :param filters: The filters the cached wallpapers have been selected with.
+        :return: The cache key of a listing page.
+        """
+        return "{}?{}#{}".format(url, "&".join(
+            "{}={}".format(k, v) for k, v in sorted(params.items())
+        ), "&".join(
+            "{}={}".format(k, v) for k, v in sorted((filters or {}).items())
+        ))
+
+    def get(self, key):
+        """
+        :param key: A listing key.
+        :return: The cached ListingEntry, or None.
+        """
+        row = self.connection.execute(
+            "SELECT etag, last_modified, fetched_at, walls, after, names FROM listing_pages WHERE key = ?",
+            (key,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        etag, last_modified, fetched_at, walls, after, names = row
+        walls = [
+            RedditWallpaperChooser.wallpaper.WebWallpaper(
+                title, url, utils.Size(width, height), subreddit, score[0] if score else None
+            ) for title, url, width, height, subreddit, *score in json.loads(walls)  # No score before.
+        ]
+        return ListingEntry(
+            etag, last_modified, fetched_at,
+            RedditWallpaperChooser.reddit.Page(walls, after, json.loads(names)),
+        )
+
+    def put(self, key, etag, last_modified, page):
+        """
+        Store a parsed listing page.
+
+        :param key: A listing key.
+        :param etag: The ETag response header (can be None).
+        :param last_modified: The Last-Modified response header (can be None).
+        :param page: The parsed page.
+        """
+        walls = json.dumps([
+            (w.title, w.url, w.size.width, w.size.height, w.subreddit, w.score) for w in page.walls
+        ])
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO listing_pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, etag, last_modified, time.time(), walls, page.after, json.dumps(page.names))
+            )
+            # Keys include the paging cursor and the page size: old pages are never asked for again.
+            self._prune()
+
+    def touch(self, key):
+        """
+        Mark a cached listing page as fresh, e.g. after a '304 Not Modified'.
+
+        :param key: A listing key.
+        """
+        with self.connection:
+            self.connection.execute(
+                "UPDATE listing_pages SET fetched_at = ? WHERE key = ?", (time.time(), key)
+            )
+
+    def _prune(self):
+        if self.max_age:
+            self.connection.execute(
+                "DELETE FROM listing_pages WHERE fetched_at < ?", (time.time() - self.max_age,)
+            )
+
+    def close(self):
+        """
+        Close the cache.
+        """
+        self.connection.close()
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Can't write the cache index: %s.", future.exception())
@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Coordination of several nodes sharing a single output folder (e.g. on NFS).
+
+Subreddits are partitioned across the nodes with consistent hashing, so that each listing is fetched by a single node.
+Downloads are serialized through lock files, created atomically with `O_EXCL`,
+and each node publishes the wallpapers it stores (and evicts) in its own append-only journal,
+that the other nodes import: a wallpaper stored by a node is never downloaded again by its peers.
+Journal segments are deleted once every node has imported them.
+"""
+
+import bisect
+import glob
+import hashlib
+import json
+import logging
+import os
+import os.path
+import threading
+import time
+import uuid
+
+import RedditWallpaperChooser.cache
+from RedditWallpaperChooser import constants
+
+__author__ = 'aldur'
+
+logger = logging.getLogger(__name__)
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing(object):
+
+    """
+    A consistent hashing ring: adding or removing a node only moves the keys of that node.
+    """
+
+    def __init__(self, nodes, replicas=constants.CLUSTER_RING_REPLICAS):
+        """
+        :param nodes: The node names.
+        :param replicas: The virtual nodes per node, spreading the keys evenly.
+        """
+        assert nodes, "I need at least a node."
+        self.nodes = tuple(sorted(set(nodes)))
+        self._ring = sorted(
+            (_hash("{}#{}".format(node, i)), node)
+            for node in self.nodes
+            for i in range(replicas)
+        )
+        self._hashes = [h for h, _ in self._ring]
+
+    def owner(self, key):
+        """
+        :param key: A key, e.g. a subreddit.
+        :return: The node owning the key.
+        """
+        position = bisect.bisect(self._hashes, _hash(key)) % len(self._ring)
+        return self._ring[position][1]
+
+
+class FileLock(object):
+
+    """
+    A lock file, created atomically with `O_EXCL` (which is atomic on NFSv3 and later).
+    Locks not refreshed for `timeout` seconds are considered stale, i.e. left by a crashed node, and are broken.
+    Each lock writes a token of its own in the file, so that a lock broken and taken by another node is never removed.
+    """
+
+    def __init__(self, path, owner, timeout=constants.CLUSTER_LOCK_TIMEOUT):
+        """
+        :param path: The lock file path.
+        :param owner: The name of the node taking the lock, written in the file.
+        :param timeout: After this many seconds without a refresh, the lock is considered stale.
+        """
+        self.path = path
+        self.owner = owner
+        self.timeout = timeout
+        self.token = "{} {}".format(owner, uuid.uuid4().hex)
+
+    def acquire(self):
+        """
+        :return: True if the lock has been acquired, False if another node holds it.
+        """
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            if not self._break_stale():
+                return False
+            return self.acquire()
+        with os.fdopen(fd, "w") as f:
+            f.write(self.token)
+        return True
+
+    def refresh(self):
+        """
+        Refresh the lock modification time, so that it is not considered stale while the download goes on.
+
+        :return: False if the lock has been broken meanwhile.
+        """
+        if not self._holds():
+            logger.warning("Lost the lock '%s'.", self.path)
+            return False
+        try:
+            os.utime(self.path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def release(self):
+        """
+        Release the lock, unless it has been broken (and maybe taken by another node) meanwhile.
+        """
+        if not self._remove_if(lambda path: _read(path) == self.token):
+            logger.warning("Lock '%s' was broken, not releasing it.", self.path)
+
+    def _holds(self):
+        try:
+            return _read(self.path) == self.token
+        except FileNotFoundError:
+            return False
+
+    def _break_stale(self):
+        """
+        :return: True if the lock was stale and has been broken.
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return True
+        if time.time() - stat.st_mtime < self.timeout:
+            return False
+
+        logger.warning("Breaking the stale lock '%s'.", self.path)
+        # Another node could break it first, and take it: only the very file found stale is removed.
+        return self._remove_if(lambda path: os.stat(path).st_ino == stat.st_ino)
+
+    def _remove_if(self, check):
+        """
+        Remove the lock file if `check` holds for it.
+        The file is first renamed away, and put back if the check fails:
+        a lock is never removed between the check and the removal.
+
+        :param check: A function of the renamed lock path.
+        :return: True if the lock has been removed, or was already gone.
+        """
+        moved = "{}.{}".format(self.path, uuid.uuid4().hex)
+        try:
+            os.rename(self.path, moved)
+        except FileNotFoundError:
+            return True
+        try:
+            try:
+                if check(moved):
+                    return True
+            except FileNotFoundError:
+                return True
+            try:
+                os.link(moved, self.path)
+            except FileExistsError:  # Taken meanwhile: the lock found is lost anyway.
+                pass
+            return False
+        finally:
+            os.unlink(moved)
+
+
+class Cluster(object):
+
+    """
+    The view of a node on the cluster.
+
+    Journals are split in segments: once a segment exceeds `segment_bytes`, the node starts a new one.
+    After each sync, a node publishes how far it imported the segments of its peers (`.journal-progress.<node>.json`),
+    and deletes its own segments that every peer has fully imported.
+    """
+
+    def __init__(self, output_path, node, nodes, segment_bytes=constants.CLUSTER_JOURNAL_SEGMENT_BYTES):
+        """
+        :param output_path: The output folder, shared by every node.
+        :param node: The name of this node.
+        :param nodes: The names of all the nodes.
+        :param segment_bytes: The size after which a new journal segment is started.
+        """
+        assert node in nodes, "This node is not part of the cluster."
+        self.output_path = output_path
+        self.node = node
+        self.ring = HashRing(nodes)
+        self.segment_bytes = segment_bytes
+
+        segments = sorted(sequence for owner, sequence in journals(output_path).values() if owner == node)
+        self._sequence = segments[-1] if segments else 0
+        self.journal_path = journal_path(output_path, node, self._sequence)
+        # Publications come from several I/O threads.
+        self._publish_lock = threading.Lock()
+        # The offsets last published in the progress file.
+        self._acknowledged = None
+
+    def owns(self, key):
+        """
+        :param key: A subreddit, or a wallpaper identifier.
+        :return: True if this node is responsible for the key.
+        """
+        return self.ring.owner(key) == self.node
+
+    def lock(self, wallpaper_id):
+        """
+        :param wallpaper_id: The wallpaper identifier.
+        :return: The (not yet acquired) lock on the download of that wallpaper.
+        """
+        return FileLock(os.path.join(self.output_path, ".{}.lock".format(wallpaper_id)), self.node)
+
+    def publish(self, added=(), removed=()):
+        """
+        Append the stored and the evicted wallpapers to the journal of this node.
+
+        :param added: The cache entries of the stored wallpapers.
+        :param removed: The URLs of the evicted wallpapers.
+        """
+        records = [{"add": entry._asdict()} for entry in added] + [{"remove": url} for url in removed]
+        if not records:
+            return
+        with self._publish_lock:
+            # Single appends are atomic with O_APPEND, so that readers never see a torn record.
+            with open(self.journal_path, "a") as f:
+                f.write("".join(json.dumps(record) + "\n" for record in records))
+                if f.tell() >= self.segment_bytes:
+                    self._sequence += 1
+                    self.journal_path = journal_path(self.output_path, self.node, self._sequence)
+
+    def read(self, offsets):
+        """
+        Read the records published by the other nodes past `offsets`.
+        It blocks on the shared folder: run it off the event loop, then `apply` what it returns.
+
+        :param offsets: How far each journal segment has been imported, by file name.
+        :return: The journal segments (see `journals`),
+            and the (segment, offset, record) of each record read, where `offset` follows the record.
+            Records adding a wallpaper whose image is missing are None.
+        """
+        segments = journals(self.output_path)
+        records = []
+        for name, (owner, _) in sorted(segments.items(), key=lambda item: item[1]):
+            if owner == self.node:
+                continue
+
+            try:
+                f = open(os.path.join(self.output_path, name))
+            except FileNotFoundError:  # Deleted by its owner, once imported.
+                continue
+            with f:
+                f.seek(offsets.get(name, 0))
+                for line in iter(f.readline, ""):
+                    if not line.endswith("\n"):  # Still being written.
+                        break
+                    record = json.loads(line)
+                    if "add" in record and not os.path.exists(os.path.join(
+                            self.output_path, "{}.{}".format(record["add"]["id"], record["add"]["image_type"])
+                    )):
+                        record = None
+                    records.append((name, f.tell(), record))
+        return segments, records
+
+    def apply(self, cache, segments, records):
+        """
+        Import in the cache index the records returned by `read`,
+        along with how far each journal segment has been imported.
+        Records already imported (e.g. by a concurrent sync) are skipped.
+
+        :param cache: The cache index.
+        :param segments: The journal segments.
+        :param records: The records read.
+        :return: The number of records that changed the cache index.
+        """
+        imported = 0
+        for name, offset, record in records:
+            if offset <= cache.journal_offsets.get(name, 0):
+                continue
+            if record is not None:
+                imported += self._import(cache, record)
+            cache.set_journal_offset(name, offset)
+
+        # The segments deleted by their owners.
+        for name in set(cache.journal_offsets) - set(segments):
+            cache.set_journal_offset(name, None)
+
+        if imported:
+            logger.debug("Imported %d records from the other nodes.", imported)
+        return imported
+
+    def acknowledge(self, offsets, segments):
+        """
+        Publish how far the journals of the other nodes have been imported (once persisted in the cache index),
+        then delete the journal segments of this node that every peer has imported.
+        It blocks on the shared folder: run it off the event loop.
+
+        :param offsets: How far each journal segment has been imported, by file name.
+        :param segments: The journal segments (see `journals`).
+        """
+        if offsets != self._acknowledged:
+            path = progress_path(self.output_path, self.node)
+            tmp_path = "{}.tmp".format(path)
+            with open(tmp_path, "w") as f:
+                json.dump(offsets, f)
+            os.replace(tmp_path, path)
+            self._acknowledged = offsets
+        self._compact(segments)
+
+    def _compact(self, segments):
+        """
+        Delete the segments of this node, but the current one, that every peer has fully imported.
+
+        :param segments: The journal segments (see `journals`).
+        """
+        completed = [
+            name for name, (owner, sequence) in segments.items() if owner == self.node and sequence < self._sequence
+        ]
+        if not completed:
+            return
+
+        progress = []
+        for peer in self.ring.nodes:
+            if peer == self.node:
+                continue
+            try:
+                with open(progress_path(self.output_path, peer)) as f:
+                    progress.append(json.load(f))
+            except FileNotFoundError:  # The peer never imported anything.
+                return
+            except ValueError as e:
+                logger.debug("Can't read the progress of '%s': %s.", peer, e)
+                return
+
+        for name in completed:
+            path = os.path.join(self.output_path, name)
+            if all(offsets.get(name, 0) >= os.path.getsize(path) for offsets in progress):
+                logger.debug("Deleting the journal segment '%s', imported by every peer.", name)
+                os.unlink(path)
+
+    def _import(self, cache, record):
+        """
+        :return: 1 if the record changed the cache index, 0 otherwise.
+        """
+        if "remove" in record:
+            if record["remove"] not in cache:
+                return 0
+            cache.remove(record["remove"])
+            return 1
+
+        entry = RedditWallpaperChooser.cache.CacheEntry(**record["add"])
+        known = cache.get(entry.url)
+        if known is not None and known.id == entry.id:
+            return 0
+        cache.add(entry)
+        return 1
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def node_filename(filename, node):
+    """
+    :param filename: The name of a file private to each node, e.g. ".index.sqlite3".
+    :param node: A node name.
+    :return: The name of that file for that node, e.g. ".index.<node>.sqlite3".
+    """
+    base, extension = os.path.splitext(filename)
+    return "{}.{}{}".format(base, node, extension)
+
+
+def journal_path(output_path, node, sequence):
+    """
+    :param output_path: The shared output folder.
+    :param node: A node name.
+    :param sequence: The segment sequence number.
+    :return: The path of that segment of the journal of that node.
+    """
+    return os.path.join(output_path, ".journal.{}.{:08d}.jsonl".format(node, sequence))
+
+
+def journals(output_path):
+    """
+    :param output_path: The shared output folder.
+    :return: The node and the sequence number of each journal segment, by file name.
+    """
+    segments = {}
+    for path in glob.glob(os.path.join(output_path, ".journal.*.jsonl")):
+        name = os.path.basename(path)
+        node, _, sequence = name[len(".journal."):-len(".jsonl")].rpartition(".")
+        if node and sequence.isdigit():
+            segments[name] = (node, int(sequence))
+    return segments
+
+
+def progress_path(output_path, node):
+    """
+    :param output_path: The shared output folder.
+    :param node: A node name.
+    :return: The path where that node publishes how far it imported the journals of its peers.
+    """
+    return os.path.join(output_path, ".journal-progress.{}.json".format(node))
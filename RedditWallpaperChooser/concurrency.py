@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Adaptive limits on the concurrent downloads from each image host.
+"""
+
+import asyncio
+import collections
+import contextlib
+import logging
+import math
+import time
+import urllib.parse
+
+from RedditWallpaperChooser import constants
+
+__author__ = 'aldur'
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveLimit(object):
+
+    """
+    A limit on concurrent requests, tuned on their latency gradient (as Netflix's Gradient2 limit).
+
+    The time per byte of the requests is tracked by a moving average, and compared to a baseline following the fastest ones:
+    while they match, the link is not saturated and the limit grows (by about its square root);
+    once requests slow down, i.e. they queue somewhere, the limit shrinks in proportion.
+    Failed requests shrink the limit multiplicatively.
+    Until the first slow down or failure, the limit grows by one for each request (slow start, as in TCP).
+    """
+
+    def __init__(self, minimum, maximum, initial=constants.CONCURRENCY_INITIAL, adaptive=True):
+        """
+        :param minimum: The lowest limit.
+        :param maximum: The highest limit.
+        :param initial: The starting limit (clamped within the bounds).
+        :param adaptive: If False, the limit stays at `maximum`.
+        """
+        assert 0 < minimum <= maximum, "Malformed concurrency bounds."
+        self.minimum = minimum
+        self.maximum = maximum
+        self.adaptive = adaptive
+        self.limit = float(min(max(initial, minimum), maximum)) if adaptive else float(maximum)
+
+        self.in_flight = 0
+        self.slow_start = adaptive
+        # Moving average and baseline of the seconds per byte.
+        self.average = None
+        self.baseline = None
+
+        self._waiters = collections.deque()
+
+    @property
+    def capacity(self):
+        """
+        :return: The number of requests allowed at once.
+        """
+        return int(self.limit)
+
+    async def acquire(self):
+        """
+        Wait for the number of in-flight requests to drop below the limit, then take a slot.
+        """
+        while self.in_flight >= self.capacity:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Woken up, but cancelled before taking the slot: pass the wake-up on to the next waiter.
+                if waiter.done() and not waiter.cancelled():
+                    self._wake_up()
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.in_flight += 1
+
+    def release(self, seconds=None, byte_size=None, failed=False):
+        """
+        Release a slot, updating the limit with the outcome of the request.
+
+        :param seconds: The duration of a successful request.
+        :param byte_size: The bytes transferred by a successful request.
+        :param failed: True if the request failed (e.g. it timed out, or the host is overloaded).
+        """
+        # Requests complete in waves: the limit counts as used if at least half of it was.
+        saturated = 2 * self.in_flight >= self.capacity
+        self.in_flight -= 1
+
+        if self.adaptive:
+            previous = self.capacity
+            if failed:
+                self.slow_start = False
+                self.limit = max(self.limit * constants.CONCURRENCY_BACKOFF, self.minimum)
+            elif seconds is not None and byte_size is not None:
+                self._update(seconds, byte_size, saturated)
+            if self.capacity != previous:
+                logger.debug("Concurrency limit: %d -> %d.", previous, self.capacity)
+
+        self._wake_up()
+
+    def _wake_up(self):
+        """
+        Wake up as many waiters as there are free slots.
+        """
+        for _ in range(min(self.capacity - self.in_flight, len(self._waiters))):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _update(self, seconds, byte_size, saturated):
+        sample = seconds / max(byte_size, constants.CONCURRENCY_SAMPLE_BYTES)
+        if self.average is None:
+            self.average = self.baseline = sample
+        self.average += (sample - self.average) * constants.CONCURRENCY_AVERAGE_WEIGHT
+        # Drifting up slowly, in case the link gets slower for good.
+        self.baseline = min(self.baseline * (1 + constants.CONCURRENCY_BASELINE_DRIFT), sample)
+
+        gradient = min(max(self.baseline / self.average, 0.5), 1.0)
+        if self.slow_start and gradient < constants.CONCURRENCY_TOLERANCE:
+            self.slow_start = False
+        # Growing is only safe while the limit is actually reached: otherwise, samples tell nothing about it.
+        if not saturated:
+            allowance = 0.0
+        elif self.slow_start:
+            self.limit = min(self.limit + 1, self.maximum)
+            return
+        else:
+            allowance = math.sqrt(self.limit)
+        target = self.limit * gradient + allowance
+
+        smoothing = constants.CONCURRENCY_SMOOTHING
+        self.limit = min(max(self.limit * (1 - smoothing) + target * smoothing, self.minimum), self.maximum)
+
+
+class Sample(object):
+
+    """
+    The outcome of a request, filled in by the caller of `HostLimits.slot`.
+    `io_seconds` is the time spent on the local disk, that does not count towards the request latency.
+    """
+
+    __slots__ = ("byte_size", "failed", "io_seconds")
+
+    def __init__(self):
+        self.byte_size = None
+        self.failed = False
+        self.io_seconds = 0.0
+
+
+class HostLimits(object):
+
+    """
+    An `AdaptiveLimit` for each host, e.g. 'i.redd.it' and 'i.imgur.com'.
+    """
+
+    def __init__(self, minimum, maximum, adaptive=True):
+        """
+        :param minimum: The lowest limit of each host.
+        :param maximum: The highest limit of each host.
+        :param adaptive: If False, each host is allowed `maximum` concurrent requests.
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.adaptive = adaptive
+        self.limits = {}
+
+    def get(self, url):
+        """
+        :param url: A URL.
+        :return: The limit of the URL host.
+        """
+        host = urllib.parse.urlsplit(url).hostname or ""
+        limit = self.limits.get(host)
+        if limit is None:
+            limit = self.limits[host] = AdaptiveLimit(self.minimum, self.maximum, adaptive=self.adaptive)
+        return limit
+
+    @contextlib.asynccontextmanager
+    async def slot(self, url):
+        """
+        Hold a slot of the URL host for the duration of a request.
+        The caller sets the transferred bytes (or the failure) in the yielded `Sample`,
+        along with the time spent writing them to disk; raised exceptions count as failures.
+
+        :param url: The requested URL.
+        :return: The sample of the request.
+        """
+        limit = self.get(url)
+        await limit.acquire()
+        sample = Sample()
+        start = time.perf_counter()
+        try:
+            yield sample
+        except Exception:
+            limit.release(failed=True)
+            raise
+        except BaseException:  # E.g. cancelled: nothing learnt.
+            limit.release()
+            raise
+        limit.release(
+            seconds=time.perf_counter() - start - sample.io_seconds, byte_size=sample.byte_size, failed=sample.failed,
+        )
@@ -5,9 +5,14 @@
 Configuration logic.
 """
 
+import collections
 import configparser
 import logging
+import socket
 
+import RedditWallpaperChooser.constants
+import RedditWallpaperChooser.metrics
+import RedditWallpaperChooser.sampling
 import RedditWallpaperChooser.utils
 
 __author__ = 'aldur'
@@ -20,11 +25,62 @@ REDDIT_SUBREDDITS = "subreddits"
 REDDIT_RESULT_LIMIT = "result_limit"
 REDDIT_SORTING = "sorting"
 REDDIT_TIME = "time"
+REDDIT_LISTING_TTL = "listing_ttl"
+REDDIT_API_URL = "api_url"
+REDDIT_MIN_SCORE = "min_score"
+REDDIT_REQUESTS_PER_MINUTE = "requests_per_minute"
+REDDIT_BURST = "burst"
+REDDIT_MAX_RETRIES = "max_retries"
+REDDIT_TOTAL_RESULTS = "total_results"
+REDDIT_SUBREDDIT_WEIGHTS = "subreddit_weights"
 
 SECTION_WALLPAPER = "wallpaper"
 WALLPAPER_SIZE = "size"
 WALLPAPER_ASPECT_RATIO = "aspect_ratio"
+WALLPAPER_RATIO_TOLERANCE = "ratio_tolerance"
 WALLPAPER_FOLDER = "output_folder"
+WALLPAPER_CHUNK_SIZE = "chunk_size"
+WALLPAPER_MAX_BYTES = "max_bytes"
+WALLPAPER_WRITE_WORKERS = "write_workers"
+WALLPAPER_FSYNC = "fsync"
+WALLPAPER_FSYNC_BATCH = "fsync_batch"
+WALLPAPER_VERIFY = "verify"
+WALLPAPER_PROCESS_WORKERS = "process_workers"
+WALLPAPER_VARIANTS = "variants"
+WALLPAPER_THUMBNAIL_SIZE = "thumbnail_size"
+WALLPAPER_MAX_TOTAL_BYTES = "max_total_bytes"
+WALLPAPER_MAX_FILES = "max_files"
+WALLPAPER_MAX_AGE = "max_age"
+WALLPAPER_CHOOSE_BY = "choose_by"
+
+SECTION_NETWORK = "network"
+NETWORK_LIMIT = "limit"
+NETWORK_LIMIT_PER_HOST = "limit_per_host"
+NETWORK_KEEPALIVE_TIMEOUT = "keepalive_timeout"
+NETWORK_DNS_CACHE_TTL = "dns_cache_ttl"
+NETWORK_DOWNLOAD_WORKERS = "download_workers"
+NETWORK_QUEUE_SIZE = "queue_size"
+NETWORK_ADAPTIVE_CONCURRENCY = "adaptive_concurrency"
+NETWORK_MIN_PER_HOST = "min_per_host"
+
+SECTION_DAEMON = "daemon"
+DAEMON_REFRESH_INTERVAL = "refresh_interval"
+DAEMON_SUBREDDIT_INTERVALS = "subreddit_intervals"
+DAEMON_ROTATE_INTERVAL = "rotate_interval"
+DAEMON_ROTATE_COMMAND = "rotate_command"
+
+SECTION_SERVER = "server"
+SERVER_HOST = "host"
+SERVER_PORT = "port"
+SERVER_UNIX_SOCKET = "unix_socket"
+
+SECTION_CLUSTER = "cluster"
+CLUSTER_NODES = "nodes"
+CLUSTER_NODE = "node"
+
+SECTION_METRICS = "metrics"
+METRICS_OUTPUT = "output"
+METRICS_FORMAT = "format"
 
 _default_config = {
     SECTION_REDDIT: {
@@ -32,16 +88,123 @@ _default_config = {
         REDDIT_SORTING: "hot",
         REDDIT_RESULT_LIMIT: "100",
         REDDIT_TIME: "month",
+        REDDIT_LISTING_TTL: "300",
+        REDDIT_API_URL: RedditWallpaperChooser.constants.REDDIT_API_FORMAT_URL,
+        REDDIT_MIN_SCORE: "",
+        REDDIT_REQUESTS_PER_MINUTE: "60",
+        REDDIT_BURST: "5",
+        REDDIT_MAX_RETRIES: "5",
+        REDDIT_TOTAL_RESULTS: "0",
+        REDDIT_SUBREDDIT_WEIGHTS: "",
     },
 
     SECTION_WALLPAPER: {
         WALLPAPER_SIZE: "1920x1080",
         WALLPAPER_ASPECT_RATIO: "16:9",
+        WALLPAPER_RATIO_TOLERANCE: "0",
         WALLPAPER_FOLDER: "wallpapers",
+        WALLPAPER_CHUNK_SIZE: "65536",
+        WALLPAPER_MAX_BYTES: "52428800",
+        WALLPAPER_WRITE_WORKERS: "4",
+        WALLPAPER_FSYNC: "yes",
+        WALLPAPER_FSYNC_BATCH: "32",
+        WALLPAPER_VERIFY: "yes",
+        WALLPAPER_PROCESS_WORKERS: "0",
+        WALLPAPER_VARIANTS: "",
+        WALLPAPER_THUMBNAIL_SIZE: "",
+        WALLPAPER_MAX_TOTAL_BYTES: "0",
+        WALLPAPER_MAX_FILES: "0",
+        WALLPAPER_MAX_AGE: "0",
+        WALLPAPER_CHOOSE_BY: "uniform",
+    },
+
+    SECTION_NETWORK: {
+        NETWORK_LIMIT: "32",
+        NETWORK_LIMIT_PER_HOST: "16",
+        NETWORK_KEEPALIVE_TIMEOUT: "30",
+        NETWORK_DNS_CACHE_TTL: "300",
+        NETWORK_DOWNLOAD_WORKERS: "16",
+        NETWORK_QUEUE_SIZE: "50",
+        NETWORK_ADAPTIVE_CONCURRENCY: "yes",
+        NETWORK_MIN_PER_HOST: "1",
+    },
+
+    SECTION_DAEMON: {
+        DAEMON_REFRESH_INTERVAL: "600",
+        DAEMON_SUBREDDIT_INTERVALS: "",
+        DAEMON_ROTATE_INTERVAL: "300",
+        DAEMON_ROTATE_COMMAND: "",
+    },
+
+    SECTION_SERVER: {
+        SERVER_HOST: "127.0.0.1",
+        SERVER_PORT: "8765",
+        SERVER_UNIX_SOCKET: "",
+    },
+
+    SECTION_CLUSTER: {
+        CLUSTER_NODES: "",
+        CLUSTER_NODE: "",
+    },
+
+    SECTION_METRICS: {
+        METRICS_OUTPUT: "",
+        METRICS_FORMAT: "json",
     },
 }
 
+Settings = collections.namedtuple("Settings", [
+    "subreddits",
+    "sorting",
+    "time",
+    "result_limit",
+    "total_results",
+    "subreddit_weights",
+    "listing_ttl",
+    "api_url",
+    "requests_per_minute",
+    "burst",
+    "max_retries",
+    "min_score",
+    "size",
+    "ratio",
+    "ratio_tolerance",
+    "output_folder",
+    "chunk_size",
+    "max_bytes",
+    "write_workers",
+    "fsync",
+    "fsync_batch",
+    "verify",
+    "process_workers",
+    "variants",
+    "thumbnail_size",
+    "max_total_bytes",
+    "max_files",
+    "max_age",
+    "choose_by",
+    "limit",
+    "limit_per_host",
+    "keepalive_timeout",
+    "dns_cache_ttl",
+    "download_workers",
+    "queue_size",
+    "adaptive_concurrency",
+    "min_per_host",
+    "refresh_intervals",
+    "rotate_interval",
+    "rotate_command",
+    "server_host",
+    "server_port",
+    "server_socket",
+    "cluster_nodes",
+    "cluster_node",
+    "metrics_output",
+    "metrics_format",
+])
+
 parser = None
+settings = None
 
 
 def as_dictionary():
@@ -59,11 +222,12 @@ def as_dictionary():
 def parse_config(config_path):
     """
     Read the .ini configuration.
-    Store the configuration in the "config" global variable.
+    Store the configuration in the "parser" global variable,
+    and its validated settings in the "settings" global variable.
 
     :param config_path: Path to configuration file.
     """
-    global parser
+    global parser, settings
     if parser is not None:
         logger.debug("Configuration already loaded, skipping.")
         return
@@ -77,6 +241,143 @@ def parse_config(config_path):
     else:
         logger.info("No configuration path provided. Loading default values.")
 
+    settings = _build_settings()
+
+
+def _build_settings():
+    """
+    Parse and validate the configuration once, so that hot paths never go through the parser.
+
+    :return: The immutable settings.
+    """
+    subreddits = tuple(
+        subreddit.strip()
+        for subreddit in parser.get(SECTION_REDDIT, REDDIT_SUBREDDITS).split(",")
+        if subreddit.strip()
+    )
+    assert subreddits, "I need at least a subreddit."
+
+    sorting = parser.get(SECTION_REDDIT, REDDIT_SORTING)
+    assert sorting in RedditWallpaperChooser.constants.REDDIT_ALLOWED_SORTING, "Unknown sorting."
+
+    t = parser.get(SECTION_REDDIT, REDDIT_TIME)
+    assert t in RedditWallpaperChooser.constants.REDDIT_ALLOWED_TIME, "Unknown time."
+
+    chunk_size = parser.getint(SECTION_WALLPAPER, WALLPAPER_CHUNK_SIZE)
+    assert chunk_size > 0, "Chunk size must be positive."
+
+    write_workers = parser.getint(SECTION_WALLPAPER, WALLPAPER_WRITE_WORKERS)
+    assert write_workers > 0, "I need at least one write worker."
+    fsync_batch = parser.getint(SECTION_WALLPAPER, WALLPAPER_FSYNC_BATCH)
+    assert fsync_batch > 0, "Fsync batch must be positive."
+
+    min_score = parser.get(SECTION_REDDIT, REDDIT_MIN_SCORE)
+    min_score = int(min_score) if min_score else None
+
+    ratio_tolerance = parser.getfloat(SECTION_WALLPAPER, WALLPAPER_RATIO_TOLERANCE)
+    assert 0 <= ratio_tolerance < 1, "Malformed ratio tolerance."
+
+    thumbnail_size = parse_size(parser.get(SECTION_WALLPAPER, WALLPAPER_THUMBNAIL_SIZE))
+    variants = tuple(
+        parse_size(size.strip())
+        for size in parser.get(SECTION_WALLPAPER, WALLPAPER_VARIANTS).split(",")
+        if size.strip()
+    )
+    if thumbnail_size and thumbnail_size not in variants:
+        variants += (thumbnail_size,)
+
+    result_limit = parser.getint(SECTION_REDDIT, REDDIT_RESULT_LIMIT)
+    total_results = parser.getint(SECTION_REDDIT, REDDIT_TOTAL_RESULTS) or result_limit * len(subreddits)
+    subreddit_weights = dict.fromkeys(subreddits, 1.0)
+    for item in parser.get(SECTION_REDDIT, REDDIT_SUBREDDIT_WEIGHTS).split(","):
+        if not item.strip():
+            continue
+        assert ":" in item, "Malformed subreddit weight."
+        subreddit, weight = item.split(":")
+        assert subreddit.strip() in subreddit_weights, "Weight for an unknown subreddit."
+        subreddit_weights[subreddit.strip()] = float(weight)
+    assert all(w > 0 for w in subreddit_weights.values()), "Subreddit weights must be positive."
+
+    refresh_interval = parser.getfloat(SECTION_DAEMON, DAEMON_REFRESH_INTERVAL)
+    refresh_intervals = {subreddit: refresh_interval for subreddit in subreddits}
+    for item in parser.get(SECTION_DAEMON, DAEMON_SUBREDDIT_INTERVALS).split(","):
+        if not item.strip():
+            continue
+        assert ":" in item, "Malformed subreddit interval."
+        subreddit, interval = item.split(":")
+        assert subreddit.strip() in refresh_intervals, "Interval for an unknown subreddit."
+        refresh_intervals[subreddit.strip()] = float(interval)
+    assert all(i > 0 for i in refresh_intervals.values()), "Refresh intervals must be positive."
+
+    choose_by = parser.get(SECTION_WALLPAPER, WALLPAPER_CHOOSE_BY)
+    assert choose_by in RedditWallpaperChooser.sampling.CHOOSE_BY, "Unknown weighting."
+
+    cluster_nodes = tuple(
+        node.strip() for node in parser.get(SECTION_CLUSTER, CLUSTER_NODES).split(",") if node.strip()
+    )
+    cluster_node = parser.get(SECTION_CLUSTER, CLUSTER_NODE) or socket.gethostname()
+    assert not cluster_nodes or cluster_node in cluster_nodes, "This node is not part of the cluster."
+
+    metrics_format = parser.get(SECTION_METRICS, METRICS_FORMAT)
+    assert metrics_format in RedditWallpaperChooser.metrics.FORMATS, "Unknown metrics format."
+
+    download_workers = parser.getint(SECTION_NETWORK, NETWORK_DOWNLOAD_WORKERS)
+    assert download_workers > 0, "I need at least one download worker."
+
+    limit_per_host = parser.getint(SECTION_NETWORK, NETWORK_LIMIT_PER_HOST)
+    min_per_host = parser.getint(SECTION_NETWORK, NETWORK_MIN_PER_HOST)
+    assert 0 < min_per_host <= limit_per_host, "Malformed per host limits."
+
+    return Settings(
+        subreddits=subreddits,
+        sorting=sorting,
+        time=t,
+        result_limit=result_limit,
+        total_results=total_results,
+        subreddit_weights=tuple(subreddit_weights.items()),
+        listing_ttl=parser.getint(SECTION_REDDIT, REDDIT_LISTING_TTL),
+        api_url=parser.get(SECTION_REDDIT, REDDIT_API_URL),
+        requests_per_minute=parser.getfloat(SECTION_REDDIT, REDDIT_REQUESTS_PER_MINUTE),
+        burst=parser.getint(SECTION_REDDIT, REDDIT_BURST),
+        max_retries=parser.getint(SECTION_REDDIT, REDDIT_MAX_RETRIES),
+        min_score=min_score,
+        size=get_size(),
+        ratio=get_ratio(),
+        ratio_tolerance=ratio_tolerance,
+        output_folder=parser.get(SECTION_WALLPAPER, WALLPAPER_FOLDER),
+        chunk_size=chunk_size,
+        max_bytes=parser.getint(SECTION_WALLPAPER, WALLPAPER_MAX_BYTES),
+        write_workers=write_workers,
+        fsync=parser.getboolean(SECTION_WALLPAPER, WALLPAPER_FSYNC),
+        fsync_batch=fsync_batch,
+        verify=parser.getboolean(SECTION_WALLPAPER, WALLPAPER_VERIFY),
+        process_workers=parser.getint(SECTION_WALLPAPER, WALLPAPER_PROCESS_WORKERS) or None,
+        variants=variants,
+        thumbnail_size=thumbnail_size,
+        max_total_bytes=parser.getint(SECTION_WALLPAPER, WALLPAPER_MAX_TOTAL_BYTES),
+        max_files=parser.getint(SECTION_WALLPAPER, WALLPAPER_MAX_FILES),
+        max_age=parser.getfloat(SECTION_WALLPAPER, WALLPAPER_MAX_AGE) * 24 * 60 * 60,
+        choose_by=choose_by,
+        limit=parser.getint(SECTION_NETWORK, NETWORK_LIMIT),
+        limit_per_host=limit_per_host,
+        keepalive_timeout=parser.getfloat(SECTION_NETWORK, NETWORK_KEEPALIVE_TIMEOUT),
+        dns_cache_ttl=parser.getint(SECTION_NETWORK, NETWORK_DNS_CACHE_TTL),
+        download_workers=download_workers,
+        queue_size=parser.getint(SECTION_NETWORK, NETWORK_QUEUE_SIZE),
+        adaptive_concurrency=parser.getboolean(SECTION_NETWORK, NETWORK_ADAPTIVE_CONCURRENCY),
+        min_per_host=min_per_host,
+        refresh_intervals=tuple(refresh_intervals.items()),
+        rotate_interval=parser.getfloat(SECTION_DAEMON, DAEMON_ROTATE_INTERVAL),
+        rotate_command=parser.get(SECTION_DAEMON, DAEMON_ROTATE_COMMAND),
+        server_host=parser.get(SECTION_SERVER, SERVER_HOST),
+        server_port=parser.getint(SECTION_SERVER, SERVER_PORT),
+        server_socket=parser.get(SECTION_SERVER, SERVER_UNIX_SOCKET),
+        cluster_nodes=cluster_nodes,
+        cluster_node=cluster_node,
+        metrics_output=parser.get(SECTION_METRICS, METRICS_OUTPUT),
+        metrics_format=metrics_format,
+    )
+
 
 def write_default_config(config_path):
     """
@@ -99,8 +400,16 @@ def get_size():
     :return: An image size.
     """
     assert parser is not None
+    return parse_size(parser.get(SECTION_WALLPAPER, WALLPAPER_SIZE))
+
+
+def parse_size(size):
+    """
+    Parse an image size, such as "1920x1080".
 
-    size = parser.get(SECTION_WALLPAPER, WALLPAPER_SIZE)
+    :param size: The size to be parsed (can be empty).
+    :return: An image size, or None.
+    """
     assert not size or "x" in size, "Malformed image size."
 
     if not size:
@@ -118,7 +427,16 @@ def get_ratio():
 
     :return: The required image ration (as float).
     """
-    ratio = parser.get(SECTION_WALLPAPER, WALLPAPER_ASPECT_RATIO)
+    return parse_ratio(parser.get(SECTION_WALLPAPER, WALLPAPER_ASPECT_RATIO))
+
+
+def parse_ratio(ratio):
+    """
+    Parse an image ratio, such as "16:9".
+
+    :param ratio: The ratio to be parsed (can be empty).
+    :return: The image ratio (as float), or None.
+    """
     assert not ratio or ":" in ratio, "Malformed image ratio."
 
     if not ratio:
@@ -36,3 +36,91 @@ ACCEPTED_CONTENT_TYPES = {
     "image/jpeg": "jpg",
     "image/png": "png",
 }
+
+# Name of the cache index, stored in the output folder.
+CACHE_INDEX_FILENAME = ".index.sqlite3"
+
+# Number of new cache entries written per transaction.
+CACHE_INDEX_BATCH_SIZE = 50
+
+# Name of the listing cache, stored in the output folder.
+LISTING_CACHE_FILENAME = ".listings.sqlite3"
+
+# Listing pages not fetched, nor revalidated, for this many times `listing_ttl` (at least a minute) are deleted.
+LISTING_CACHE_RETENTION = 12
+
+# HTTP statuses on which Reddit API calls are retried.
+REDDIT_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Exponential backoff parameters (seconds) for retried Reddit API calls.
+REDDIT_BACKOFF_BASE = 1.0
+REDDIT_BACKOFF_CAP = 60.0
+
+# How many times an interrupted wallpaper download is resumed within a run.
+DOWNLOAD_ATTEMPTS = 3
+
+# Folder, within the output folder, holding the downloads failing verification.
+QUARANTINE_FOLDER = ".quarantine"
+
+# Seconds after which an untouched partial download is considered abandoned, and deleted on eviction.
+STALE_PART_SECONDS = 24 * 60 * 60
+
+# Folder, within the output folder, holding the resized variants.
+VARIANTS_FOLDER = "variants"
+
+# Half-life (seconds) of the weight of a wallpaper, when recent downloads are preferred.
+CHOOSE_RECENT_HALF_LIFE = 7 * 24 * 60 * 60
+
+# Lowest weight of a candidate wallpaper.
+CHOOSE_MIN_WEIGHT = 1e-9
+
+# Number of filter combinations whose candidates are kept in memory.
+CHOOSER_SAMPLERS = 32
+
+# Virtual nodes per cluster node on the consistent hashing ring.
+CLUSTER_RING_REPLICAS = 100
+
+# Seconds after which the download lock of a cluster node is considered stale.
+CLUSTER_LOCK_TIMEOUT = 600
+
+# Seconds between two checks of a download lock held by another cluster node.
+CLUSTER_LOCK_POLL = 0.5
+
+# Seconds between two refreshes of a download lock, while the download goes on.
+CLUSTER_LOCK_HEARTBEAT = 60
+
+# Size in bytes after which a cluster node starts a new segment of its journal.
+CLUSTER_JOURNAL_SEGMENT_BYTES = 1 << 20
+
+# Maximum number of posts in a listing page.
+REDDIT_PAGE_LIMIT = 100
+
+# Listing page sizes are multiples of this step.
+BUDGET_LIMIT_STEP = 25
+
+# Extra posts requested on top of the ones expected to fill a subreddit quota.
+BUDGET_MARGIN = 1.25
+
+# Downloads are written to disk in blocks of about this many bytes.
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# Starting limit of concurrent downloads from an image host.
+CONCURRENCY_INITIAL = 4
+
+# The limit of an image host is multiplied by this factor when a download fails.
+CONCURRENCY_BACKOFF = 0.75
+
+# Weight of the new samples in the moving average of the download times.
+CONCURRENCY_AVERAGE_WEIGHT = 0.3
+
+# Relative increase, after each download, of the baseline (i.e. fastest) download time.
+CONCURRENCY_BASELINE_DRIFT = 0.001
+
+# Slow start ends once downloads are this much slower than the baseline (as a ratio).
+CONCURRENCY_TOLERANCE = 0.8
+
+# Weight of the new limit of an image host, after each download.
+CONCURRENCY_SMOOTHING = 0.2
+
+# Download times are normalized by their size, counting at least this many bytes.
+CONCURRENCY_SAMPLE_BYTES = 64 * 1024
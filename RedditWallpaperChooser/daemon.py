@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Long-running mode: refresh the subreddits periodically and rotate the wallpaper.
+"""
+
+import asyncio
+import logging
+import shlex
+import signal
+
+__author__ = 'aldur'
+
+logger = logging.getLogger(__name__)
+
+
+class Daemon(object):
+
+    """
+    Keep a manager, and its session, alive.
+    Each subreddit is refreshed on its own interval, fetching only the posts
+    published since the previous refresh; the chosen wallpaper rotates on a timer.
+    """
+
+    def __init__(self, manager, size=None):
+        """
+        :param manager: The manager.
+        :param size: If set, rotate through the variants best fitting this size.
+        """
+        self.manager = manager
+        self.settings = manager.settings
+        self.size = size
+
+    async def refresh_loop(self, session, subreddit, interval, queue):
+        """
+        Refresh a subreddit every `interval` seconds.
+
+        :param session: An aiohttp session.
+        :param subreddit: The subreddit.
+        :param interval: The refresh interval, in seconds.
+        :param queue: The download queue.
+        """
+        manager = self.manager
+        while True:
+            scheduled = await manager.fetch_from_subreddit(session, subreddit, queue, incremental=True)
+            # Only the downloads of this subreddit are waited for.
+            if scheduled:
+                await asyncio.wait(scheduled)
+            await manager.flush_index()
+            await manager.sync()
+            # The wallpapers still to be stored, by any subreddit, are kept.
+            await manager.evict(protected=set(manager.queued))
+            await manager.save_metrics()
+            await asyncio.sleep(interval)
+
+    async def rotate_loop(self):
+        """
+        As soon as a wallpaper is available, and then every `rotate_interval` seconds,
+        choose a wallpaper, print its path
+        and pass it as last argument to `rotate_command`, if any.
+        """
+        command = shlex.split(self.settings.rotate_command)
+        while True:
+            path = self.manager.choose(self.size)
+            if path is None:  # Nothing stored yet.
+                await asyncio.sleep(1)
+                continue
+
+            print(path, flush=True)
+            if command:
+                process = await asyncio.create_subprocess_exec(*command, path)
+                if await process.wait():
+                    logger.warning("'%s' exited with status %d.", self.settings.rotate_command, process.returncode)
+            await asyncio.sleep(self.settings.rotate_interval)
+
+    async def run(self):
+        """
+        Run until cancelled (or until SIGTERM is received).
+        """
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+        manager = self.manager
+        async with manager.session_scope() as session:
+            queue = asyncio.Queue(maxsize=self.settings.queue_size)
+            tasks = [self.rotate_loop()] + [
+                self.refresh_loop(session, subreddit, interval, queue)
+                for subreddit, interval in self.settings.refresh_intervals
+                if manager.fetches(subreddit)
+            ]
+            if manager.variant_sizes:
+                derivatives = asyncio.Queue(maxsize=self.settings.queue_size)
+                tasks += [manager.store(session, queue, derivatives), manager.derive(derivatives)]
+            else:
+                tasks.append(manager.store(session, queue))
+
+            logger.info("Running as a daemon.")
+            try:
+                await asyncio.gather(*tasks)
+            except asyncio.CancelledError:
+                logger.info("Stopping.")
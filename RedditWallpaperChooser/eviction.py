@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Eviction of the stored wallpapers, to respect the disk quota.
+"""
+
+import collections
+import heapq
+import logging
+import os
+import os.path
+import time
+
+import RedditWallpaperChooser.fileio
+import RedditWallpaperChooser.variants
+from RedditWallpaperChooser import constants, utils
+
+__author__ = 'aldur'
+
+logger = logging.getLogger(__name__)
+
+
+def select(entries, max_total_bytes=0, max_files=0, max_age=0, protected=frozenset(), now=None, extra_bytes=0):
+    """
+    Select the wallpapers to be evicted: first the ones older than `max_age`,
+    then the least recently used ones, until both quotas are respected.
+    Hard-linked wallpapers share their bytes, which are freed only once all of them are evicted.
+
+    :param entries: The cache entries.
+    :param max_total_bytes: The maximum total size of the wallpapers (0 for no limit).
+    :param max_files: The maximum number of wallpapers (0 for no limit).
+    :param max_age: The maximum age in seconds since the last use (0 for no limit).
+    :param protected: URLs that must not be evicted.
+    :param now: The current time (defaults to now).
+    :param extra_bytes: The bytes of the other files counting towards `max_total_bytes`.
+    :return: The entries to be evicted.
+    """
+    now = time.time() if now is None else now
+    entries = list(entries)
+
+    # The bytes and the number of links of each file.
+    sizes = {}
+    links = collections.Counter()
+    for entry in entries:
+        key = _file_key(entry)
+        sizes[key] = entry.byte_size or 0
+        links[key] += 1
+    total_bytes = extra_bytes + sum(sizes.values())
+    files = len(entries)
+
+    def _last_used(e):
+        return e.last_used or e.downloaded_at or 0
+
+    def _evict(e):
+        nonlocal total_bytes, files
+        evicted.append(e)
+        key = _file_key(e)
+        links[key] -= 1
+        if not links[key]:
+            total_bytes -= sizes[key]
+        files -= 1
+
+    evicted = []
+    candidates = []
+    for entry in entries:
+        if entry.url in protected:
+            continue
+        if max_age and now - _last_used(entry) > max_age:
+            _evict(entry)
+        else:
+            candidates.append((_last_used(entry), entry.url, entry))
+
+    heapq.heapify(candidates)
+    while candidates and (
+            (max_total_bytes and total_bytes > max_total_bytes) or (max_files and files > max_files)):
+        _, _, entry = heapq.heappop(candidates)
+        _evict(entry)
+
+    return evicted
+
+
+async def evict(cache, files, output_path, variants_path, max_total_bytes=0, max_files=0, max_age=0,
+                protected=frozenset()):
+    """
+    Delete the wallpapers selected by `select`, along with their variants, and drop them from the index.
+    Files are deleted in the I/O thread pool; their sizes, and hard links, come from the index.
+    Partial downloads and quarantined files count towards `max_total_bytes`:
+    abandoned partial downloads are deleted, as are quarantined files older than `max_age`;
+    then the oldest quarantined files are deleted, before any wallpaper, until the rest fits.
+
+    :param cache: The cache index.
+    :param files: The `FileIO` running the filesystem calls.
+    :param output_path: The folder storing the wallpapers.
+    :param variants_path: The folder storing the variants.
+    :return: The URLs of the evicted wallpapers.
+    """
+    if not (max_total_bytes or max_files or max_age):
+        return set()
+
+    now = time.time()
+    doomed = []
+    extra_bytes = 0
+    for wallpaper_id, partial in list(cache.partials.items()):
+        if now - partial.updated_at > constants.STALE_PART_SECONDS:
+            logger.debug("Deleting the abandoned partial download of '%s'.", partial.url)
+            doomed.append(os.path.join(output_path, ".{}.part".format(wallpaper_id)))
+            cache.set_partial(wallpaper_id, None)
+        else:
+            extra_bytes += partial.byte_size
+
+    # The wallpaper bytes, counting each hard-linked file once.
+    wallpaper_bytes = sum({_file_key(entry): entry.byte_size or 0 for entry in cache.entries.values()}.values())
+    # The newest quarantined files are kept, as long as they fit.
+    quarantine_path = os.path.join(output_path, constants.QUARANTINE_FOLDER)
+    for url, (rejected_at, size) in sorted(cache.quarantined.items(), key=lambda item: item[1], reverse=True):
+        if (max_age and now - rejected_at > max_age) or (
+                max_total_bytes and wallpaper_bytes + extra_bytes + size > max_total_bytes):
+            logger.debug("Deleting the quarantined download of '%s'.", url)
+            doomed.append(os.path.join(quarantine_path, utils.url_id(url)))
+            cache.release_quarantined(url)
+        else:
+            extra_bytes += size
+
+    evicted = select(
+        cache.entries.values(), max_total_bytes, max_files, max_age, protected, now=now, extra_bytes=extra_bytes,
+    )
+    for entry in evicted:
+        doomed.append(os.path.join(output_path, "{}.{}".format(entry.id, entry.image_type)))
+        doomed.extend(
+            os.path.join(variants_path, RedditWallpaperChooser.variants.variant_name(entry.id, size))
+            for size in cache.variants.get(entry.id, ())
+        )
+    # Dropped from the index first, so that they are not chosen while being deleted.
+    for entry in evicted:
+        cache.remove(entry.url)
+    if doomed:
+        await files.call(_remove, doomed)
+        cache.flush()
+
+    if evicted:
+        logger.info("Evicted %d wallpapers.", len(evicted))
+    return {entry.url for entry in evicted}
+
+
+def _file_key(entry):
+    # Hard-linked wallpapers share the file of the one they have been linked to.
+    return entry.linked_to or entry.id
+
+
+def _remove(paths):
+    for path in paths:
+        RedditWallpaperChooser.fileio.remove(path)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Filesystem and database operations run off the event loop, on bounded thread pools.
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import os
+import os.path
+
+__author__ = 'aldur'
+
+logger = logging.getLogger(__name__)
+
+
+class FileIO(object):
+
+    """
+    Run blocking filesystem calls on a pool of `workers` threads, so that a slow disk
+    (e.g. an SD card or a network filesystem) never stalls the downloads and the listing requests.
+
+    Completed files are moved in place by `commit`, with group commit:
+    while a group is being flushed to disk, the next files wait for it and are then flushed together,
+    followed by a single flush of each of their folders.
+
+    SQLite calls run on a thread of their own (`database`, see `query`),
+    so that each connection is used by a single thread and its transactions never interleave.
+    """
+
+    def __init__(self, workers, fsync=True, fsync_batch=32):
+        """
+        :param workers: The maximum number of concurrent filesystem calls.
+        :param fsync: If True, files are flushed to disk before being moved in place.
+        :param fsync_batch: The maximum number of files flushed together.
+        """
+        assert workers > 0, "I need at least one I/O worker."
+        assert fsync_batch > 0, "Malformed fsync batch."
+        self.workers = workers
+        self.fsync = fsync
+        self.fsync_batch = fsync_batch
+
+        self.pool = None
+        self.database = None
+        # The (source, destination, future) of the files waiting to be committed.
+        self._pending = []
+        self._committer = None
+
+    def start(self):
+        """
+        Start the thread pools.
+        """
+        if self.pool is None:
+            self.pool = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="fileio")
+        if self.database is None:
+            self.database = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="database")
+
+    def shutdown(self):
+        """
+        Wait for the pending calls and stop the thread pools.
+        """
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        if self.database is not None:
+            self.database.shutdown()
+            self.database = None
+
+    async def call(self, function, *args, **kwargs):
+        """
+        :param function: A blocking function.
+        :return: What `function(*args, **kwargs)` returns, run in the thread pool.
+        """
+        assert self.pool is not None, "The I/O pool is not running."
+        return await asyncio.get_running_loop().run_in_executor(
+            self.pool, functools.partial(function, *args, **kwargs)
+        )
+
+    async def query(self, function, *args, **kwargs):
+        """
+        :param function: A blocking function using an SQLite connection.
+        :return: What `function(*args, **kwargs)` returns, run in the database thread.
+        """
+        assert self.database is not None, "The I/O pool is not running."
+        return await asyncio.get_running_loop().run_in_executor(
+            self.database, functools.partial(function, *args, **kwargs)
+        )
+
+    async def commit(self, path, destination):
+        """
+        Durably move a completed file in place.
+
+        :param path: The completed file.
+        :param destination: Its final path, atomically replaced.
+        """
+        if not self.fsync:
+            await self.call(os.replace, path, destination)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((path, destination, future))
+        if self._committer is None or self._committer.done():
+            self._committer = asyncio.ensure_future(self._commit_pending())
+        await future
+
+    async def _commit_pending(self):
+        while self._pending:
+            batch, self._pending = self._pending[:self.fsync_batch], self._pending[self.fsync_batch:]
+            try:
+                await self.call(_commit, [(path, destination) for path, destination, _ in batch])
+            except OSError as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            logger.debug("Committed %d files.", len(batch))
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+
+
+def _commit(moves):
+    """
+    Flush the files to disk, move them in place and flush their folders.
+
+    :param moves: The (source, destination) paths of the files.
+    """
+    for path, _ in moves:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    for path, destination in moves:
+        os.replace(path, destination)
+
+    for folder in {os.path.dirname(os.path.abspath(destination)) for _, destination in moves}:
+        fsync_folder(folder)
+
+
+def fsync_folder(folder):
+    """
+    Flush the entries of a folder (e.g. after a rename) to disk, where supported.
+
+    :param folder: The folder path.
+    """
+    try:
+        fd = os.open(folder, os.O_RDONLY)
+    except OSError as e:  # E.g. on Windows, folders can't be opened.
+        logger.debug("Can't open '%s': %s.", folder, e)
+        return
+    try:
+        os.fsync(fd)
+    except OSError as e:
+        logger.debug("Can't flush '%s': %s.", folder, e)
+    finally:
+        os.close(fd)
+
+
+def size(path):
+    """
+    :param path: A file path.
+    :return: The size of the file in bytes, 0 if it does not exist.
+    """
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+def remove(path):
+    """
+    Remove a file, if it exists.
+
+    :param path: A file path.
+    """
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Batch filtering and ranking of candidate wallpapers.
+"""
+
+import logging
+
+from RedditWallpaperChooser import utils
+
+__author__ = 'aldur'
+
+logger = logging.getLogger(__name__)
+
+
+def ratio_fits(ratio, target_ratio, ratio_tolerance=0.0):
+    """
+    :param ratio: An image ratio.
+    :param target_ratio: The target ratio.
+    :param ratio_tolerance: The accepted relative deviation from the target (0 requires an exact match).
+    :return: True if `ratio` respects the target.
+    """
+    if ratio_tolerance:
+        return abs(ratio - target_ratio) <= ratio_tolerance * target_ratio
+    return round(ratio, 5) == target_ratio
+
+
+def filter_and_rank(widths, heights, scores=None, ages=None, target_size=None,
+                    target_ratio=None, ratio_tolerance=0.0, min_score=None):
+    """
+    Filter a batch of candidates in a single pass, then rank the accepted ones
+    by descending score and, on ties, by ascending age.
+    NumPy is used if available.
+
+    :param widths: The candidate widths.
+    :param heights: The candidate heights.
+    :param scores: The candidate scores (can be None).
+    :param ages: The candidate ages, in seconds (can be None).
+    :param target_size: A minimum size (can be None).
+    :param target_ratio: A target ratio (can be None).
+    :param ratio_tolerance: The accepted relative deviation from the target ratio.
+    :param min_score: A minimum score (can be None).
+    :return: The ranked indices of the accepted candidates.
+    """
+    if not len(widths):
+        return []
+    if utils.optional_import("numpy") is not None:
+        return _filter_and_rank_numpy(
+            widths, heights, scores, ages, target_size, target_ratio, ratio_tolerance, min_score
+        )
+    return _filter_and_rank_python(
+        widths, heights, scores, ages, target_size, target_ratio, ratio_tolerance, min_score
+    )
+
+
+def _filter_and_rank_numpy(widths, heights, scores, ages, target_size,
+                           target_ratio, ratio_tolerance, min_score):
+    numpy = utils.optional_import("numpy")
+    widths = numpy.asarray(widths, dtype=numpy.float64)
+    heights = numpy.asarray(heights, dtype=numpy.float64)
+    mask = numpy.ones(len(widths), dtype=bool)
+
+    if target_size:
+        mask &= (widths >= target_size.width) & (heights >= target_size.height)
+    if target_ratio:
+        ratios = widths / heights
+        if ratio_tolerance:
+            mask &= numpy.abs(ratios - target_ratio) <= ratio_tolerance * target_ratio
+        else:
+            mask &= numpy.round(ratios, 5) == target_ratio
+
+    keys = []
+    if ages is not None:
+        keys.append(numpy.asarray(ages, dtype=numpy.float64))
+    if scores is not None:
+        scores = numpy.asarray(scores, dtype=numpy.float64)
+        if min_score is not None:
+            mask &= scores >= min_score
+        keys.append(-scores)
+
+    if not keys:
+        return numpy.flatnonzero(mask).tolist()
+
+    # The last key is the primary one; the sort is stable.
+    order = numpy.lexsort(keys)
+    return order[mask[order]].tolist()
+
+
+def _filter_and_rank_python(widths, heights, scores, ages, target_size,
+                            target_ratio, ratio_tolerance, min_score):
+    accepted = []
+    for i, (width, height) in enumerate(zip(widths, heights)):
+        if target_size and (width < target_size.width or height < target_size.height):
+            continue
+        if target_ratio and not ratio_fits(float(width) / height, target_ratio, ratio_tolerance):
+            continue
+        if scores is not None and min_score is not None and scores[i] < min_score:
+            continue
+        accepted.append(i)
+
+    def _key(i):
+        return (
+            -scores[i] if scores is not None else 0,
+            ages[i] if ages is not None else 0,
+        )
+
+    if scores is not None or ages is not None:
+        accepted.sort(key=_key)
+    return accepted
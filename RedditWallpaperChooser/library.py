@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+The library of stored wallpapers, usable without any network access.
+"""
+
+import logging
+import os
+import os.path
+
+import RedditWallpaperChooser.cache
+import RedditWallpaperChooser.cluster
+import RedditWallpaperChooser.sampling
+import RedditWallpaperChooser.variants
+import RedditWallpaperChooser.wallpaper
+from RedditWallpaperChooser import constants
+
+__author__ = 'aldur'
+
+logger = logging.getLogger(__name__)
+
+
+class Library(object):
+
+    """
+    The wallpapers stored in the output folder, along with their variants.
+    This module does not depend on the network stack, so that choosing a stored wallpaper starts quickly.
+    """
+
+    def __init__(self, output_path, settings, read_only=False):
+        """
+        :param output_path: The folder storing the wallpapers.
+        :param settings: The configuration settings, see `config.Settings`.
+        :param read_only: If True, the library is only used to choose a wallpaper:
+            the index is neither migrated nor preloaded (see `cache.CacheIndex`).
+        """
+        assert output_path
+        self.output_path = output_path
+        self.settings = settings
+
+        self.cache = RedditWallpaperChooser.cache.CacheIndex(output_path, self.private_filename(
+            constants.CACHE_INDEX_FILENAME
+        ), migrate=not read_only, preload=not read_only)
+        self.chooser = RedditWallpaperChooser.sampling.Chooser(
+            self.cache, settings.choose_by, settings.ratio_tolerance
+        )
+        self.variants_path = os.path.join(output_path, constants.VARIANTS_FOLDER)
+
+    def private_filename(self, filename):
+        """
+        :param filename: The name of a file private to this process, e.g. the cache index.
+        :return: The name to be used, in case the output folder is shared by a cluster.
+        """
+        if self.settings.cluster_nodes:
+            return RedditWallpaperChooser.cluster.node_filename(filename, self.settings.cluster_node)
+        return filename
+
+    def choose(self, size=None):
+        """
+        Choose one of the stored wallpapers fitting the configured subreddits, size and ratio,
+        and return its absolute path.
+        No network access is required: wallpapers stored by previous runs are candidates as well.
+
+        :param size: If set, return the best pre-rendered variant for this size, if any.
+        :return: The absolute path of the chosen wallpaper, or None if no stored wallpaper fits.
+        """
+        entry = self.chooser.choose(self.settings.subreddits, self.settings.size, self.settings.ratio)
+        if entry is None:
+            return None
+        self.cache.flush()
+        return self.image_path(entry, size)
+
+    def image_path(self, wallpaper, size=None):
+        """
+        :param wallpaper: A stored wallpaper (or its cache entry).
+        :param size: If set, return the best pre-rendered variant for this size, if any.
+        :return: The absolute path of the wallpaper image.
+        """
+        if size is not None:
+            variant = self.best_variant(wallpaper, size)
+            if variant is not None:
+                return os.path.abspath(os.path.join(
+                    self.variants_path, RedditWallpaperChooser.variants.variant_name(wallpaper.id, variant)
+                ))
+
+        return os.path.abspath(os.path.join(
+            self.output_path, "{}.{}".format(wallpaper.id, wallpaper.image_type)
+        ))
+
+    def best_variant(self, wallpaper, size):
+        """
+        :param wallpaper: A stored wallpaper.
+        :param size: The requested size.
+        :return: The size of the smallest variant covering `size`, preferring its aspect ratio, or None.
+        """
+        target_ratio = RedditWallpaperChooser.wallpaper.ratio(*size)
+        candidates = [
+            variant for variant in self.cache.variants.get(wallpaper.id, ())
+            if variant.width >= size.width and variant.height >= size.height
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda v: (
+            RedditWallpaperChooser.wallpaper.ratio(*v) != target_ratio, v.width * v.height
+        ))
@@ -6,19 +6,21 @@ RedditWallpaperChooser main file.
 """
 
 import argparse
-import json
 import logging
 import os
 import sys
 
 import RedditWallpaperChooser.config
-import RedditWallpaperChooser.manager
 
 __author__ = 'aldur'
 
 _config_file_path = "config"
 _default_config_file_path = "default_config"
 _log_level = "log_level"
+_requested_size = "size"
+_daemon = "daemon"
+_serve = "serve"
+_choose_only = "choose_only"
 
 logger = logging.getLogger(__name__)
 
@@ -39,6 +41,8 @@ def _setup_logging(log_level):
 
     formatter = None
     try:
+        if not console_handler.stream.isatty():
+            raise ImportError("Colors are only useful on a terminal.")
         # noinspection PyUnresolvedReferences, PyPackageRequirements
         import colorlog
         formatter = colorlog.ColoredFormatter(
@@ -106,6 +110,33 @@ def _cmd_line_parser():
         help="set logging level"
     )
 
+    parser.add_argument(
+        *_to_add_argument(_requested_size),
+        metavar="<width>x<height>",
+        type=str,
+        required=False,
+        help="print the best pre-rendered variant for this screen size"
+    )
+
+    parser.add_argument(
+        "--{}".format(_daemon),
+        action="store_true",
+        help="keep running, refreshing the subreddits and rotating the wallpaper periodically"
+    )
+
+    parser.add_argument(
+        "--{}".format(_serve),
+        action="store_true",
+        help="serve the stored wallpapers over HTTP (along with the daemon, if requested)"
+    )
+
+    parser.add_argument(
+        "--choose-only",
+        dest=_choose_only,
+        action="store_true",
+        help="skip the network and choose among the wallpapers already stored"
+    )
+
     return parser
 
 
@@ -113,10 +144,7 @@ def _create_output_directory():
     """
     Create the output directory, if needed.
     """
-    output_path = RedditWallpaperChooser.config.parser.get(
-        RedditWallpaperChooser.config.SECTION_WALLPAPER,
-        RedditWallpaperChooser.config.WALLPAPER_FOLDER
-    )
+    output_path = RedditWallpaperChooser.config.settings.output_folder
 
     exists = os.path.exists(output_path)
     is_dir = os.path.isdir(output_path)
@@ -166,15 +194,88 @@ def main():
     RedditWallpaperChooser.config.parse_config(config_path)
     output_path = _create_output_directory()
 
-    logger.debug(
-        "Dumping loaded configuration:\n%s",
-        json.dumps(
-            RedditWallpaperChooser.config.as_dictionary(),
-            indent=2,
+    if logger.isEnabledFor(logging.DEBUG):
+        import json
+        logger.debug(
+            "Dumping loaded configuration:\n%s",
+            json.dumps(
+                RedditWallpaperChooser.config.as_dictionary(),
+                indent=2,
+            )
         )
-    )
 
-    manager = RedditWallpaperChooser.manager.Manager(output_path)
-    manager.fetch()
-    manager.store()
-    print(manager.choose())
+    size = RedditWallpaperChooser.config.parse_size(cli_args.get(_requested_size))
+    settings = RedditWallpaperChooser.config.settings
+
+    # The network stack is slow to import: only import it on the code paths needing it.
+    if cli_args.get(_choose_only):
+        return _choose(output_path, settings, size)
+    return _run(cli_args, output_path, settings, size)
+
+
+def _choose(output_path, settings, size):
+    """
+    Choose among the stored wallpapers, without any network access.
+
+    :param output_path: The output folder.
+    :param settings: The configuration settings.
+    :param size: If set, choose the best pre-rendered variant for this size, if any.
+    :return: The exit status.
+    """
+    import RedditWallpaperChooser.library
+    # Folders of previous versions are migrated by the first networked run.
+    return _print_choice(RedditWallpaperChooser.library.Library(output_path, settings, read_only=True), size)
+
+
+def _run(cli_args, output_path, settings, size):
+    """
+    Fetch and store the wallpapers, then choose one of them;
+    or keep running, as a daemon and/or as a server.
+
+    :param cli_args: The command line arguments.
+    :param output_path: The output folder.
+    :param settings: The configuration settings.
+    :param size: If set, choose the best pre-rendered variant for this size, if any.
+    :return: The exit status.
+    """
+    import asyncio
+    import RedditWallpaperChooser.daemon
+    import RedditWallpaperChooser.manager
+    import RedditWallpaperChooser.server
+
+    manager = RedditWallpaperChooser.manager.Manager(output_path, settings)
+
+    daemon = RedditWallpaperChooser.daemon.Daemon(manager, size) if cli_args.get(_daemon) else None
+    if cli_args.get(_serve):
+        try:
+            asyncio.run(RedditWallpaperChooser.server.Server(manager).run(daemon))
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    if daemon is not None:
+        try:
+            asyncio.run(daemon.run())
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    asyncio.run(manager.run())
+    manager.write_metrics()
+    return _print_choice(manager, size)
+
+
+def _print_choice(library, size):
+    """
+    Choose a stored wallpaper and print its path.
+
+    :param library: The stored wallpapers (see `library.Library`).
+    :param size: If set, print the best pre-rendered variant for this size, if any.
+    :return: The exit status.
+    """
+    path = library.choose(size)
+    if path is None:
+        logger.error("No stored wallpaper fits the configuration.")
+        return 1
+    print(path)
+    return 0
@@ -6,15 +6,28 @@ Parse subreddits searching for wallpapers.
 """
 
 import asyncio
+import concurrent.futures
+import contextlib
+import hashlib
 import http
-import json
 import logging
+import os
 import os.path
-import random
-
+import time
+
+import RedditWallpaperChooser.budget
+import RedditWallpaperChooser.cache
+import RedditWallpaperChooser.cluster
+import RedditWallpaperChooser.concurrency
+import RedditWallpaperChooser.eviction
+import RedditWallpaperChooser.fileio
+import RedditWallpaperChooser.library
+import RedditWallpaperChooser.metrics
+import RedditWallpaperChooser.ratelimit
 import RedditWallpaperChooser.reddit
-import RedditWallpaperChooser.wallpaper
-from RedditWallpaperChooser import config, constants
+import RedditWallpaperChooser.variants
+import RedditWallpaperChooser.verify
+from RedditWallpaperChooser import constants, utils
 import aiohttp
 
 __author__ = 'aldur'
@@ -22,81 +35,323 @@ __author__ = 'aldur'
 logger = logging.getLogger(__name__)
 
 
-class Manager(object):
+class Manager(RedditWallpaperChooser.library.Library):
 
     """Parse each subreddit and store the wallpapers they link to."""
 
-    def __init__(self, output_path):
-        assert output_path
-        self.output_path = output_path
-
-        self.subreddits = [subreddit.strip() for subreddit in config.parser.get(
-            config.SECTION_REDDIT, config.REDDIT_SUBREDDITS
-        ).split(",")]
-        assert self.subreddits
-
+    def __init__(self, output_path, settings):
+        """
+        :param output_path: The folder storing the wallpapers.
+        :param settings: The configuration settings, see `config.Settings`.
+        """
+        super().__init__(output_path, settings)
+
+        self.listings = RedditWallpaperChooser.cache.ListingCache(
+            output_path,
+            self.private_filename(constants.LISTING_CACHE_FILENAME),
+            max_age=constants.LISTING_CACHE_RETENTION * max(settings.listing_ttl, 60),
+        )
+        self.cluster = None
+        if settings.cluster_nodes:
+            self.cluster = RedditWallpaperChooser.cluster.Cluster(
+                output_path, settings.cluster_node, settings.cluster_nodes
+            )
+        self._sync_lock = None
+        self.rate_limiter = RedditWallpaperChooser.ratelimit.RateLimiter(
+            settings.requests_per_minute, settings.burst, settings.max_retries,
+        )
+
+        self.variant_sizes = settings.variants
+        if self.variant_sizes and not RedditWallpaperChooser.variants.available():
+            logger.warning("Pillow is not installed, resized variants will not be rendered.")
+            self.variant_sizes = ()
+        if self.variant_sizes:
+            os.makedirs(self.variants_path, exist_ok=True)
+
+        self.metrics = RedditWallpaperChooser.metrics.Metrics()
+
+        # Concurrent downloads allowed by each image host.
+        self.download_limits = RedditWallpaperChooser.concurrency.HostLimits(
+            settings.min_per_host, settings.limit_per_host, settings.adaptive_concurrency
+        )
+
+        # Filesystem calls of the store path, run off the event loop (the thread pool is alive during `run`).
+        self.files = RedditWallpaperChooser.fileio.FileIO(
+            settings.write_workers, settings.fsync, settings.fsync_batch
+        )
+        # Process pool verifying the downloads and rendering the variants, alive during `run`.
+        self.process_pool = None
+
+        # Fullname of the first post of the last fetch, by subreddit.
+        self.newest = {}
+
+        # The URLs waiting in the download queue, or being downloaded,
+        # and the futures resolved once they are done with.
+        self.queued = {}
+        # Wallpapers available on disk.
         self.walls = set()
+        self.connections_created = 0
 
-    async def fetch_from_subreddit(self, session, subreddit):
+    def create_budget(self, subreddits):
+        """
+        :param subreddits: The subreddits to be fetched.
+        :return: A budget of accepted wallpapers for those subreddits, i.e. their share of `total_results`.
         """
-        Fetch trending walls from selected subreddit.
+        weights = dict(self.settings.subreddit_weights)
+        shares = RedditWallpaperChooser.budget.apportion(self.settings.total_results, weights)
+        return RedditWallpaperChooser.budget.Budget(
+            sum(shares[s] for s in subreddits), {s: weights[s] for s in subreddits}
+        )
+
+    async def fetch_from_subreddit(self, session, subreddit, queue, incremental=False, budget=None):
+        """
+        Fetch trending walls from selected subreddit and schedule them for download,
+        until its quota of accepted wallpapers is met.
 
         :param session: An aiohttp session.
         :param subreddit: Subreddit to be parsed.
+        :param queue: The download queue.
+        :param incremental: If True, stop paging once the first post of the previous fetch is reached.
+        :param budget: The budget shared with the other subreddits (defaults to the share of this subreddit).
+        :return: A future for each wallpaper scheduled for download, resolved once it is stored (or discarded).
         """
-        sorting = config.parser.get(config.SECTION_REDDIT, config.REDDIT_SORTING)
-        assert sorting in constants.REDDIT_ALLOWED_SORTING
-        subreddit_limit = config.parser.getint(config.SECTION_REDDIT, config.REDDIT_RESULT_LIMIT)
+        settings = self.settings
+        sorting = settings.sorting
+        if budget is None:
+            budget = self.create_budget([subreddit])
 
-        url = constants.REDDIT_API_FORMAT_URL.format(subreddit, sorting)
-        params = {'limit': 100}
+        url = settings.api_url.format(subreddit, sorting)
+        base_params = {}
 
         if sorting in constants.REDDIT_NEED_TIME:
-            t = config.parser.get(config.SECTION_REDDIT, config.REDDIT_TIME)
-            assert t in constants.REDDIT_ALLOWED_TIME
-            params.update({'t': t})
+            t = settings.time
+            base_params.update({'t': t})
             logger.info("Fetching %s/%s wallpapers from 'r/%s'.", sorting, t, subreddit)
         else:
             logger.info("Fetching %s wallpapers from 'r/%s'.", sorting, subreddit)
 
-        count = 0
-        while count < subreddit_limit:
-            async with session.get(url, params=params) as response:
-                if response.status != http.HTTPStatus.OK:
-                    logger.warning("Can't contact 'r/%s (status: %s).", subreddit, response.status)
-                    return
-                data = await response.json()
-
-            walls, after = RedditWallpaperChooser.reddit.parse_listing(data)
-            count += len(walls)
+        previous_newest = self.newest.get(subreddit) if incremental else None
+        loop = asyncio.get_running_loop()
+        scheduled = []
+
+        while budget.remaining(subreddit) and subreddit not in budget.exhausted:
+            after = budget.after.get(subreddit)
+            params = dict(base_params, limit=budget.page_limit(subreddit))
+            if after is not None:
+                params.update({'after': after})
+
+            page = await self.fetch_listing_page(session, url, params, subreddit)
+            if page is None:
+                logger.warning("Can't contact 'r/%s'.", subreddit)
+                budget.finish(subreddit)
+                return scheduled
+
+            self.metrics.count("posts", len(page.names), subreddit=subreddit)
+            self.metrics.count("posts_rejected", len(page.names) - len(page.walls), subreddit=subreddit)
+
+            if after is None and page.names:
+                self.newest[subreddit] = page.names[0]
+
+            # Wallpapers are ranked best first: keep the ones fitting the quota.
+            accepted = [
+                w for w in page.walls if w.url not in self.queued and w.url not in self.cache.rejected
+            ][:budget.remaining(subreddit)]
+            for w in accepted:
+                self.queued[w.url] = loop.create_future()
+            enqueued = 0
+            try:
+                for w in accepted:
+                    done = self.queued[w.url]
+                    await queue.put(w)
+                    scheduled.append(done)
+                    enqueued += 1
+            finally:
+                # E.g. cancelled while waiting for the queue: the others are not scheduled anymore.
+                for w in accepted[enqueued:]:
+                    self.queued.pop(w.url, None)
+            # Recorded once enqueued: the budget is never met while wallpapers are still to be enqueued.
+            budget.record(subreddit, len(page.names), len(accepted))
+
+            if page.after is None:
+                budget.finish(subreddit)
+            elif previous_newest is not None and previous_newest in page.names:
+                logger.debug("Reached already seen posts of 'r/%s'.", subreddit)
+                budget.finish(subreddit)
+            else:
+                budget.after[subreddit] = page.after
 
-            self.walls |= {
-                w for w in walls
-                if w.fits(config.get_size(), config.get_ratio())
-            }
+        logger.debug("Fetching from 'r/%s' completed.", subreddit)
+        return scheduled
 
-            if after is None:
-                break
-            params.update({'after': after})
+    async def fetch_listing_page(self, session, url, params, subreddit=None):
+        """
+        Fetch and parse a listing page, going through the listing cache.
+        Fresh cached pages are reused as they are, stale ones are revalidated with a conditional request.
 
-        logger.debug("Fetching from 'r/%s' completed.", subreddit)
+        :param session: An aiohttp session.
+        :param url: The listing URL.
+        :param params: The query parameters.
+        :param subreddit: The subreddit, labelling the metrics.
+        :return: The parsed page (see `reddit.parse_listing`), or None on failure.
+        """
+        filters = {
+            "target_size": self.settings.size,
+            "target_ratio": self.settings.ratio,
+            "ratio_tolerance": self.settings.ratio_tolerance,
+            "min_score": self.settings.min_score,
+        }
+        key = self.listings.key(url, params, filters)
+        cached = await self.files.query(self.listings.get, key)
+        metrics = self.metrics
+        if cached is not None and time.time() - cached.fetched_at < self.settings.listing_ttl:
+            logger.debug("Listing cache hit for '%s'.", key)
+            metrics.count("listing_cache", result="hit", subreddit=subreddit)
+            return cached.page
+
+        headers = {}
+        if cached is not None:
+            if cached.etag:
+                headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
+
+        start = time.perf_counter()
+        try:
+            response = await self.rate_limiter.get(session, url, params=params, headers=headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.debug("Can't fetch '%s': %s.", key, e)
+            metrics.count("listing_errors", subreddit=subreddit)
+            return None
+
+        async with response:
+            metrics.count("listing_requests", subreddit=subreddit, status=response.status)
+            if response.status == http.HTTPStatus.NOT_MODIFIED and cached is not None:
+                logger.debug("Listing '%s' not modified.", key)
+                metrics.observe("listing_request_seconds", time.perf_counter() - start, subreddit=subreddit)
+                metrics.count("listing_cache", result="revalidated", subreddit=subreddit)
+                await self.files.query(self.listings.touch, key)
+                return cached.page
 
-    def fetch(self):
+            if response.status != http.HTTPStatus.OK:
+                logger.debug("Bad status code from '%s' (%d).", key, response.status)
+                return None
+            data = await response.read()
+            metrics.observe("listing_request_seconds", time.perf_counter() - start, subreddit=subreddit)
+            metrics.count("listing_cache", result="miss", subreddit=subreddit)
+            metrics.count("listing_bytes", len(data), subreddit=subreddit)
+
+            with metrics.timed("listing_parse_seconds", subreddit=subreddit):
+                page = RedditWallpaperChooser.reddit.parse_raw_listing(data, **filters)
+            await self.files.query(
+                self.listings.put, key, response.headers.get("ETag"), response.headers.get("Last-Modified"), page
+            )
+            return page
+
+    async def fetch(self, session, queue):
         """
         Globally fetch trending walls from each subreddit.
+        When done, signal the download workers that no more wallpapers will come.
+
+        :param session: An aiohttp session.
+        :param queue: The download queue.
         """
         logger.info("Fetching wallpapers list from subreddits...")
-        with aiohttp.ClientSession(
-            headers={"User-Agent": RedditWallpaperChooser.constants.REDDIT_USER_AGENT},
-            connector=aiohttp.TCPConnector(limit=5),
-        ) as session:
-            tasks = [
-                asyncio.ensure_future(self.fetch_from_subreddit(session, subreddit))
-                for subreddit in self.subreddits
-            ]
-            asyncio.get_event_loop().run_until_complete(asyncio.gather(*tasks))
-
-            return self.walls
+        budget = self.create_budget([s for s in self.settings.subreddits if self.fetches(s)])
+
+        tasks = {}
+        try:
+            while True:
+                # Resume the subreddits that received part of the quota of the exhausted ones.
+                running = set(tasks.values())
+                for subreddit in budget.resumable():
+                    if subreddit not in running:
+                        task = asyncio.ensure_future(
+                            self.fetch_from_subreddit(session, subreddit, queue, budget=budget)
+                        )
+                        tasks[task] = subreddit
+                if not tasks:
+                    break
+
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    del tasks[task]
+                    task.result()
+                if budget.met:
+                    break
+        finally:
+            # Once the quota is met, the outstanding page fetches are not needed anymore.
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                self.metrics.count("listing_fetches_cancelled", len(tasks))
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+            for _ in range(self.settings.download_workers):
+                await queue.put(None)
+
+    def fetches(self, subreddit):
+        """
+        :param subreddit: A subreddit.
+        :return: True if this node is responsible for fetching the subreddit (always, outside of a cluster).
+        """
+        return self.cluster is None or self.cluster.owns(subreddit)
+
+    async def sync(self):
+        """
+        Import the wallpapers stored by the other nodes of the cluster, if any.
+        Journals are read in the I/O thread pool, and imported in the cache index on the event loop.
+        """
+        if self.cluster is None:
+            return
+        if self._sync_lock is None:  # Created in the running loop, as in `ratelimit.RateLimiter`.
+            self._sync_lock = asyncio.Lock()
+        # E.g. each download waiting for a lock syncs: one at a time, each seeing what the previous imported.
+        async with self._sync_lock:
+            segments, records = await self.files.call(self.cluster.read, dict(self.cache.journal_offsets))
+            self.cluster.apply(self.cache, segments, records)
+            # The other nodes may delete what has been imported: persist it first.
+            await self.flush_index()
+            await self.files.call(self.cluster.acknowledge, dict(self.cache.journal_offsets), segments)
+
+    async def flush_index(self):
+        """
+        Persist the pending entries of the cache index, in its database thread.
+        """
+        future = self.cache.flush()
+        if future is not None:
+            await asyncio.wrap_future(future)
+
+    async def lock_download(self, wallpaper):
+        """
+        Take the cluster-wide lock on the download of a wallpaper, waiting for the other nodes to release it.
+
+        :param wallpaper: The wallpaper to be downloaded.
+        :return: The acquired lock, or None if another node stored the wallpaper meanwhile.
+        """
+        lock = self.cluster.lock(wallpaper.id)
+        while not await self.files.call(lock.acquire):
+            await asyncio.sleep(constants.CLUSTER_LOCK_POLL)
+            await self.sync()
+            if wallpaper.url in self.cache:
+                return None
+
+        # Another node could have stored it, and released the lock, before we got it.
+        await self.sync()
+        if wallpaper.url in self.cache:
+            await self.files.call(lock.release)
+            return None
+        return lock
+
+    async def heartbeat(self, lock):
+        """
+        Refresh a download lock until cancelled (or until it is lost), so that the other nodes never break it.
+
+        :param lock: The acquired lock.
+        """
+        while True:
+            await asyncio.sleep(constants.CLUSTER_LOCK_HEARTBEAT)
+            if not await self.files.call(lock.refresh):
+                return
 
     async def store_wallpaper(self, session, wallpaper):
         """
@@ -104,50 +359,594 @@ class Manager(object):
 
         :param session: An aiohttp session.
         :param wallpaper: The wallpaper to be stored.
+        :return: True if the wallpaper is available on disk.
         """
-        info_path = os.path.join(self.output_path, wallpaper.info_path)
-
-        if os.path.exists(info_path):
+        metrics = self.metrics
+        entry = self.cache.get(wallpaper.url)
+        lock = heartbeat = None
+        if entry is None and self.cluster is not None:
+            lock = await self.lock_download(wallpaper)
+            if lock is None:
+                entry = self.cache.get(wallpaper.url)
+            else:
+                heartbeat = asyncio.ensure_future(self.heartbeat(lock))
+
+        if entry is not None:
             logger.debug("Cache hit for wallpaper: '%s'.", wallpaper.url)
-            wallpaper.image_type = json.load(open(info_path, 'r'))['image_type']
-            return
+            metrics.count("wallpaper_cache", result="hit", subreddit=wallpaper.subreddit)
+            wallpaper.image_type = entry.image_type
+            self.cache.touch(wallpaper.url)
+            return True
+
+        metrics.count("wallpaper_cache", result="miss", subreddit=wallpaper.subreddit)
+        try:
+            with metrics.timed("download_seconds", subreddit=wallpaper.subreddit):
+                stored = await self.download(session, wallpaper)
+            if stored is None:
+                metrics.count("downloads_failed", subreddit=wallpaper.subreddit)
+                return False
+
+            wallpaper_path, byte_size, content_hash = stored
+            metrics.count("downloads", subreddit=wallpaper.subreddit)
+            metrics.count("download_bytes", byte_size, subreddit=wallpaper.subreddit)
+            linked_to = await self.deduplicate(wallpaper_path, content_hash)
+
+            # The index entry marks a cache hit: add it only once the image is in place.
+            now = time.time()
+            entry = RedditWallpaperChooser.cache.CacheEntry(
+                id=wallpaper.id,
+                byte_size=byte_size,
+                downloaded_at=now,
+                content_hash=content_hash,
+                last_used=now,
+                linked_to=linked_to,
+                **wallpaper.info
+            )
+            self.cache.add(entry)
+            if self.cluster is not None:
+                await self.files.call(self.cluster.publish, added=[entry])
+        finally:
+            # Released once published, so that the other nodes find the wallpaper as soon as they get the lock.
+            if lock is not None:
+                heartbeat.cancel()
+                await self.files.call(lock.release)
+
+        logger.debug("Wallpaper from '%s' successfully downloaded.", wallpaper.url)
+        return True
+
+    async def download(self, session, wallpaper):
+        """
+        Download a wallpaper through a `.part` file, that is atomically moved in place once complete.
+        Interrupted downloads are resumed with a Range request if the server supports it,
+        both within this run and across runs: the validator of the partial file (its ETag or Last-Modified date),
+        recorded in the cache index, is sent along as If-Range, so that a changed image is downloaded again in full.
 
-        async with session.get(wallpaper.url) as response:
-            if response.status != http.HTTPStatus.OK:
-                logger.warning("Bad status code from '%s' (%d).", wallpaper.url, response.status)
-                return
-            wallpaper.set_image_type(response.headers["content-type"])
+        :param session: An aiohttp session.
+        :param wallpaper: The wallpaper to be downloaded.
+        :return: The wallpaper path, its size in bytes and its SHA-256 digest, or None on failure.
+        """
+        part_path = os.path.join(self.output_path, ".{}.part".format(wallpaper.id))
+        partial = self.cache.partials.get(wallpaper.id)
+        validator = partial.validator if partial is not None else None
+        try:
+            for _ in range(constants.DOWNLOAD_ATTEMPTS):
+                offset = await self.files.call(RedditWallpaperChooser.fileio.size, part_path)
+                if offset and validator is None:
+                    # It could be part of another version of the image.
+                    logger.debug("Can't validate the partial download of '%s', restarting.", wallpaper.url)
+                    await self.files.call(os.unlink, part_path)
+                    offset = 0
+                headers = {"Range": "bytes={}-".format(offset), "If-Range": validator} if offset else {}
+
+                # Partial files are kept, unless the server can't resume them.
+                resumable = True
+                # Each attempt holds a slot of the image host, whose limit adapts to how the host copes.
+                async with self.download_limits.slot(wallpaper.url) as sample:
+                    try:
+                        async with session.get(wallpaper.url, headers=headers) as response:
+                            if response.status == http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE:
+                                logger.debug("Can't resume '%s', restarting.", wallpaper.url)
+                                await self.files.call(os.unlink, part_path)
+                                continue
+
+                            if response.status == http.HTTPStatus.PARTIAL_CONTENT:
+                                if not _content_range_starts_at(response, offset):
+                                    logger.debug("Inconsistent Content-Range from '%s', restarting.", wallpaper.url)
+                                    await self.files.call(os.unlink, part_path)
+                                    continue
+                                logger.debug("Resuming '%s' from byte %d.", wallpaper.url, offset)
+                            elif response.status == http.HTTPStatus.OK:
+                                offset = 0
+                                validator = _validator(response)
+                                resumable = validator is not None and \
+                                    response.headers.get("Accept-Ranges", "").lower() == "bytes"
+                            else:
+                                logger.warning("Bad status code from '%s' (%d).", wallpaper.url, response.status)
+                                sample.failed = response.status in constants.REDDIT_RETRY_STATUSES
+                                return None
+
+                            max_bytes = self.settings.max_bytes
+                            if max_bytes and offset + (response.content_length or 0) > max_bytes:
+                                logger.warning(
+                                    "'%s' exceeds the maximum size of %d bytes.", wallpaper.url, max_bytes
+                                )
+                                self.cache.reject(wallpaper.url, "larger than {} bytes".format(max_bytes))
+                                await self.files.call(RedditWallpaperChooser.fileio.remove, part_path)
+                                return None
+
+                            wallpaper.set_image_type(response.headers["content-type"])
+                            stored = await self.stream_to_file(response, part_path, offset, sample)
+                            if stored is not None:
+                                sample.byte_size = stored[0] - offset
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        logger.warning("Download of '%s' interrupted: %s.", wallpaper.url, e)
+                        sample.failed = True
+                        if not resumable:
+                            await self.files.call(RedditWallpaperChooser.fileio.remove, part_path)
+                        continue
+
+                if stored is None:  # Too big, but not announced as such.
+                    logger.warning("Discarding wallpaper from '%s'.", wallpaper.url)
+                    self.cache.reject(wallpaper.url, "larger than {} bytes".format(self.settings.max_bytes))
+                    return None
+
+                reason = await self.verify(wallpaper, part_path)
+                if reason is not None:
+                    await self.quarantine(wallpaper, part_path, reason, stored[0])
+                    return None
+
+                wallpaper_path = os.path.join(self.output_path, wallpaper.output_path)
+                await self.files.commit(part_path, wallpaper_path)
+                return (wallpaper_path,) + stored
+
+            logger.warning("Giving up on '%s'.", wallpaper.url)
+            return None
+        finally:
+            # Whatever is left on disk can be resumed by the next runs (and counts towards the disk quota).
+            part_size = await self.files.call(RedditWallpaperChooser.fileio.size, part_path)
+            self.cache.set_partial(wallpaper.id, RedditWallpaperChooser.cache.PartialEntry(
+                wallpaper.url, validator, part_size, time.time()
+            ) if part_size else None)
+
+    async def verify(self, wallpaper, path):
+        """
+        Check, in the verification process pool, that a download is a complete image
+        whose true dimensions fit the requirements.
+        The wallpaper type and size are updated according to the image header.
 
-            with open(info_path, "w") as info_file:
-                json.dump(wallpaper.info, info_file, indent=2)
+        :param wallpaper: The downloaded wallpaper.
+        :param path: The path of the download.
+        :return: None if the download is valid (or verification is disabled), otherwise why it is not.
+        """
+        if not self.settings.verify:
+            return None
+
+        info = await asyncio.get_running_loop().run_in_executor(
+            self.process_pool, RedditWallpaperChooser.verify.inspect_image, path
+        )
+        if info is None:
+            logger.warning("'%s' is not a complete JPEG/PNG image.", wallpaper.url)
+            return "not a complete JPEG/PNG image"
+
+        wallpaper.image_type = info.image_type
+        wallpaper.size = utils.Size(info.width, info.height)
+        if not wallpaper.fits(self.settings.size, self.settings.ratio, self.settings.ratio_tolerance):
+            logger.warning("'%s' is actually %dx%d and does not fit.", wallpaper.url, info.width, info.height)
+            return "actually {}x{}".format(info.width, info.height)
+        return None
+
+    async def quarantine(self, wallpaper, path, reason, byte_size):
+        """
+        Move a download failing verification to the quarantine folder,
+        and record its URL in the cache index so that it is not downloaded again.
 
-            data = await response.read()
+        :param wallpaper: The downloaded wallpaper.
+        :param path: The path of the download.
+        :param reason: Why the download failed verification.
+        :param byte_size: The size of the download, counting towards the disk quota.
+        """
+        self.cache.reject(wallpaper.url, reason, byte_size)
+        quarantine_path = os.path.join(self.output_path, constants.QUARANTINE_FOLDER)
+        await self.files.call(os.makedirs, quarantine_path, exist_ok=True)
+        await self.files.call(os.replace, path, os.path.join(quarantine_path, wallpaper.id))
 
-            wallpaper_path = os.path.join(self.output_path, wallpaper.output_path)
-            with open(wallpaper_path, 'wb') as f:
-                f.write(data)
+    async def stream_to_file(self, response, path, offset=0, sample=None):
+        """
+        Stream the response body to `path`, after its first `offset` bytes.
+        Chunks are written, and hashed, in the I/O thread pool, in blocks of about `WRITE_BUFFER_SIZE` bytes.
+
+        :param response: An aiohttp response.
+        :param path: The destination path.
+        :param offset: The number of bytes already stored in `path`.
+        :param sample: If set, the `concurrency.Sample` of the download, accounting for the time spent on the disk.
+        :return: The total number of bytes and their SHA-256 digest, or None if the file is too big.
+        :raise aiohttp.ClientPayloadError: If the body is shorter than announced.
+        """
+        async def _call(function, *args):
+            # The disk time is not the host's: it is left out of the download latency.
+            start = time.perf_counter()
+            try:
+                return await self.files.call(function, *args)
+            finally:
+                if sample is not None:
+                    sample.io_seconds += time.perf_counter() - start
+
+        digest = hashlib.sha256()
+        f = await _call(open, path, 'r+b' if offset else 'wb')
+        try:
+            if offset:
+                await _call(_hash_prefix, f, digest, offset, self.settings.chunk_size)
+
+            written = offset
+            buffer = []
+            buffered = 0
+            async for chunk in response.content.iter_chunked(self.settings.chunk_size):
+                written += len(chunk)
+                if self.settings.max_bytes and written > self.settings.max_bytes:
+                    logger.warning(
+                        "'%s' exceeds the maximum size of %d bytes.", response.url, self.settings.max_bytes
+                    )
+                    break
+                buffer.append(chunk)
+                buffered += len(chunk)
+                if buffered >= constants.WRITE_BUFFER_SIZE:
+                    await _call(_write, f, digest, b"".join(buffer))
+                    buffer, buffered = [], 0
+            else:
+                if buffer:
+                    await _call(_write, f, digest, b"".join(buffer))
+                if response.content_length is not None and written != offset + response.content_length:
+                    raise aiohttp.ClientPayloadError(
+                        "Expected {} bytes, got {}.".format(offset + response.content_length, written)
+                    )
+                return written, digest.hexdigest()
+        finally:
+            await _call(f.close)
+
+        await _call(os.unlink, path)
+        return None
+
+    async def deduplicate(self, path, content_hash):
+        """
+        Replace the file at `path` with a hard link to an already stored, byte-identical wallpaper.
+        If hard links are not supported, the copy is kept.
 
-            logger.debug("Wallpaper from '%s' successfully downloaded.", wallpaper.url)
+        :param path: The path of a freshly downloaded wallpaper.
+        :param content_hash: The digest of its content.
+        :return: The identifier of the wallpaper whose file is now shared (see `eviction.select`), or None.
+        """
+        duplicate = self.cache.find_by_hash(content_hash)
+        if duplicate is None:
+            return None
+
+        duplicate_path = os.path.join(
+            self.output_path, "{}.{}".format(duplicate.id, duplicate.image_type)
+        )
+        if os.path.abspath(duplicate_path) == os.path.abspath(path):
+            return None
+
+        try:
+            await self.files.call(_link, duplicate_path, path)
+        except OSError as e:
+            logger.debug("Can't link '%s' to '%s': %s.", path, duplicate_path, e)
+            return None
+        logger.debug("'%s' is a duplicate of '%s'.", path, duplicate_path)
+        return duplicate.linked_to or duplicate.id
+
+    async def download_worker(self, session, queue, derivatives=None):
+        """
+        Store the wallpapers from the download queue, until a `None` is received.
 
-    def store(self):
+        :param session: An aiohttp session.
+        :param queue: The download queue.
+        :param derivatives: If set, the queue of wallpapers whose variants have to be rendered.
         """
-        Store the previously fetched wallpapers.
+        while True:
+            wallpaper = await queue.get()
+            try:
+                if wallpaper is None:
+                    return
+                try:
+                    stored = await self.store_wallpaper(session, wallpaper)
+                finally:
+                    # Whatever the outcome, the URL can be scheduled again (e.g. retried, once evicted).
+                    done = self.queued.pop(wallpaper.url, None)
+                    if done is not None and not done.done():
+                        done.set_result(None)
+                if stored:
+                    self.walls.add(wallpaper)
+                    if derivatives is not None:
+                        await derivatives.put(wallpaper)
+            finally:
+                queue.task_done()
+
+    async def store(self, session, queue, derivatives=None):
+        """
+        Store the wallpapers scheduled by `fetch` as soon as they are queued.
+        When done, signal the derivative workers that no more wallpapers will come.
+
+        :param session: An aiohttp session.
+        :param queue: The download queue.
+        :param derivatives: If set, the queue of wallpapers whose variants have to be rendered.
         """
         logger.info("Storing wallpapers...")
-        with aiohttp.ClientSession(
-            connector=aiohttp.TCPConnector(limit=5),
-        ) as session:
-            tasks = [
-                asyncio.ensure_future(self.store_wallpaper(session, wallpaper))
-                for wallpaper in self.walls
-            ]
-            asyncio.get_event_loop().run_until_complete(asyncio.gather(*tasks))
+        try:
+            await asyncio.gather(*(
+                self.download_worker(session, queue, derivatives)
+                for _ in range(self.settings.download_workers)
+            ))
+        finally:
+            if derivatives is not None:
+                for _ in range(self._derivative_workers):
+                    await derivatives.put(None)
         logger.info("All done!")
 
-    def choose(self):
+    @property
+    def _derivative_workers(self):
+        return self.settings.process_workers or os.cpu_count() or 1
+
+    async def derive(self, derivatives):
+        """
+        Render the variants of the stored wallpapers, as soon as they are queued.
+
+        :param derivatives: The queue of wallpapers whose variants have to be rendered.
         """
-        Choose one of the stored wallpapers and return its absolute path.
+        await asyncio.gather(*(
+            self.derivative_worker(derivatives)
+            for _ in range(self._derivative_workers)
+        ))
+
+    async def derivative_worker(self, derivatives):
         """
-        assert self.walls
-        return os.path.abspath(
-            os.path.join(self.output_path, random.choice(tuple(self.walls)).output_path))
+        Render the variants of the wallpapers from the derivatives queue, until a `None` is received.
+
+        :param derivatives: The queue of wallpapers whose variants have to be rendered.
+        """
+        while True:
+            wallpaper = await derivatives.get()
+            try:
+                if wallpaper is None:
+                    return
+                await self.render_variants(wallpaper)
+            finally:
+                derivatives.task_done()
+
+    async def render_variants(self, wallpaper):
+        """
+        Render, in the process pool, the variants of a wallpaper not yet in the cache index.
+        Sizes bigger than the wallpaper are never rendered, so they are not submitted at all.
+
+        :param wallpaper: A stored wallpaper.
+        """
+        missing = [
+            size for size in self.variant_sizes
+            if size not in self.cache.variants.get(wallpaper.id, ())
+            and (not wallpaper.size or (size.width <= wallpaper.size.width and size.height <= wallpaper.size.height))
+        ]
+        if not missing:
+            return
+
+        try:
+            rendered = await asyncio.get_running_loop().run_in_executor(
+                self.process_pool,
+                RedditWallpaperChooser.variants.render,
+                os.path.join(self.output_path, wallpaper.output_path),
+                self.variants_path,
+                wallpaper.id,
+                missing,
+            )
+        except (OSError, ValueError) as e:
+            logger.warning("Can't render the variants of '%s': %s.", wallpaper.url, e)
+            return
+        self.cache.add_variants(wallpaper.id, rendered)
+
+    def create_session(self):
+        """
+        Build the pooled aiohttp session shared by every phase of a run.
+
+        :return: A new aiohttp session.
+        """
+        connector = aiohttp.TCPConnector(
+            limit=self.settings.limit,
+            limit_per_host=self.settings.limit_per_host,
+            keepalive_timeout=self.settings.keepalive_timeout,
+            ttl_dns_cache=self.settings.dns_cache_ttl,
+        )
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self._on_connection_created)
+
+        return aiohttp.ClientSession(
+            headers={"User-Agent": constants.REDDIT_USER_AGENT},
+            connector=connector,
+            trace_configs=[trace_config],
+        )
+
+    async def _on_connection_created(self, session, context, params):
+        self.connections_created += 1
+
+    @contextlib.asynccontextmanager
+    async def io_scope(self):
+        """
+        Run the I/O thread pools; meanwhile, the cache index is written in the database thread.
+        On exit, stop them and flush the cache index.
+        Nested scopes share the pools of the outermost one.
+        """
+        if self.files.database is not None:
+            yield
+            return
+
+        self.files.start()
+        self.cache.executor = self.files.database
+        try:
+            yield
+        finally:
+            # Waits for the batches still being written.
+            self.files.shutdown()
+            self.cache.executor = None
+            self.cache.flush()
+
+    @contextlib.asynccontextmanager
+    async def session_scope(self):
+        """
+        Set up the resources shared by the phases of a run: the session, the I/O thread pools (see `io_scope`)
+        and the verification pool.
+        On exit, release them.
+
+        :return: The shared aiohttp session.
+        """
+        if self.settings.verify or self.variant_sizes:
+            self.process_pool = concurrent.futures.ProcessPoolExecutor(self.settings.process_workers)
+        try:
+            async with self.io_scope(), self.create_session() as session:
+                yield session
+        finally:
+            if self.process_pool is not None:
+                self.process_pool.shutdown()
+                self.process_pool = None
+
+    async def run(self):
+        """
+        Fetch and store the wallpapers, sharing a single session between the two phases.
+        Downloads start as soon as the first listing page arrives; the bounded queue
+        applies backpressure on the listing fetches.
+        Once done, evict the wallpapers exceeding the disk quota.
+        """
+        self.connections_created = 0
+        async with self.session_scope() as session:
+            await self.sync()
+            queue = asyncio.Queue(maxsize=self.settings.queue_size)
+            phases = [self.timed_phase("fetch", self.fetch(session, queue))]
+            if self.variant_sizes:
+                derivatives = asyncio.Queue(maxsize=self.settings.queue_size)
+                phases += [
+                    self.timed_phase("store", self.store(session, queue, derivatives)),
+                    self.timed_phase("derive", self.derive(derivatives)),
+                ]
+            else:
+                phases.append(self.timed_phase("store", self.store(session, queue)))
+            await asyncio.gather(*phases)
+            await self.sync()
+            for host, limit in self.download_limits.limits.items():
+                logger.debug("Concurrent downloads from '%s' limited to %d.", host, limit.capacity)
+            # Still within the scope: eviction runs on the I/O thread pool.
+            with self.metrics.timed("phase_seconds", phase="evict"):
+                await self.evict()
+        self.metrics.count("connections", self.connections_created)
+        logger.debug("Opened %d connections during this run.", self.connections_created)
+
+    async def timed_phase(self, phase, coroutine):
+        """
+        Await a phase of a run, recording its duration.
+
+        :param phase: The phase name.
+        :param coroutine: The phase coroutine.
+        """
+        with self.metrics.timed("phase_seconds", phase=phase):
+            return await coroutine
+
+    def write_metrics(self):
+        """
+        Write the metrics to the configured file, if any.
+        """
+        if self.settings.metrics_output:
+            self.metrics.write(self.settings.metrics_output, self.settings.metrics_format)
+
+    async def save_metrics(self):
+        """
+        Like `write_metrics`, but the file is written in the I/O thread pool.
+        """
+        if self.settings.metrics_output:
+            # Exported here, as the metrics change on the event loop.
+            await self.files.call(
+                RedditWallpaperChooser.metrics.write_file,
+                self.settings.metrics_output, self.metrics.export(self.settings.metrics_format)
+            )
+
+    async def evict(self, protected=None):
+        """
+        Evict the least recently used wallpapers exceeding the disk quota.
+
+        :param protected: URLs that must not be evicted (defaults to the wallpapers of this run).
+        """
+        if protected is None:
+            protected = {w.url for w in self.walls}
+        if self.cluster is not None:
+            # Each node only evicts the wallpapers it is responsible for.
+            protected = protected | {
+                entry.url for entry in self.cache.entries.values() if not self.cluster.owns(entry.id)
+            }
+
+        evicted = await RedditWallpaperChooser.eviction.evict(
+            self.cache,
+            self.files,
+            self.output_path,
+            self.variants_path,
+            max_total_bytes=self.settings.max_total_bytes,
+            max_files=self.settings.max_files,
+            max_age=self.settings.max_age,
+            protected=protected,
+        )
+        if evicted:
+            self.walls = {w for w in self.walls if w.url not in evicted}
+            if self.cluster is not None:
+                await self.files.call(self.cluster.publish, removed=evicted)
+
+
+def _hash_prefix(f, digest, offset, chunk_size):
+    """
+    Hash the first `offset` bytes of a partial download, and drop what follows them.
+    """
+    for chunk in iter(lambda: f.read(min(chunk_size, offset - f.tell())), b""):
+        digest.update(chunk)
+    f.seek(offset)
+    f.truncate()
+
+
+def _write(f, digest, data):
+    digest.update(data)
+    f.write(data)
+
+
+def _link(source, path):
+    """
+    Atomically replace `path` with a hard link to `source`.
+    """
+    tmp_path = "{}.link".format(path)
+    try:
+        os.link(source, tmp_path)
+        os.replace(tmp_path, path)
+    except OSError:
+        RedditWallpaperChooser.fileio.remove(tmp_path)
+        raise
+
+
+def _validator(response):
+    """
+    :param response: A '200 OK' response.
+    :return: The validator to resume the response body with, in an If-Range header:
+        its ETag, unless weak, or its Last-Modified date (None if neither is available).
+    """
+    etag = response.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response.headers.get("Last-Modified")
+
+
+def _content_range_starts_at(response, offset):
+    """
+    :param response: A '206 Partial Content' response.
+    :param offset: The requested first byte.
+    :return: True if the Content-Range header matches the requested range and the Content-Length.
+    """
+    content_range = response.headers.get("Content-Range", "")
+    try:
+        unit, byte_range = content_range.split(" ", 1)
+        first, last = byte_range.split("/", 1)[0].split("-")
+        first, last = int(first), int(last)
+    except ValueError:
+        return False
+
+    if unit != "bytes" or first != offset:
+        return False
+    return response.content_length is None or response.content_length == last - first + 1
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Counters and timings of a run, exported as JSON or in the Prometheus text format.
+"""
+
+import collections
+import contextlib
+import json
+import logging
+import os
+import time
+
+__author__ = 'aldur'
+
+logger = logging.getLogger(__name__)
+
+FORMAT_JSON = "json"
+FORMAT_PROMETHEUS = "prometheus"
+
+FORMATS = (FORMAT_JSON, FORMAT_PROMETHEUS)
+
+# Prefix of the exported Prometheus metrics.
+_PROMETHEUS_PREFIX = "reddit_wallpaper_chooser_"
+
+
+class Timer(object):
+
+    """The number, the total and the maximum of a series of durations."""
+
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+
+class Metrics(object):
+
+    """
+    Named counters and timers, each optionally split by labels (e.g. by subreddit).
+    Recording is cheap enough to be done on every request.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.counters = collections.defaultdict(float)
+        self.timers = collections.defaultdict(Timer)
+
+    def count(self, name, value=1, **labels):
+        """
+        Increase a counter.
+
+        :param name: The counter name.
+        :param value: The increment.
+        :param labels: The labels of the counter.
+        """
+        self.counters[name, tuple(sorted(labels.items()))] += value
+
+    def observe(self, name, seconds, **labels):
+        """
+        Record a duration.
+
+        :param name: The timer name.
+        :param seconds: The duration.
+        :param labels: The labels of the timer.
+        """
+        self.timers[name, tuple(sorted(labels.items()))].observe(seconds)
+
+    @contextlib.contextmanager
+    def timed(self, name, **labels):
+        """
+        Record the (wall clock) duration of a block, even if it awaits.
+
+        :param name: The timer name.
+        :param labels: The labels of the timer.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def ratio(self, name, part, total):
+        """
+        :param name: A counter labelled by `result`.
+        :param part: The `result` label of the numerator.
+        :param total: The `result` labels of the denominator.
+        :return: The ratio between the counters, summed over the other labels, or None.
+        """
+        sums = collections.Counter()
+        for (counter, labels), value in self.counters.items():
+            if counter == name:
+                sums[dict(labels).get("result")] += value
+        denominator = sum(sums[r] for r in total)
+        return sums[part] / denominator if denominator else None
+
+    def summary(self):
+        """
+        :return: A JSON-serializable summary of the metrics.
+        """
+        counters = collections.defaultdict(list)
+        for (name, labels), value in sorted(self.counters.items()):
+            counters[name].append(dict(labels, value=value))
+
+        timers = collections.defaultdict(list)
+        for (name, labels), timer in sorted(self.timers.items(), key=lambda item: item[0]):
+            timers[name].append(dict(labels, count=timer.count, total=timer.total, max=timer.max))
+
+        return {
+            "started_at": self.started_at,
+            "elapsed": time.time() - self.started_at,
+            "cache_hit_ratio": {
+                "listings": self.ratio("listing_cache", "hit", ("hit", "revalidated", "miss")),
+                "wallpapers": self.ratio("wallpaper_cache", "hit", ("hit", "miss")),
+            },
+            "counters": counters,
+            "timers": timers,
+        }
+
+    def as_json(self):
+        """
+        :return: The metrics summary, as JSON.
+        """
+        return json.dumps(self.summary(), indent=2)
+
+    def as_prometheus(self):
+        """
+        :return: The metrics, in the Prometheus text exposition format.
+        """
+        lines = []
+
+        names = sorted({name for name, _ in self.counters})
+        for name in names:
+            metric = "{}{}_total".format(_PROMETHEUS_PREFIX, name)
+            lines.append("# TYPE {} counter".format(metric))
+            for (counter, labels), value in sorted(self.counters.items()):
+                if counter == name:
+                    lines.append("{}{} {}".format(metric, _prometheus_labels(labels), _number(value)))
+
+        names = sorted({name for name, _ in self.timers})
+        for name in names:
+            metric = "{}{}".format(_PROMETHEUS_PREFIX, name)
+            lines.append("# TYPE {} summary".format(metric))
+            for (timer_name, labels), timer in sorted(self.timers.items(), key=lambda item: item[0]):
+                if timer_name == name:
+                    lines.append("{}_count{} {}".format(metric, _prometheus_labels(labels), timer.count))
+                    lines.append("{}_sum{} {}".format(metric, _prometheus_labels(labels), _number(timer.total)))
+
+        return "\n".join(lines) + "\n"
+
+    def export(self, fmt=FORMAT_JSON):
+        """
+        :param fmt: One of `FORMATS`.
+        :return: The metrics, in that format.
+        """
+        assert fmt in FORMATS, "Unknown metrics format."
+        return self.as_prometheus() if fmt == FORMAT_PROMETHEUS else self.as_json()
+
+    def write(self, path, fmt=FORMAT_JSON):
+        """
+        Atomically replace the file at `path` with the exported metrics,
+        e.g. for the textfile collector of the Prometheus node exporter.
+
+        :param path: The destination path.
+        :param fmt: One of `FORMATS`.
+        """
+        write_file(path, self.export(fmt))
+
+
+def write_file(path, text):
+    """
+    Atomically replace the file at `path` with some exported metrics.
+
+    :param path: The destination path.
+    :param text: The exported metrics (see `Metrics.export`).
+    """
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+    logger.debug("Metrics written to '%s'.", path)
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    ))
+
+
+def _number(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Rate limiting of the Reddit API calls.
+"""
+
+import asyncio
+import logging
+import random
+import time
+
+from RedditWallpaperChooser import constants
+import aiohttp
+
+__author__ = 'aldur'
+
+logger = logging.getLogger(__name__)
+
+
+def _header_float(headers, name):
+    """
+    :return: The header `name` as a float, or None if missing or malformed.
+    """
+    try:
+        return float(headers[name])
+    except (KeyError, ValueError):
+        return None
+
+
+class RateLimiter(object):
+
+    """
+    A token bucket shared by every Reddit API call.
+
+    The refill rate starts from the configured one and follows the
+    `X-Ratelimit-Remaining`/`X-Ratelimit-Reset` headers sent by Reddit,
+    spreading the remaining requests over the current window.
+    Throttled (429) and failed (5xx) calls are retried with jittered exponential backoff.
+    """
+
+    def __init__(self, requests_per_minute, burst, max_retries,
+                 clock=time.monotonic, sleep=asyncio.sleep):
+        assert requests_per_minute > 0, "The request rate must be positive."
+        assert burst >= 1, "The burst must allow at least one request."
+
+        self.max_rate = requests_per_minute / 60.0
+        self.rate = self.max_rate
+        self.burst = burst
+        self.max_retries = max_retries
+
+        self._clock = clock
+        self._sleep = sleep
+
+        self.tokens = float(burst)
+        self._last_refill = clock()
+        self._blocked_until = 0.0
+        # Created in the running loop: before Python 3.10, locks bind to the loop current at creation.
+        self._lock = None
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    async def acquire(self):
+        """
+        Wait until a request can be sent.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = self._clock()
+                if now < self._blocked_until:
+                    await self._sleep(self._blocked_until - now)
+                    continue
+
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await self._sleep((1 - self.tokens) / self.rate)
+
+    def update(self, headers):
+        """
+        Adapt the pace to the rate limit headers of a response.
+
+        :param headers: The response headers.
+        """
+        remaining = _header_float(headers, "X-Ratelimit-Remaining")
+        reset = _header_float(headers, "X-Ratelimit-Reset")
+        if remaining is None or reset is None:
+            return
+
+        now = self._clock()
+        self._refill(now)
+        if remaining < 1:
+            logger.debug("Rate limit exhausted, waiting %.1f seconds.", reset)
+            self._blocked_until = now + reset
+            self.tokens = 0.0
+            self.rate = self.max_rate  # A new window starts after the reset.
+        else:
+            self.rate = min(self.max_rate, remaining / max(reset, 1.0))
+            self.tokens = min(self.tokens, remaining)
+
+    def backoff(self, attempt, retry_after=None):
+        """
+        :param attempt: The number of failed attempts so far.
+        :param retry_after: The `Retry-After` header value, if any.
+        :return: How many seconds to wait before retrying.
+        """
+        try:
+            if retry_after is not None:
+                return float(retry_after)
+        except ValueError:
+            pass
+        delay = min(constants.REDDIT_BACKOFF_CAP, constants.REDDIT_BACKOFF_BASE * 2 ** attempt)
+        return random.uniform(0, delay)  # Full jitter.
+
+    async def get(self, session, url, **kwargs):
+        """
+        Perform a paced GET request, retrying on throttling and server errors.
+        The caller is in charge of releasing the response (e.g. with `async with`).
+
+        :param session: An aiohttp session.
+        :param url: The URL to fetch.
+        :return: The aiohttp response.
+        """
+        attempt = 0
+        while True:
+            await self.acquire()
+            try:
+                response = await session.get(url, **kwargs)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.backoff(attempt)
+                logger.debug("Request to '%s' failed (%s), retrying in %.1f seconds.", url, e, delay)
+            else:
+                self.update(response.headers)
+                if response.status not in constants.REDDIT_RETRY_STATUSES or attempt >= self.max_retries:
+                    return response
+
+                delay = self.backoff(attempt, response.headers.get("Retry-After"))
+                logger.debug(
+                    "Got status %d from '%s', retrying in %.1f seconds.", response.status, url, delay
+                )
+                response.release()
+
+            attempt += 1
+            await self._sleep(delay)
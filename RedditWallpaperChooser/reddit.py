@@ -5,9 +5,12 @@
 Reddit API handler.
 """
 
+import collections
 import logging
+import time
 
 import RedditWallpaperChooser.constants
+import RedditWallpaperChooser.filtering
 import RedditWallpaperChooser.utils
 import RedditWallpaperChooser.wallpaper
 
@@ -15,46 +18,86 @@ __author__ = 'aldur'
 
 logger = logging.getLogger(__name__)
 
+# A parsed listing page: the accepted wallpapers, the 'after' token and the fullnames of all its posts.
+Page = collections.namedtuple("Page", "walls, after, names")
 
-def parse_listing(listing):
+
+def parse_raw_listing(raw, **filters):
+    """
+    Decode and parse a raw Reddit listing, with the fastest available JSON backend.
+
+    :param raw: The listing bytes, as returned by an API call.
+    :param filters: The filters of `parse_listing`.
+    :return: A Page, see `parse_listing`.
+    """
+    return parse_listing(RedditWallpaperChooser.utils.json_loads(raw), **filters)
+
+
+def parse_listing(listing, target_size=None, target_ratio=None, ratio_tolerance=0.0, min_score=None):
     """
     Parse a Reddit listing, looking for wallpaper links.
+    The whole page is filtered and ranked in a single batch, before building any wallpaper object.
 
     :param listing: The listing to be parsed, i.e. a JSON as returned by an API call.
-    :return: A list of wallpapers and the 'after' token, if any.
+    :param target_size: If set, skip the wallpapers smaller than this size.
+    :param target_ratio: If set, skip the wallpapers not respecting this ratio.
+    :param ratio_tolerance: The accepted relative deviation from the target ratio.
+    :param min_score: If set, skip the posts with a lower score.
+    :return: A Page, holding the list of wallpapers (best ranked first),
+             the 'after' token, if any, and the fullnames of the posts in the page.
     """
     assert listing['kind'] == 'Listing'
-    children = listing['data']['children']
 
-    return {w for w in (
-        parse_child(child)
-        for child in children
-        if child['kind'] == 't3'
-    ) if w is not None}, listing['data'].get('after', None)
+    candidates = []
+    names = []
+    for child in listing['data']['children']:
+        if child['kind'] != 't3':
+            continue
+        data = child['data']
+        names.append(data.get('name'))
+        source = _preview_source(data)
+        if source is not None:
+            candidates.append((data, source))
 
+    now = time.time()
+    ranked = RedditWallpaperChooser.filtering.filter_and_rank(
+        [source['width'] for _, source in candidates],
+        [source['height'] for _, source in candidates],
+        scores=[data.get('score', 0) for data, _ in candidates],
+        ages=[now - data.get('created_utc', now) for data, _ in candidates],
+        target_size=target_size,
+        target_ratio=target_ratio,
+        ratio_tolerance=ratio_tolerance,
+        min_score=min_score,
+    )
 
-def parse_child(child):
-    """
-    Parse a Reddit Listing child of type 'link'.
+    return Page(
+        [_wallpaper(*candidates[i]) for i in ranked],
+        listing['data'].get('after', None),
+        names,
+    )
 
-    :param child: The child to be parsed.
-    :return: A wallpaper object from the child.
-    """
-    assert child['kind'] == 't3'
-    data = child['data']
 
-    title = data['title']
-    url = data['url']
-    subreddit = data['subreddit']
+def _preview_source(data):
+    """
+    :param data: The data of a 'link' child.
+    :return: The source image of the link preview, or None.
+    """
     try:
         source = data['preview']['images'][0]['source']
-        url = source['url']
-        width = source['width']
-        height = source['height']
-
-        return RedditWallpaperChooser.wallpaper.WebWallpaper(
-            title, url, RedditWallpaperChooser.utils.Size(width, height), subreddit
-        )
-    except KeyError:  # Old posts do not have the 'preview' API field.
-        logger.debug("Ignoring '{}' - '{}' from 'r/{}'.".format(title, url, subreddit))
+    except (KeyError, IndexError):  # Old posts do not have the 'preview' API field.
+        source = None
+    if source is None or not all(key in source for key in ('width', 'height', 'url')):
+        logger.debug("Ignoring '%s' - '%s' from 'r/%s'.", data['title'], data['url'], data['subreddit'])
         return None
+    return source
+
+
+def _wallpaper(data, source):
+    return RedditWallpaperChooser.wallpaper.WebWallpaper(
+        data['title'],
+        source['url'],
+        RedditWallpaperChooser.utils.Size(source['width'], source['height']),
+        data['subreddit'],
+        data.get('score'),
+    )
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Weighted random choice of the stored wallpapers.
+"""
+
+import collections
+import logging
+import random
+import time
+
+import RedditWallpaperChooser.wallpaper
+from RedditWallpaperChooser import constants
+
+__author__ = 'aldur'
+
+logger = logging.getLogger(__name__)
+
+CHOOSE_UNIFORM = "uniform"
+CHOOSE_RECENT = "recent"
+CHOOSE_SCORE = "score"
+CHOOSE_LEAST_RECENTLY_SHOWN = "least_recently_shown"
+
+CHOOSE_BY = (CHOOSE_UNIFORM, CHOOSE_RECENT, CHOOSE_SCORE, CHOOSE_LEAST_RECENTLY_SHOWN)
+
+
+def weight(entry, choose_by, now):
+    """
+    :param entry: A cache entry.
+    :param choose_by: The weighting, one of `CHOOSE_BY`.
+    :param now: The current time.
+    :return: The (positive) weight of the entry.
+    """
+    if choose_by == CHOOSE_RECENT:
+        age = max(now - (entry.downloaded_at or 0), 0)
+        return max(0.5 ** (age / constants.CHOOSE_RECENT_HALF_LIFE), constants.CHOOSE_MIN_WEIGHT)
+    if choose_by == CHOOSE_SCORE:
+        return 1.0 + max(entry.score or 0, 0)
+    if choose_by == CHOOSE_LEAST_RECENTLY_SHOWN:
+        return max(now - (entry.last_used or 0), 1.0)
+    return 1.0
+
+
+class WeightedSampler(object):
+
+    """
+    A set of weighted items, stored in a Fenwick tree:
+    adding an item, changing its weight and sampling all take O(log n).
+    """
+
+    def __init__(self, items=(), weights=()):
+        """
+        :param items: The initial (distinct) items, built into the tree in O(n).
+        :param weights: Their weights.
+        """
+        self.items = list(items)
+        self.weights = list(weights)
+        assert len(self.items) == len(self.weights), "Each item needs a weight."
+        assert all(w >= 0 for w in self.weights), "Weights can't be negative."
+        self.positions = {item: position for position, item in enumerate(self.items)}
+
+        # 1-based: each node adds itself to its parent, which covers the range (n - lowbit(n), n].
+        self._tree = [0.0] + self.weights
+        for n in range(1, len(self._tree)):
+            parent = n + (n & -n)
+            if parent < len(self._tree):
+                self._tree[parent] += self._tree[n]
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, item):
+        return item in self.positions
+
+    def add(self, item, item_weight):
+        """
+        Add an item, or change its weight if already there.
+
+        :param item: A hashable item.
+        :param item_weight: Its weight (0 excludes it from sampling).
+        """
+        assert item_weight >= 0, "Weights can't be negative."
+        position = self.positions.get(item)
+        if position is not None:
+            self._add_to(position, item_weight - self.weights[position])
+            self.weights[position] = item_weight
+            return
+
+        # Append a node covering the range (n - lowbit(n), n].
+        n = len(self.items) + 1
+        self._tree.append(item_weight + self._prefix_sum(n - 1) - self._prefix_sum(n - (n & -n)))
+        self.positions[item] = n - 1
+        self.items.append(item)
+        self.weights.append(item_weight)
+
+    @property
+    def total(self):
+        """
+        The sum of the weights.
+        """
+        return self._prefix_sum(len(self.items))
+
+    def sample(self, rng=random):
+        """
+        :param rng: The random number generator.
+        :return: An item, with a probability proportional to its weight, or None if all weights are 0.
+        """
+        total = self.total
+        if total <= 0:
+            return None
+
+        while True:
+            target = rng.random() * total
+            position = 0
+            mask = 1 << (len(self.items).bit_length() - 1)
+            while mask:
+                child = position + mask
+                if child <= len(self.items) and self._tree[child] <= target:
+                    position = child
+                    target -= self._tree[child]
+                mask >>= 1
+            # Rounding errors could land on an item having no weight: draw again.
+            if position < len(self.items) and self.weights[position] > 0:
+                return self.items[position]
+
+    def _prefix_sum(self, n):
+        total = 0.0
+        while n > 0:
+            total += self._tree[n]
+            n -= n & -n
+        return total
+
+    def _add_to(self, position, delta):
+        n = position + 1
+        while n < len(self._tree):
+            self._tree[n] += delta
+            n += n & -n
+
+
+class Chooser(object):
+
+    """
+    Choose among the wallpapers of a cache index, optionally filtered by subreddit, size and ratio.
+
+    The candidates of each filter are only collected on the first choice with that filter,
+    and are collected again once wallpapers are added to or removed from the index.
+    Unless the index is preloaded, SQLite filters them, and only the chosen wallpaper is loaded.
+    """
+
+    def __init__(self, cache, choose_by=CHOOSE_UNIFORM, ratio_tolerance=0.0):
+        """
+        :param cache: The cache index.
+        :param choose_by: How candidates are weighted, one of `CHOOSE_BY`.
+        :param ratio_tolerance: The accepted relative deviation from a target ratio.
+        """
+        assert choose_by in CHOOSE_BY, "Unknown weighting."
+        self.cache = cache
+        self.choose_by = choose_by
+        self.ratio_tolerance = ratio_tolerance
+
+        self._samplers = collections.OrderedDict()
+
+    def choose(self, subreddits=None, min_size=None, target_ratio=None):
+        """
+        Choose a wallpaper and mark it as used.
+
+        :param subreddits: If set, only choose among the wallpapers of these subreddits.
+        :param min_size: If set, only choose among the wallpapers bigger than this size.
+        :param target_ratio: If set, only choose among the wallpapers having this aspect ratio.
+        :return: The cache entry of the chosen wallpaper, or None if no wallpaper fits.
+        """
+        subreddits = frozenset(s.lower() for s in subreddits or ())
+        sampler = self._sampler(subreddits, min_size, target_ratio)
+
+        url = sampler.sample()
+        if url is None:
+            return None
+
+        self.cache.load(url)
+        self.cache.touch(url)
+        entry = self.cache.get(url)
+        if self.choose_by == CHOOSE_LEAST_RECENTLY_SHOWN:
+            sampler.add(url, weight(entry, self.choose_by, time.time()))
+        return entry
+
+    def _sampler(self, subreddits, min_size, target_ratio):
+        """
+        :return: The (cached) sampler of the candidates respecting the filters.
+        """
+        key = (subreddits, min_size, target_ratio)
+        cached = self._samplers.get(key)
+        if cached is not None and cached[0] == self.cache.generation:
+            self._samplers.move_to_end(key)
+            return cached[1]
+
+        now = time.time()
+        if self.cache.preloaded:
+            candidates = [
+                entry for entry in self.cache.entries.values() if self._fits(entry, subreddits, min_size, target_ratio)
+            ]
+        else:
+            candidates = list(self.cache.select(subreddits, min_size, target_ratio, self.ratio_tolerance))
+        sampler = WeightedSampler(
+            (entry.url for entry in candidates), (weight(entry, self.choose_by, now) for entry in candidates)
+        )
+        logger.debug("%d candidate wallpapers.", len(sampler))
+
+        self._samplers[key] = (self.cache.generation, sampler)
+        self._samplers.move_to_end(key)
+        while len(self._samplers) > constants.CHOOSER_SAMPLERS:
+            self._samplers.popitem(last=False)
+        return sampler
+
+    def _fits(self, entry, subreddits, min_size, target_ratio):
+        """
+        :return: True if the cache entry respects the filters (see `choose`).
+        """
+        if subreddits and (entry.subreddit or "").lower() not in subreddits:
+            return False
+        if not (min_size or target_ratio):
+            return True
+        return bool(entry.width and entry.height) and RedditWallpaperChooser.wallpaper.size_fits(
+            entry.width, entry.height, min_size, target_ratio, self.ratio_tolerance
+        )
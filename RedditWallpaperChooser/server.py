@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Serve the stored wallpapers over HTTP (on a TCP port or on a Unix socket).
+"""
+
+import asyncio
+import logging
+import signal
+
+import RedditWallpaperChooser.config
+import RedditWallpaperChooser.metrics
+from aiohttp import web
+
+__author__ = 'aldur'
+
+logger = logging.getLogger(__name__)
+
+
+class Server(object):
+
+    """
+    A small HTTP API answering from the in-memory cache index, without touching the network:
+
+    - `GET /choose`: choose a wallpaper and return its metadata,
+      optionally filtered by `subreddit` (comma separated), `min_size` (e.g. `1920x1080`)
+      and `ratio` (e.g. `16:9`); with `size`, the path of its best variant for that size is returned;
+    - `GET /image/<id>`: the image itself (or, with `size`, its best variant), sent with `sendfile`;
+    - `GET /metadata/<id>`: the metadata of a wallpaper;
+    - `GET /metrics`: the metrics of the manager, in the Prometheus text format (or, with `format=json`, as JSON).
+    """
+
+    def __init__(self, manager):
+        """
+        :param manager: The manager whose cache index is served.
+        """
+        self.manager = manager
+        self.settings = manager.settings
+        self.runner = None
+
+        self.app = web.Application()
+        self.app.add_routes([
+            web.get("/choose", self.handle_choose),
+            web.get("/image/{id}", self.handle_image),
+            web.get("/metadata/{id}", self.handle_metadata),
+            web.get("/metrics", self.handle_metrics),
+        ])
+
+    def choose(self, subreddits=None, min_size=None, target_ratio=None):
+        """
+        Choose one of the stored wallpapers and mark it as used.
+
+        :param subreddits: If set, only choose among the wallpapers of these subreddits.
+        :param min_size: If set, only choose among the wallpapers bigger than this size.
+        :param target_ratio: If set, only choose among the wallpapers having this aspect ratio.
+        :return: The cache entry of the chosen wallpaper, or None if no wallpaper fits.
+        """
+        # Marked as used in memory: persisted with the next batch, or when the server stops.
+        return self.manager.chooser.choose(subreddits, min_size, target_ratio)
+
+    def metadata(self, entry, size=None):
+        """
+        :param entry: A cache entry.
+        :param size: If set, point to the best variant for this size.
+        :return: The metadata of a wallpaper, as a dictionary.
+        """
+        metadata = entry._asdict()
+        metadata.update({
+            "path": self.manager.image_path(entry, size),
+            "image": "/image/{}".format(entry.id),
+            "variants": sorted(
+                "{}x{}".format(*variant) for variant in self.manager.cache.variants.get(entry.id, ())
+            ),
+        })
+        return metadata
+
+    async def handle_choose(self, request):
+        """
+        `GET /choose`: choose a wallpaper and return its metadata.
+        """
+        query = request.query
+        try:
+            subreddits = {s.strip() for s in query.get("subreddit", "").split(",") if s.strip()}
+            min_size = RedditWallpaperChooser.config.parse_size(query.get("min_size"))
+            target_ratio = RedditWallpaperChooser.config.parse_ratio(query.get("ratio"))
+            size = RedditWallpaperChooser.config.parse_size(query.get("size"))
+        except (AssertionError, ValueError, ZeroDivisionError):
+            raise web.HTTPBadRequest(text="Malformed filters.")
+
+        entry = self.choose(subreddits, min_size, target_ratio)
+        if entry is None:
+            raise web.HTTPNotFound(text="No wallpaper fits.")
+        return web.json_response(self.metadata(entry, size))
+
+    async def handle_image(self, request):
+        """
+        `GET /image/<id>`: send the image of a wallpaper.
+        """
+        entry = self._entry(request)
+        try:
+            size = RedditWallpaperChooser.config.parse_size(request.query.get("size"))
+        except (AssertionError, ValueError):
+            raise web.HTTPBadRequest(text="Malformed size.")
+        # `FileResponse` relies on `sendfile` where available.
+        return web.FileResponse(self.manager.image_path(entry, size))
+
+    async def handle_metadata(self, request):
+        """
+        `GET /metadata/<id>`: return the metadata of a wallpaper.
+        """
+        return web.json_response(self.metadata(self._entry(request)))
+
+    async def handle_metrics(self, request):
+        """
+        `GET /metrics`: export the metrics.
+        """
+        fmt = request.query.get("format", RedditWallpaperChooser.metrics.FORMAT_PROMETHEUS)
+        if fmt not in RedditWallpaperChooser.metrics.FORMATS:
+            raise web.HTTPBadRequest(text="Unknown format.")
+        content_type = "application/json" if fmt == RedditWallpaperChooser.metrics.FORMAT_JSON else "text/plain"
+        return web.Response(text=self.manager.metrics.export(fmt), content_type=content_type)
+
+    def _entry(self, request):
+        """
+        :param request: A request routed with an `id`.
+        :return: The cache entry of the requested wallpaper.
+        """
+        entry = self.manager.cache.find_by_id(request.match_info["id"])
+        if entry is None:
+            raise web.HTTPNotFound(text="Unknown wallpaper.")
+        return entry
+
+    async def start(self):
+        """
+        Start listening, on the Unix socket if configured or on the TCP port otherwise.
+        """
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+
+        if self.settings.server_socket:
+            site = web.UnixSite(self.runner, self.settings.server_socket)
+        else:
+            site = web.TCPSite(self.runner, self.settings.server_host, self.settings.server_port)
+        await site.start()
+        logger.info("Serving wallpapers on %s.", site.name)
+
+    async def stop(self):
+        """
+        Stop listening, and persist the wallpapers marked as used, in the database thread.
+        """
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+        await self.manager.flush_index()
+
+    async def run(self, daemon=None):
+        """
+        Serve until cancelled (or until SIGTERM is received).
+        The cache index is written in the database thread (see `manager.Manager.io_scope`), with or without a daemon.
+
+        :param daemon: If set, a daemon (see `daemon.Daemon`) to run alongside the server.
+        """
+        async with self.manager.io_scope():
+            await self.start()
+            try:
+                if daemon is not None:
+                    await daemon.run()
+                else:
+                    loop = asyncio.get_running_loop()
+                    loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+                    try:
+                        await loop.create_future()
+                    except asyncio.CancelledError:
+                        logger.info("Stopping.")
+            finally:
+                await self.stop()
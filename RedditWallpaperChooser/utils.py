@@ -4,7 +4,58 @@
 """Various utilities."""
 
 import collections
+import hashlib
+import importlib
+import json
 
 __author__ = 'aldur'
 
 Size = collections.namedtuple("Size", "width, height")
+
+# The optional modules imported so far, None if not installed.
+_optional_modules = {}
+
+
+def optional_import(name):
+    """
+    Import an optional dependency on first use: they are slow to import, and not needed on every code path.
+
+    :param name: The module name, e.g. "PIL.Image".
+    :return: The module, or None if not installed.
+    """
+    if name not in _optional_modules:
+        try:
+            _optional_modules[name] = importlib.import_module(name)
+        except ImportError:
+            _optional_modules[name] = None
+    return _optional_modules[name]
+
+
+def json_backend():
+    """
+    Pick the fastest available JSON decoder, importing it on first use.
+
+    :return: `orjson.loads` if orjson is installed, `json.loads` otherwise.
+    """
+    orjson = optional_import("orjson")
+    return json.loads if orjson is None else orjson.loads
+
+
+def json_loads(raw):
+    """
+    Decode a JSON document with the fastest available decoder.
+
+    :param raw: The document, as bytes or string.
+    :return: The decoded document.
+    """
+    return json_backend()(raw)
+
+
+def url_id(url):
+    """
+    Produce a deterministic, collision-resistant identifier starting from an url.
+
+    :param url: The url.
+    :return: The hex BLAKE2b digest of the url.
+    """
+    return hashlib.blake2b(url.encode(), digest_size=16).hexdigest()
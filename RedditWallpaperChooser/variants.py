@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Resized variants and thumbnails of the stored wallpapers.
+
+Rendering requires Pillow and is meant to run in a process pool,
+so the functions in this module only take and return picklable values.
+"""
+
+import logging
+import os
+import os.path
+
+from RedditWallpaperChooser import utils
+
+__author__ = 'aldur'
+
+logger = logging.getLogger(__name__)
+
+# Quality of the rendered JPEG files.
+_JPEG_QUALITY = 90
+
+
+def available():
+    """
+    :return: True if variants can be rendered.
+    """
+    return utils.optional_import("PIL.ImageOps") is not None
+
+
+def variant_name(wallpaper_id, size):
+    """
+    :param wallpaper_id: The wallpaper identifier.
+    :param size: The variant size.
+    :return: The file name of a variant.
+    """
+    return "{}_{}x{}.jpg".format(wallpaper_id, size.width, size.height)
+
+
+def render(source_path, variants_path, wallpaper_id, sizes):
+    """
+    Render the variants of a wallpaper, cropping it to each size aspect ratio.
+    Variants already on disk are skipped, as are the ones bigger than the source.
+
+    :param source_path: The path of the stored wallpaper.
+    :param variants_path: The folder storing the variants.
+    :param wallpaper_id: The wallpaper identifier.
+    :param sizes: The variant sizes.
+    :return: The sizes of the variants available on disk.
+    """
+    assert available(), "I need Pillow to render the variants."
+    Image = utils.optional_import("PIL.Image")
+    ImageOps = utils.optional_import("PIL.ImageOps")
+    rendered = []
+    with Image.open(source_path) as image:
+        # Only the header has been read so far: the image is decoded if some variant is actually missing.
+        missing = []
+        for size in sizes:
+            if size.width > image.width or size.height > image.height:
+                continue
+            path = os.path.join(variants_path, variant_name(wallpaper_id, size))
+            if os.path.exists(path):
+                rendered.append(size)
+            else:
+                missing.append((size, path))
+        if not missing:
+            return rendered
+
+        image.draft("RGB", (max(s.width for s, _ in missing), max(s.height for s, _ in missing)))
+        image = image.convert("RGB")
+        for size, path in missing:
+            variant = ImageOps.fit(image, tuple(size), Image.LANCZOS)
+            tmp_path = "{}.tmp".format(path)
+            variant.save(tmp_path, "JPEG", quality=_JPEG_QUALITY)
+            os.replace(tmp_path, path)
+            rendered.append(size)
+
+    return rendered
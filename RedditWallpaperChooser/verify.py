@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Verification of the downloaded images.
+
+The functions in this module are meant to run in a process pool,
+so they only take and return picklable values.
+"""
+
+import collections
+import logging
+import os
+import struct
+
+__author__ = 'aldur'
+
+logger = logging.getLogger(__name__)
+
+ImageInfo = collections.namedtuple("ImageInfo", "image_type, width, height")
+
+_JPEG_MAGIC = b"\xff\xd8\xff"
+_PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+
+# JPEG Start Of Frame markers, carrying the image dimensions.
+_JPEG_SOF_MARKERS = {
+    0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf,
+}
+
+# Some encoders pad the file after the end marker.
+_TRAILER_SEARCH = 1024
+
+
+def _jpeg_info(f, file_size):
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) != 2 or marker[0] != 0xff:
+            return None
+        code = marker[1]
+        if code == 0xff:  # Fill byte.
+            f.seek(-1, os.SEEK_CUR)
+            continue
+        if code in (0x01,) or 0xd0 <= code <= 0xd7:  # Markers without payload.
+            continue
+
+        length = f.read(2)
+        if len(length) != 2:
+            return None
+        length, = struct.unpack(">H", length)
+
+        if code in _JPEG_SOF_MARKERS:
+            header = f.read(5)
+            if len(header) != 5:
+                return None
+            _, height, width = struct.unpack(">BHH", header)
+            break
+        f.seek(length - 2, os.SEEK_CUR)
+
+    f.seek(max(file_size - _TRAILER_SEARCH, 0))
+    if b"\xff\xd9" not in f.read():
+        return None  # Truncated.
+    return ImageInfo("jpg", width, height)
+
+
+def _png_info(f, file_size):
+    f.seek(8)
+    chunk = f.read(24)
+    if len(chunk) != 24 or chunk[4:8] != b"IHDR":
+        return None
+    width, height = struct.unpack(">II", chunk[8:16])
+
+    f.seek(max(file_size - _TRAILER_SEARCH, 0))
+    if b"IEND" not in f.read():
+        return None  # Truncated.
+    return ImageInfo("png", width, height)
+
+
+def inspect_image(path):
+    """
+    Identify an image from its magic bytes and read its true dimensions from its header.
+    Truncated files are rejected.
+
+    :param path: The image path.
+    :return: An ImageInfo, or None if the file is not a complete JPEG/PNG image.
+    """
+    try:
+        file_size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            magic = f.read(8)
+            if magic.startswith(_JPEG_MAGIC):
+                return _jpeg_info(f, file_size)
+            if magic.startswith(_PNG_MAGIC):
+                return _png_info(f, file_size)
+    except (OSError, struct.error):
+        pass
+    return None
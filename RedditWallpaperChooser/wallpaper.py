@@ -4,9 +4,9 @@
 """Wallpaper classes."""
 
 import logging
-import zlib
 
 import RedditWallpaperChooser.constants
+import RedditWallpaperChooser.filtering
 import RedditWallpaperChooser.utils
 
 __author__ = 'aldur'
@@ -14,23 +14,79 @@ __author__ = 'aldur'
 logger = logging.getLogger(__name__)
 
 
+def ratio(width, height):
+    """
+    :return: The aspect ratio of an image, rounded as the configured one.
+    """
+    return round(float(width) / height, 5)
+
+
+def size_fits(width, height, target_size, target_ratio, ratio_tolerance=0.0):
+    """
+    Check raw dimensions against the requirements, without building any wallpaper.
+
+    :param width: The image width.
+    :param height: The image height.
+    :param target_size: A target size (can be None).
+    :param target_ratio: A target ratio (can be None).
+    :param ratio_tolerance: The accepted relative deviation from the target ratio.
+
+    :return: True if the image is bigger than the provided size and respects the ratio requirements.
+    """
+    if target_size and (width < target_size.width or height < target_size.height):
+        return False
+    if target_ratio and not RedditWallpaperChooser.filtering.ratio_fits(
+            float(width) / height, target_ratio, ratio_tolerance):
+        return False
+    return True
+
+
 class WebWallpaper(object):
 
     """A wallpaper from the web."""
 
-    def __init__(self, title, url, size, subreddit):
+    __slots__ = ("title", "url", "subreddit", "score", "image_type", "_size", "_id", "_ratio")
+
+    def __init__(self, title, url, size, subreddit, score=None):
         self.title = title
         self.url = url
-        self.size = size
         self.subreddit = subreddit
+        self.score = score
+        self.image_type = None
 
-        # Produce a deterministic identifier starting form the url.
-        self.id = str(zlib.adler32(self.url.encode()))
+        self._size = size
+        self._id = None
+        self._ratio = None
 
-        # Store the image ratio
-        self.ratio = round(float(self.size.width) / self.size.height, 5)
+    @property
+    def size(self):
+        """
+        The image size.
+        """
+        return self._size
 
-        self.image_type = None
+    @size.setter
+    def size(self, size):
+        self._size = size
+        self._ratio = None
+
+    @property
+    def id(self):
+        """
+        A deterministic identifier, produced from the url.
+        """
+        if self._id is None:
+            self._id = RedditWallpaperChooser.utils.url_id(self.url)
+        return self._id
+
+    @property
+    def ratio(self):
+        """
+        The image ratio.
+        """
+        if self._ratio is None:
+            self._ratio = ratio(*self.size)
+        return self._ratio
 
     def __eq__(self, other):
         return isinstance(other, self.__class__) and self.url == other.url
@@ -57,34 +113,15 @@ class WebWallpaper(object):
 
         self.image_type = content_types.get(content_type, "jpg")
 
-    def fits(self, target_size, target_ratio):
+    def fits(self, target_size, target_ratio, ratio_tolerance=0.0):
         """
         :param target_size: A target size (can be None).
         :param target_ratio: A target ratio (can be None).
+        :param ratio_tolerance: The accepted relative deviation from the target ratio.
 
         :return: True if the wallpaper is bigger than the provided size and respects the ratio requirements.
         """
-        if not target_size and not target_ratio:
-            return True
-
-        size_fits = False
-        aspect_ratio_fits = False
-
-        if target_size:
-            size_fits = all((
-                self.size.height >= target_size.height,
-                self.size.width >= target_size.width,
-            ))
-
-        if target_ratio:
-            aspect_ratio_fits = target_ratio == self.ratio
-
-        if target_size and target_ratio:
-            return size_fits and aspect_ratio_fits
-        elif target_size:
-            return size_fits
-        else:  # aspect_ratio_fits
-            return aspect_ratio_fits
+        return size_fits(self.size.width, self.size.height, target_size, target_ratio, ratio_tolerance)
 
     @property
     def info(self):
@@ -98,15 +135,9 @@ class WebWallpaper(object):
             "height": self.size.height,
             "image_type": self.image_type,
             "subreddit": self.subreddit,
+            "score": self.score,
         }
 
-    @property
-    def info_path(self):
-        """
-        The path of the wallpaper's info on disk.
-        """
-        return "{}.json".format(self.id)
-
     @property
     def output_path(self):
         """
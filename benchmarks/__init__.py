@@ -0,0 +1,8 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+RedditWallpaperChooser benchmarks.
+"""
+
+__author__ = 'aldur'
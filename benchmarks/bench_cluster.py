@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Cluster benchmark: several processes, each acting as a cluster node,
+share an output folder and crawl a local fake Reddit at the same time.
+
+Usage: python -m benchmarks.bench_cluster --help
+"""
+
+import argparse
+import asyncio
+import os
+import os.path
+import sqlite3
+import sys
+import tempfile
+import time
+
+from RedditWallpaperChooser import cluster, constants
+from benchmarks import fake_server
+
+__author__ = 'aldur'
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_SCRIPT = os.path.join(_ROOT, "bin", "reddit-wallpaper-chooser")
+
+
+def _cmd_line_parser():
+    parser = argparse.ArgumentParser(description="Benchmark a cluster of nodes sharing an output folder.")
+    parser.add_argument("--nodes", type=int, default=4, help="number of nodes (i.e. processes)")
+    parser.add_argument("--subreddits", type=int, default=8, help="number of subreddits")
+    parser.add_argument("--pages", type=int, default=2, help="listing pages per subreddit")
+    parser.add_argument("--image-size", type=int, default=64 * 1024, help="image size in bytes")
+    parser.add_argument("--latency", type=float, default=0.0, help="latency per response, in seconds")
+    return parser
+
+
+def _configure(server, output_path, node, args):
+    """
+    :return: The path of the configuration of a node.
+    """
+    nodes = ["node{}".format(i) for i in range(args.nodes)]
+    config_path = os.path.join(output_path, "{}.ini".format(node))
+    with open(config_path, "w") as f:
+        f.write("\n".join([
+            "[reddit]",
+            "subreddits = {}".format(", ".join("sub{}".format(i) for i in range(args.subreddits))),
+            "result_limit = {}".format(args.pages * 100),
+            "api_url = {}".format(server.api_url),
+            "requests_per_minute = 60000",
+            "burst = 100",
+            "[wallpaper]",
+            "output_folder = {}".format(output_path),
+            "aspect_ratio = ",
+            "[cluster]",
+            "nodes = {}".format(", ".join(nodes)),
+            "node = {}".format(node),
+        ]))
+    return config_path
+
+
+async def _run_node(config_path):
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, _SCRIPT, "-c", config_path, "-l", "ERROR",
+        stdout=asyncio.subprocess.DEVNULL,
+        env=dict(os.environ, PYTHONPATH=_ROOT),
+    )
+    return await process.wait()
+
+
+def _indexed(output_path, node):
+    connection = sqlite3.connect(os.path.join(
+        output_path, cluster.node_filename(constants.CACHE_INDEX_FILENAME, node)
+    ))
+    try:
+        return connection.execute("SELECT COUNT(*) FROM wallpapers").fetchone()[0]
+    finally:
+        connection.close()
+
+
+async def _run(args):
+    server = fake_server.FakeReddit(pages=args.pages, image_size=args.image_size, latency=args.latency)
+    await server.start()
+
+    try:
+        with tempfile.TemporaryDirectory() as output_path:
+            nodes = ["node{}".format(i) for i in range(args.nodes)]
+            configs = [_configure(server, output_path, node, args) for node in nodes]
+
+            # A first run crawls, a second one only reuses what the other nodes stored.
+            for run in ("first", "second"):
+                listing_requests, image_requests = server.listing_requests, server.image_requests
+                start = time.perf_counter()
+                statuses = await asyncio.gather(*(_run_node(c) for c in configs))
+                print("{} run: {:.2f} s, {} listing requests, {} image requests, exit statuses {}".format(
+                    run, time.perf_counter() - start,
+                    server.listing_requests - listing_requests, server.image_requests - image_requests,
+                    statuses,
+                ))
+                print("  indexed wallpapers by node: {}".format(
+                    ", ".join("{}={}".format(node, _indexed(output_path, node)) for node in nodes)
+                ))
+
+            images = [f for f in os.listdir(output_path) if f.endswith(".jpg")]
+            print("{} images in the shared folder, {} journal segments left.".format(
+                len(images), len(cluster.journals(output_path))
+            ))
+    finally:
+        await server.stop()
+
+
+def main():
+    asyncio.run(_run(_cmd_line_parser().parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Micro-benchmark of the wallpaper filtering.
+
+Usage: python -m benchmarks.bench_filter
+"""
+
+import random
+import timeit
+
+import RedditWallpaperChooser.filtering
+import RedditWallpaperChooser.reddit
+import RedditWallpaperChooser.utils
+import RedditWallpaperChooser.wallpaper
+from benchmarks import fixtures
+
+__author__ = 'aldur'
+
+
+def main():
+    walls = []
+    for page in range(100):
+        walls += RedditWallpaperChooser.reddit.parse_listing(fixtures.listing_page("wallpapers", page)).walls
+
+    size = RedditWallpaperChooser.utils.Size(1920, 1080)
+    ratio = round(16 / 9, 5)
+    repeat, number = 5, 10
+
+    sizes = [tuple(w.size) for w in walls]
+    size_fits = RedditWallpaperChooser.wallpaper.size_fits
+
+    print("{} candidates.".format(len(walls)))
+    for name, timer in (
+        ("WebWallpaper.fits", timeit.Timer(lambda: [w for w in walls if w.fits(size, ratio)])),
+        ("wallpaper.size_fits", timeit.Timer(lambda: [s for s in sizes if size_fits(*s, size, ratio)])),
+    ):
+        best = min(timer.repeat(repeat=repeat, number=number)) / number
+        print("{:<22} {:.3f} us/candidate".format(name, best * 10 ** 6 / len(walls)))
+
+    _bench_batch(size, ratio, repeat, number)
+
+
+def _bench_batch(size, ratio, repeat, number, count=50000):
+    """
+    Time the batch filtering and ranking of a large backlog.
+    """
+    rng = random.Random(0)
+    widths, heights = zip(*(rng.choice(fixtures.SIZES) for _ in range(count)))
+    scores = [rng.randrange(10 ** 5) for _ in range(count)]
+    ages = [rng.random() * 10 ** 6 for _ in range(count)]
+
+    filtering = RedditWallpaperChooser.filtering
+    variants = [("pure Python", filtering._filter_and_rank_python)]
+    if RedditWallpaperChooser.utils.optional_import("numpy") is not None:
+        variants.append(("numpy", filtering._filter_and_rank_numpy))
+
+    for name, function in variants:
+        timer = timeit.Timer(lambda: function(
+            widths, heights, scores, ages, size, ratio, 0.01, 100
+        ))
+        best = min(timer.repeat(repeat=repeat, number=number)) / number
+        print("batch of {}, {:<12} {:.3f} ms".format(count, name, best * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Micro-benchmark of the listing decoding and parsing.
+
+Usage: python -m benchmarks.bench_listing [recorded_listing.json ...]
+
+Without arguments, synthetic listing pages are used.
+"""
+
+import json
+import sys
+import timeit
+
+import RedditWallpaperChooser.reddit
+import RedditWallpaperChooser.utils
+from benchmarks import fixtures
+
+__author__ = 'aldur'
+
+
+def _load_pages(paths):
+    if not paths:
+        return [fixtures.listing_bytes("wallpapers", page) for page in range(10)]
+
+    pages = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            pages.append(f.read())
+    return pages
+
+
+def _report(name, timer, pages, repeat, number):
+    best = min(timer.repeat(repeat=repeat, number=number)) / number
+    print("{:<28} {:>9.3f} ms/page".format(name, best * 1000 / len(pages)))
+
+
+def main(argv):
+    pages = _load_pages(argv)
+    repeat, number = 5, 10
+
+    print("{} pages, {:.0f} KB/page on average, JSON backend: {}.".format(
+        len(pages),
+        sum(len(p) for p in pages) / len(pages) / 1024,
+        RedditWallpaperChooser.utils.json_backend().__module__,
+    ))
+
+    _report("json.loads", timeit.Timer(
+        lambda: [json.loads(p) for p in pages]), pages, repeat, number)
+    _report("utils.json_loads", timeit.Timer(
+        lambda: [RedditWallpaperChooser.utils.json_loads(p) for p in pages]), pages, repeat, number)
+
+    decoded = [json.loads(p) for p in pages]
+    _report("reddit.parse_listing", timeit.Timer(
+        lambda: [RedditWallpaperChooser.reddit.parse_listing(d) for d in decoded]), pages, repeat, number)
+    _report("reddit.parse_raw_listing", timeit.Timer(
+        lambda: [RedditWallpaperChooser.reddit.parse_raw_listing(p) for p in pages]), pages, repeat, number)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+End-to-end benchmark, against a local fake Reddit.
+
+Usage: python -m benchmarks.bench_run --help
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os.path
+import resource
+import tempfile
+import time
+
+import RedditWallpaperChooser.manager
+from RedditWallpaperChooser import config
+from benchmarks import fake_server
+
+__author__ = 'aldur'
+
+
+def _cmd_line_parser():
+    parser = argparse.ArgumentParser(description="Benchmark a full run against a local fake Reddit.")
+    parser.add_argument("--subreddits", type=int, default=5, help="number of subreddits")
+    parser.add_argument("--pages", type=int, default=3, help="listing pages per subreddit")
+    parser.add_argument("--per-page", type=int, default=100, help="posts per listing page")
+    parser.add_argument("--image-size", type=int, default=512 * 1024, help="image size in bytes")
+    parser.add_argument("--latency", type=float, default=0.0, help="latency per response, in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability of a 503 response")
+    parser.add_argument("--bandwidth", type=float, default=0, help="bytes per second of the images (0: no limit)")
+    parser.add_argument("--fixed-concurrency", action="store_true",
+                        help="download `limit_per_host` images at once, instead of adapting")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser
+
+
+def _configure(server, output_path, args):
+    """
+    Load a configuration pointing to the fake server.
+    """
+    config_path = os.path.join(output_path, "config.ini")
+    with open(config_path, "w") as f:
+        f.write("\n".join([
+            "[reddit]",
+            "subreddits = {}".format(", ".join("sub{}".format(i) for i in range(args.subreddits))),
+            "result_limit = {}".format(args.pages * args.per_page),
+            "api_url = {}".format(server.api_url),
+            "requests_per_minute = 60000",
+            "burst = 100",
+            "[wallpaper]",
+            "output_folder = {}".format(output_path),
+            "[network]",
+            "adaptive_concurrency = {}".format("no" if args.fixed_concurrency else "yes"),
+        ]))
+
+    config.parser = None
+    config.parse_config(config_path)
+
+
+async def _timed(coroutine):
+    start = time.perf_counter()
+    await coroutine
+    return time.perf_counter() - start
+
+
+async def _run(args):
+    server = fake_server.FakeReddit(
+        pages=args.pages,
+        per_page=args.per_page,
+        image_size=args.image_size,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        bandwidth=args.bandwidth,
+    )
+    await server.start()
+
+    try:
+        with tempfile.TemporaryDirectory() as output_path:
+            _configure(server, output_path, args)
+
+            run_start = time.perf_counter()
+            manager = RedditWallpaperChooser.manager.Manager(output_path, config.settings)
+            setup_time = time.perf_counter() - run_start
+
+            async with manager.session_scope() as session:
+                queue = asyncio.Queue(maxsize=manager.settings.queue_size)
+                fetch_time, store_time = await asyncio.gather(
+                    _timed(manager.fetch(session, queue)),
+                    _timed(manager.store(session, queue)),
+                )
+
+            start = time.perf_counter()
+            manager.choose()
+            choose_time = time.perf_counter() - start
+            wall_time = time.perf_counter() - run_start
+    finally:
+        await server.stop()
+
+    requests = server.listing_requests + server.image_requests
+    return {
+        "wall_time_s": wall_time,
+        "phases_s": {
+            "setup": setup_time,
+            "fetch": fetch_time,
+            "store": store_time,
+            "choose": choose_time,
+        },
+        "listing_requests": server.listing_requests,
+        "image_requests": server.image_requests,
+        "stored_wallpapers": len(manager.walls),
+        "download_limits": {
+            host: limit.capacity for host, limit in manager.download_limits.limits.items()
+        },
+        "requests_per_s": requests / wall_time,
+        "bytes_per_s": server.bytes_sent / wall_time,
+        # On Linux, ru_maxrss is expressed in KB.
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def main():
+    args = _cmd_line_parser().parse_args()
+    logging.getLogger("RedditWallpaperChooser").setLevel(logging.ERROR)
+    report = asyncio.run(_run(args))
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    for key, value in report.items():
+        if isinstance(value, dict):
+            print("{}:".format(key))
+            for k, v in value.items():
+                print("  {:<18} {:.4f}".format(k, v))
+        elif isinstance(value, float):
+            print("{:<20} {:.2f}".format(key, value))
+        else:
+            print("{:<20} {}".format(key, value))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Start-up benchmark of the command line tool, based on `python -X importtime`.
+Exits with a non-zero status if the start-up exceeds the budget.
+
+Usage: python -m benchmarks.bench_startup --help
+"""
+
+import argparse
+import os
+import os.path
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+__author__ = 'aldur'
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_SCRIPT = os.path.join(_ROOT, "bin", "reddit-wallpaper-chooser")
+
+# Modules that must not be imported before a networked code path runs.
+_HEAVY_MODULES = ("aiohttp", "numpy", "PIL", "orjson", "asyncio", "RedditWallpaperChooser.manager")
+
+
+def _cmd_line_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the start-up of the command line tool.")
+    parser.add_argument("--budget", type=float, default=150, help="wall time budget per command, in ms")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per command (the median is reported)")
+    parser.add_argument("--wallpapers", type=int, default=20000,
+                        help="wallpapers in the index chosen from by the last command")
+    return parser
+
+
+def _run(arguments, **kwargs):
+    """
+    Run the command line tool, making sure it is imported from this repository.
+    """
+    env = dict(os.environ, PYTHONPATH=_ROOT)
+    return subprocess.run([sys.executable] + arguments, env=env, **kwargs)
+
+
+def _import_times(command):
+    """
+    :param command: The command line arguments.
+    :return: The total import time (in ms), and the names of the imported modules.
+    """
+    result = _run(
+        ["-X", "importtime", _SCRIPT] + command,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True,
+    )
+    total, modules = 0, set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():  # The header.
+            continue
+        modules.add(name.strip())
+        if not name.startswith("  "):  # Top-level import.
+            total += int(cumulative)
+    return total / 1000, modules
+
+
+def _populate(output_path, count):
+    """
+    Fill the cache index of `output_path` with `count` wallpapers (their files are not needed to choose one).
+    """
+    import RedditWallpaperChooser.cache
+
+    cache = RedditWallpaperChooser.cache.CacheIndex(output_path)
+    now = time.time()
+    for i in range(count):
+        cache.add(RedditWallpaperChooser.cache.CacheEntry(
+            url="https://i.redd.it/{}.jpg".format(i), id="{:032x}".format(i), title=None,
+            subreddit="subreddit{}".format(i % 4), width=1920 + i % 3 * 640, height=1080,
+            image_type="jpg", byte_size=1 << 20, downloaded_at=now - i, content_hash=None,
+            last_used=None, score=i % 100, linked_to=None,
+        ))
+    cache.close()
+
+
+def _wall_time(arguments, repeat):
+    """
+    :return: The median wall time (in ms) of a Python process.
+    """
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        _run(arguments, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    args = _cmd_line_parser().parse_args()
+
+    with tempfile.TemporaryDirectory() as output_path, tempfile.TemporaryDirectory() as populated_path:
+        config_path = os.path.join(output_path, "config.ini")
+        with open(config_path, "w") as f:
+            f.write("[wallpaper]\noutput_folder = {}\n".format(output_path))
+        populated_config_path = os.path.join(populated_path, "config.ini")
+        with open(populated_config_path, "w") as f:
+            f.write("[reddit]\nsubreddits = subreddit0, subreddit1\n[wallpaper]\noutput_folder = {}\n".format(
+                populated_path
+            ))
+        _populate(populated_path, args.wallpapers)
+
+        commands = [
+            ("--help", ["--help"]),
+            ("--default_config", ["-d", os.path.join(output_path, "default.ini")]),
+            ("--choose-only", ["-c", config_path, "--choose-only"]),
+            ("--choose-only {}".format(args.wallpapers), ["-c", populated_config_path, "--choose-only"]),
+        ]
+
+        print("{:<22} {:>8.1f} ms wall (bare interpreter)".format("python", _wall_time(["-c", "pass"], args.repeat)))
+        failed = False
+        for name, command in commands:
+            wall = _wall_time([_SCRIPT] + command, args.repeat)
+            import_time, modules = _import_times(command)
+            heavy = sorted(m for m in modules if m.split(".")[0] in _HEAVY_MODULES or m in _HEAVY_MODULES)
+
+            over = wall > args.budget
+            failed |= over or bool(heavy)
+            print("{:<22} {:>8.1f} ms wall, {:>6.1f} ms importing{}{}".format(
+                name, wall, import_time,
+                " - OVER BUDGET" if over else "",
+                " - imports {}".format(", ".join(heavy)) if heavy else "",
+            ))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
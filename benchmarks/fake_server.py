@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+A local stand-in for the Reddit API and its image hosts.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import struct
+
+from aiohttp import web
+
+from benchmarks import fixtures
+
+__author__ = 'aldur'
+
+# Bytes sent at once by a bandwidth-limited response.
+_BANDWIDTH_CHUNK = 16 * 1024
+
+
+class FakeReddit(object):
+
+    """
+    Serve synthetic `/r/<subreddit>/<sorting>/.json` listings and the images they link to.
+    """
+
+    def __init__(self, pages=3, per_page=100, image_size=512 * 1024,
+                 latency=0.0, error_rate=0.0, bandwidth=0, rate_limit=0, rate_window=600.0, seed=0):
+        """
+        :param pages: Number of listing pages per subreddit.
+        :param per_page: Number of posts per listing page.
+        :param image_size: Size in bytes of each served image.
+        :param latency: Delay in seconds added to each response.
+        :param error_rate: Probability of answering with a 503.
+        :param bandwidth: Bytes per second shared by every image response (0 for no limit).
+        :param rate_limit: Listing requests allowed per window, as Reddit does (0 for no limit).
+            Listings carry the `X-Ratelimit-*` headers, and requests over the limit get a 429.
+        :param rate_window: The rate limit window, in seconds.
+        :param seed: Seed of the generated content and errors.
+        """
+        self.pages = pages
+        self.per_page = per_page
+        self.image_size = image_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.bandwidth = bandwidth
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self._window_start = None
+        self._window_used = 0
+        # When the shared link is next free to send, as a monotonic time.
+        self._link_free_at = 0.0
+        self.seed = seed
+
+        self._random = random.Random(seed)
+        # Fake entropy-coded data: no 0xff byte, so that no JPEG marker is found in it.
+        self._image = bytes(self._random.randrange(0xff) for _ in range(256)) * (image_size // 256 + 1)
+        self._runner = None
+        self.base_url = None
+
+        self.listing_requests = 0
+        self.throttled_requests = 0
+        self.image_requests = 0
+        self.bytes_sent = 0
+
+    @property
+    def api_url(self):
+        """
+        The listing URL format string, to be used as the `api_url` configuration option.
+        """
+        return self.base_url + "/r/{}/{}/.json"
+
+    async def _delay_or_fail(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and self._random.random() < self.error_rate:
+            raise web.HTTPServiceUnavailable()
+
+    def _rate_limit_headers(self):
+        """
+        Count a listing request in the current rate limit window.
+
+        :return: Whether the request is within the limit, and the `X-Ratelimit-*` headers.
+        """
+        now = asyncio.get_running_loop().time()
+        if self._window_start is None or now >= self._window_start + self.rate_window:
+            self._window_start, self._window_used = now, 0
+
+        over = self._window_used >= self.rate_limit
+        if not over:
+            self._window_used += 1
+        headers = {
+            "X-Ratelimit-Used": str(self._window_used),
+            "X-Ratelimit-Remaining": str(self.rate_limit - self._window_used),
+            "X-Ratelimit-Reset": "{:.3f}".format(self._window_start + self.rate_window - now),
+        }
+        return not over, headers
+
+    async def _listing(self, request):
+        self.listing_requests += 1
+        headers = {}
+        if self.rate_limit:
+            allowed, headers = self._rate_limit_headers()
+            if not allowed:
+                self.throttled_requests += 1
+                raise web.HTTPTooManyRequests(headers=headers)
+        await self._delay_or_fail()
+
+        subreddit = request.match_info["subreddit"]
+        after = request.query.get("after")
+        # Like Reddit, `after` is the fullname of the last post already seen, and pages are at most `per_page` long.
+        start = int(after[-6:]) + 1 if after else 0
+        limit = min(int(request.query.get("limit", self.per_page)), self.per_page)
+
+        body = json.dumps(fixtures.listing_slice(
+            subreddit, start, limit,
+            total=self.pages * self.per_page,
+            image_host=self.base_url + "/images",
+            seed=self.seed,
+        )).encode()
+        self.bytes_sent += len(body)
+        return web.Response(body=body, headers=headers, content_type="application/json")
+
+    async def _image_handler(self, request):
+        self.image_requests += 1
+        await self._delay_or_fail()
+
+        body = self._jpeg(request.match_info["name"])
+        start = 0
+        status = 200
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        headers = {"Accept-Ranges": "bytes", "ETag": etag}
+
+        byte_range = request.http_range
+        # As HTTP mandates, a range whose validator does not match gets the whole (changed) image.
+        if byte_range.start is not None and request.headers.get("If-Range", etag) == etag:
+            start = byte_range.start
+            if start >= len(body):
+                raise web.HTTPRequestRangeNotSatisfiable()
+            status = 206
+            headers["Content-Range"] = "bytes {}-{}/{}".format(start, len(body) - 1, len(body))
+
+        self.bytes_sent += len(body) - start
+        if not self.bandwidth:
+            return web.Response(
+                body=body[start:], status=status, headers=headers, content_type="image/jpeg"
+            )
+
+        response = web.StreamResponse(status=status, headers=headers)
+        response.content_type = "image/jpeg"
+        response.content_length = len(body) - start
+        await response.prepare(request)
+        for position in range(start, len(body), _BANDWIDTH_CHUNK):
+            chunk = body[position:position + _BANDWIDTH_CHUNK]
+            await self._transmit(len(chunk))
+            await response.write(chunk)
+        await response.write_eof()
+        return response
+
+    async def _transmit(self, byte_size):
+        """
+        Wait for `byte_size` bytes to go through the shared link: concurrent responses queue for it.
+        """
+        loop = asyncio.get_running_loop()
+        self._link_free_at = max(self._link_free_at, loop.time()) + byte_size / self.bandwidth
+        await asyncio.sleep(self._link_free_at - loop.time())
+
+    def _jpeg(self, name):
+        """
+        :return: A JPEG-like image with the dimensions found in `name`, of about `image_size` bytes.
+        """
+        match = re.search(r"_(\d+)x(\d+)\.", name)
+        width, height = (int(match.group(1)), int(match.group(2))) if match else (1920, 1080)
+
+        # Make each image unique, so that no download is deduplicated.
+        comment = name.encode()
+        header = b"".join((
+            b"\xff\xd8",
+            b"\xff\xfe", struct.pack(">H", len(comment) + 2), comment,
+            b"\xff\xc0", struct.pack(">HBHHB", 11, 8, height, width, 1), b"\x01\x11\x00",
+            b"\xff\xda", struct.pack(">HB", 8, 1), b"\x01\x00\x00\x3f\x00",
+        ))
+        return header + self._image[:max(self.image_size - len(header) - 2, 0)] + b"\xff\xd9"
+
+    async def start(self, host="127.0.0.1", port=0):
+        """
+        Start serving; `base_url` is set once the server is listening.
+        """
+        app = web.Application()
+        app.router.add_get("/r/{subreddit}/{sorting}/.json", self._listing)
+        app.router.add_get("/images/{name}", self._image_handler)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = "http://{}:{}".format(host, port)
+
+    async def stop(self):
+        """
+        Stop serving.
+        """
+        await self._runner.cleanup()
+
+
+async def _serve(args):
+    server = FakeReddit(
+        pages=args.pages, image_size=args.image_size, latency=args.latency, error_rate=args.error_rate,
+        bandwidth=args.bandwidth, rate_limit=args.rate_limit,
+    )
+    await server.start(port=args.port)
+    print("Serving on {}; use 'api_url = {}'.".format(server.base_url, server.api_url), flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local fake Reddit until interrupted.")
+    parser.add_argument("--port", type=int, default=8080, help="listening port")
+    parser.add_argument("--pages", type=int, default=3, help="listing pages per subreddit")
+    parser.add_argument("--image-size", type=int, default=512 * 1024, help="image size in bytes")
+    parser.add_argument("--latency", type=float, default=0.0, help="latency per response, in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability of a 503 response")
+    parser.add_argument("--bandwidth", type=float, default=0, help="bytes per second of the images (0: no limit)")
+    parser.add_argument("--rate-limit", type=int, default=0, help="listing requests per 10 minutes (0: no limit)")
+
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
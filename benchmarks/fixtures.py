@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Synthetic Reddit listings, shaped (and sized) like the ones served by the API.
+"""
+
+import json
+import random
+
+__author__ = 'aldur'
+
+_RESOLUTIONS = [(108, 60), (216, 121), (320, 180), (640, 360), (960, 540), (1080, 607)]
+
+SIZES = [(1920, 1080), (2560, 1440), (3840, 2160), (1080, 1920), (4000, 3000), (1280, 720)]
+
+
+def _image(url, width, height):
+    return {"url": url, "width": width, "height": height}
+
+
+def listing_child(index, subreddit, image_host="https://i.redd.it", rng=random):
+    """
+    :return: A Listing child of kind 't3', with most of the noise of a real one.
+    """
+    width, height = rng.choice(SIZES)
+    name = "{}{:06d}".format(subreddit, index)
+    source_url = "{}/{}_{}x{}.jpg".format(image_host, name, width, height)
+
+    data = {
+        "title": "Wallpaper #{} from r/{}".format(index, subreddit),
+        "url": source_url,
+        "subreddit": subreddit,
+        "name": "t3_{}".format(name),
+        "id": name,
+        "author": "user{}".format(rng.randrange(10 ** 6)),
+        "score": rng.randrange(10 ** 5),
+        "ups": rng.randrange(10 ** 5),
+        "num_comments": rng.randrange(10 ** 3),
+        "created_utc": 1.5e9 + rng.randrange(10 ** 8),
+        "permalink": "/r/{}/comments/{}/".format(subreddit, name),
+        "selftext": "",
+        "selftext_html": None,
+        "thumbnail": "https://b.thumbs.redditmedia.com/{}.jpg".format(name),
+        "all_awardings": [{"name": "Silver", "coin_price": 100} for _ in range(rng.randrange(4))],
+        "link_flair_richtext": [{"e": "text", "t": "OC"}],
+        "preview": {
+            "enabled": True,
+            "images": [{
+                "id": name,
+                "source": _image(source_url, width, height),
+                "resolutions": [
+                    _image("https://preview.redd.it/{}.jpg?width={}".format(name, w), w, h)
+                    for w, h in _RESOLUTIONS
+                ],
+                "variants": {},
+            }],
+        },
+    }
+    if rng.random() < 0.05:  # Some posts lack the preview.
+        del data["preview"]
+
+    return {"kind": "t3", "data": data}
+
+
+def listing_page(subreddit, page, per_page=100, last_page=None, image_host="https://i.redd.it", seed=0):
+    """
+    :return: A Listing page, as a dictionary.
+    """
+    rng = random.Random("{}-{}-{}".format(seed, subreddit, page))
+    # As in Reddit, `after` is the fullname of the last post of the page.
+    after = None
+    if last_page is None or page < last_page:
+        after = "t3_{}{:06d}".format(subreddit, (page + 1) * per_page - 1)
+
+    return {
+        "kind": "Listing",
+        "data": {
+            "after": after,
+            "before": None,
+            "dist": per_page,
+            "children": [
+                listing_child(page * per_page + i, subreddit, image_host, rng)
+                for i in range(per_page)
+            ],
+        },
+    }
+
+
+def listing_slice(subreddit, start, count, total=None, image_host="https://i.redd.it", seed=0):
+    """
+    :return: A Listing page of `count` posts from the `start`-th one, as a dictionary.
+        Each post only depends on its position, so that pages of any size are consistent with each other.
+    """
+    if total is not None:
+        count = max(min(count, total - start), 0)
+    # As in Reddit, `after` is the fullname of the last post of the page.
+    after = None
+    if count and (total is None or start + count < total):
+        after = "t3_{}{:06d}".format(subreddit, start + count - 1)
+
+    return {
+        "kind": "Listing",
+        "data": {
+            "after": after,
+            "before": None,
+            "dist": count,
+            "children": [
+                listing_child(i, subreddit, image_host, random.Random("{}-{}-{}".format(seed, subreddit, i)))
+                for i in range(start, start + count)
+            ],
+        },
+    }
+
+
+def listing_bytes(subreddit, page, **kwargs):
+    """
+    :return: A Listing page, encoded as JSON.
+    """
+    return json.dumps(listing_page(subreddit, page, **kwargs)).encode()
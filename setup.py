@@ -83,7 +83,7 @@ setuptools.setup(
         'Intended Audience :: System Administrators',
         'License :: OSI Approved :: MIT License',
         'Programming Language :: Python :: 3 :: Only',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.8',
         'Topic :: Desktop Environment',
         'Topic :: Multimedia',
         'Topic :: Utilities',
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Tests of the budgeting of the accepted wallpapers across subreddits.
+"""
+
+import unittest
+
+import RedditWallpaperChooser.budget
+from RedditWallpaperChooser import constants
+
+__author__ = 'aldur'
+
+
+class TestApportion(unittest.TestCase):
+
+    def test_largest_remainders_get_the_rest(self):
+        shares = RedditWallpaperChooser.budget.apportion(7, {"a": 3, "b": 1})
+        self.assertEqual(shares, {"a": 5, "b": 2})
+
+    def test_ties_are_broken_by_key(self):
+        shares = RedditWallpaperChooser.budget.apportion(10, {"c": 1, "b": 1, "a": 1})
+        self.assertEqual(shares, {"a": 4, "b": 3, "c": 3})
+
+    def test_shares_sum_to_total(self):
+        for total in range(20):
+            shares = RedditWallpaperChooser.budget.apportion(total, {"a": 0.2, "b": 1.7, "c": 3.1})
+            self.assertEqual(sum(shares.values()), total)
+
+    def test_no_weights(self):
+        self.assertEqual(RedditWallpaperChooser.budget.apportion(5, {}), {})
+
+
+class TestBudget(unittest.TestCase):
+
+    def test_exhausted_subreddit_shares_its_quota(self):
+        budget = RedditWallpaperChooser.budget.Budget(9, {"a": 1, "b": 1, "c": 1})
+        self.assertEqual(budget.quotas, {"a": 3, "b": 3, "c": 3})
+
+        budget.record("a", 10, 1)
+        budget.finish("a")
+
+        self.assertEqual(budget.quotas, {"a": 1, "b": 4, "c": 4})
+        self.assertEqual(budget.resumable(), ["b", "c"])
+        self.assertFalse(budget.met)
+
+        budget.record("b", 10, 4)
+        budget.record("c", 10, 4)
+        self.assertTrue(budget.met)
+
+    def test_met_once_every_subreddit_is_exhausted(self):
+        budget = RedditWallpaperChooser.budget.Budget(10, {"a": 1, "b": 1})
+        budget.record("a", 10, 2)
+        budget.finish("a")
+        self.assertEqual(budget.quotas, {"a": 2, "b": 8})
+        budget.finish("b")
+
+        self.assertEqual(budget.resumable(), [])
+        self.assertTrue(budget.met)
+
+    def test_finished_quota_is_kept(self):
+        budget = RedditWallpaperChooser.budget.Budget(4, {"a": 1, "b": 1})
+        budget.record("a", 10, 2)
+        budget.finish("a")
+        self.assertEqual(budget.quotas, {"a": 2, "b": 2})
+
+    def test_page_limit_is_clamped(self):
+        budget = RedditWallpaperChooser.budget.Budget(48, {"a": 1, "b": 1})
+        # Nothing accepted yet: a full page.
+        self.assertEqual(budget.page_limit("a"), constants.REDDIT_PAGE_LIMIT)
+
+        # 14 left at an acceptance rate of 1/2: 35 posts, rounded up to a step.
+        budget.record("a", 20, 10)
+        self.assertEqual(budget.page_limit("a"), 2 * constants.BUDGET_LIMIT_STEP)
+
+        # A single wallpaper left: at least one step.
+        budget.record("a", 13, 13)
+        self.assertEqual(budget.page_limit("a"), constants.BUDGET_LIMIT_STEP)
+
+        # 20 left at an acceptance rate of 1/100: at most a full page.
+        budget.record("b", 400, 4)
+        self.assertEqual(budget.page_limit("b"), constants.REDDIT_PAGE_LIMIT)
+
+
+if __name__ == '__main__':
+    unittest.main()
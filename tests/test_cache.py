@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Tests of the cache index migrations.
+"""
+
+import json
+import os
+import os.path
+import tempfile
+import unittest
+
+import RedditWallpaperChooser.cache
+from RedditWallpaperChooser import utils
+
+__author__ = 'aldur'
+
+URL = "https://i.redd.it/a.jpg"
+
+
+class TestMigration(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.output_path = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, content):
+        with open(os.path.join(self.output_path, name), "w") as f:
+            f.write(content)
+
+    def open_index(self):
+        cache = RedditWallpaperChooser.cache.CacheIndex(self.output_path)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_sidecars_are_imported_and_ids_renamed(self):
+        self.write("123.jpg", "image")
+        self.write("123.json", json.dumps({"url": URL, "image_type": "jpg", "subreddit": "earthporn"}))
+
+        entry = self.open_index().get(URL)
+
+        self.assertEqual(entry.id, utils.url_id(URL))
+        self.assertEqual(entry.subreddit, "earthporn")
+        self.assertEqual(sorted(os.listdir(self.output_path)), [".index.sqlite3", "{}.jpg".format(entry.id)])
+
+    def test_other_json_files_are_kept(self):
+        self.write("999.json", "{not json")
+        self.write("metrics.json", json.dumps({"downloads": 3}))
+        self.write("list.json", json.dumps([1, 2]))
+
+        self.assertEqual(len(self.open_index()), 0)
+        for name in ("999.json", "metrics.json", "list.json"):
+            self.assertTrue(os.path.exists(os.path.join(self.output_path, name)), name)
+
+    def test_migration_runs_once(self):
+        self.open_index().close()
+        self.write("123.jpg", "image")
+        self.write("123.json", json.dumps({"url": URL, "image_type": "jpg"}))
+
+        self.assertNotIn(URL, self.open_index())
+        self.assertTrue(os.path.exists(os.path.join(self.output_path, "123.json")))
+
+
+if __name__ == '__main__':
+    unittest.main()
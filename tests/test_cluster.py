@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Tests of the coordination of several nodes sharing an output folder.
+"""
+
+import os
+import os.path
+import tempfile
+import time
+import unittest
+
+import RedditWallpaperChooser.cache
+import RedditWallpaperChooser.cluster
+
+__author__ = 'aldur'
+
+NODES = ("a", "b")
+
+
+class TestFileLock(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, ".wallpaper.lock")
+
+    def lock(self, owner):
+        return RedditWallpaperChooser.cluster.FileLock(self.path, owner, timeout=1)
+
+    def make_stale(self):
+        past = time.time() - 5
+        os.utime(self.path, (past, past))
+
+    def test_exclusive_until_released(self):
+        first, second = self.lock("a"), self.lock("b")
+        self.assertTrue(first.acquire())
+        self.assertFalse(second.acquire())
+
+        first.release()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertTrue(second.acquire())
+
+    def test_stale_lock_is_broken(self):
+        first, second = self.lock("a"), self.lock("b")
+        first.acquire()
+        self.make_stale()
+
+        self.assertTrue(second.acquire())
+        with open(self.path) as f:
+            self.assertEqual(f.read(), second.token)
+
+    def test_broken_lock_is_not_released_by_its_former_holder(self):
+        first, second = self.lock("a"), self.lock("b")
+        first.acquire()
+        self.make_stale()
+        second.acquire()
+
+        self.assertFalse(first.refresh())
+        first.release()
+        self.assertTrue(os.path.exists(self.path))
+        self.assertTrue(second.refresh())
+
+        second.release()
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    def test_refresh_keeps_the_lock_fresh(self):
+        first, second = self.lock("a"), self.lock("b")
+        first.acquire()
+        self.make_stale()
+
+        self.assertTrue(first.refresh())
+        self.assertFalse(second.acquire())
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.output_path = self.tmp.name
+        self.nodes = {}
+        self.indexes = {}
+        for node in NODES:
+            self.nodes[node] = RedditWallpaperChooser.cluster.Cluster(
+                self.output_path, node, NODES, segment_bytes=600
+            )
+            self.indexes[node] = self.open_index(node)
+
+    def open_index(self, node):
+        cache = RedditWallpaperChooser.cache.CacheIndex(
+            self.output_path, RedditWallpaperChooser.cluster.node_filename(".index.sqlite3", node)
+        )
+        self.addCleanup(cache.close)
+        return cache
+
+    def entry(self, i, store=True):
+        if store:
+            open(os.path.join(self.output_path, "w{}.jpg".format(i)), "w").close()
+        return RedditWallpaperChooser.cache.CacheEntry(
+            url="https://i.redd.it/{}.jpg".format(i), id="w{}".format(i), title=None, subreddit=None,
+            width=1, height=1, image_type="jpg", byte_size=1, downloaded_at=0, content_hash=None,
+            last_used=0, score=None, linked_to=None,
+        )
+
+    def sync(self, node):
+        """
+        Sync a node, as `manager.Manager.sync` does.
+        """
+        cluster, cache = self.nodes[node], self.indexes[node]
+        segments, records = cluster.read(dict(cache.journal_offsets))
+        imported = cluster.apply(cache, segments, records)
+        cache.flush()
+        cluster.acknowledge(dict(cache.journal_offsets), segments)
+        return imported
+
+    def segments(self, node):
+        return sorted(
+            name for name, (owner, _) in RedditWallpaperChooser.cluster.journals(self.output_path).items()
+            if owner == node
+        )
+
+    def test_records_are_applied_once(self):
+        self.nodes["a"].publish(added=[self.entry(0), self.entry(1), self.entry(2, store=False)])
+
+        # The entry whose image is missing is skipped.
+        self.assertEqual(self.sync("b"), 2)
+        self.assertEqual(len(self.indexes["b"]), 2)
+        self.assertEqual(self.sync("b"), 0)
+
+        # How far each segment has been imported survives a restart.
+        self.indexes["b"].close()
+        self.indexes["b"] = self.open_index("b")
+        self.assertEqual(self.sync("b"), 0)
+
+        self.nodes["a"].publish(removed=[self.entry(0).url])
+        self.assertEqual(self.sync("b"), 1)
+        self.assertNotIn(self.entry(0).url, self.indexes["b"])
+
+    def test_segments_are_compacted_once_imported_by_every_peer(self):
+        for i in range(6):
+            self.nodes["a"].publish(added=[self.entry(i)])
+        segments = self.segments("a")
+        self.assertGreater(len(segments), 1)
+
+        # Nothing is deleted before the peer has imported the segments.
+        self.sync("a")
+        self.assertEqual(self.segments("a"), segments)
+
+        self.assertEqual(self.sync("b"), 6)
+        self.sync("a")
+        # Only the current segment is kept, if already started.
+        current = [name for name in segments if name == os.path.basename(self.nodes["a"].journal_path)]
+        self.assertEqual(self.segments("a"), current)
+
+        # The deleted segments are forgotten by the peer.
+        self.sync("b")
+        self.assertEqual(list(self.indexes["b"].journal_offsets), current)
+
+
+if __name__ == '__main__':
+    unittest.main()
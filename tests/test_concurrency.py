@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Tests of the adaptive limits on the concurrent downloads.
+"""
+
+import asyncio
+import time
+import unittest
+
+import RedditWallpaperChooser.concurrency
+
+__author__ = 'aldur'
+
+
+class TestAdaptiveLimit(unittest.IsolatedAsyncioTestCase):
+
+    async def test_cancelled_waiter_passes_wakeup_on(self):
+        limit = RedditWallpaperChooser.concurrency.AdaptiveLimit(1, 1)
+        await limit.acquire()
+        first = asyncio.ensure_future(limit.acquire())
+        second = asyncio.ensure_future(limit.acquire())
+        await asyncio.sleep(0)
+
+        # The first waiter is woken up, then cancelled before it runs.
+        limit.release()
+        first.cancel()
+        await asyncio.wait_for(second, 1)
+        self.assertEqual(limit.in_flight, 1)
+
+    async def test_disk_time_is_not_latency(self):
+        limits = RedditWallpaperChooser.concurrency.HostLimits(1, 8)
+        released = []
+        limit = limits.get("http://example.com/a.jpg")
+        limit.release = lambda **kwargs: released.append(kwargs)
+
+        async with limits.slot("http://example.com/a.jpg") as sample:
+            start = time.perf_counter()
+            await asyncio.sleep(0.05)
+            sample.io_seconds = time.perf_counter() - start
+            sample.byte_size = 1
+
+        self.assertLess(released[0]["seconds"], 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
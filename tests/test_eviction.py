@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Tests of the eviction of the stored wallpapers.
+"""
+
+import os
+import os.path
+import tempfile
+import time
+import unittest
+
+import RedditWallpaperChooser.cache
+import RedditWallpaperChooser.eviction
+import RedditWallpaperChooser.fileio
+from RedditWallpaperChooser import constants, utils
+
+__author__ = 'aldur'
+
+
+class TestEvict(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.output_path = self.tmp.name
+        os.mkdir(os.path.join(self.output_path, constants.QUARANTINE_FOLDER))
+        self.cache = RedditWallpaperChooser.cache.CacheIndex(self.output_path)
+        self.files = RedditWallpaperChooser.fileio.FileIO(2, fsync=False)
+        self.files.start()
+
+    def tearDown(self):
+        self.files.shutdown()
+        self.cache.close()
+        self.tmp.cleanup()
+
+    def store(self, name, byte_size, last_used, linked_to=None):
+        url = "https://i.redd.it/{}.jpg".format(name)
+        self.cache.add(RedditWallpaperChooser.cache.CacheEntry(
+            url=url, id=name, title=None, subreddit=None, width=1, height=1, image_type="jpg",
+            byte_size=byte_size, downloaded_at=last_used, content_hash=None, last_used=last_used, score=None,
+            linked_to=linked_to,
+        ))
+        path = os.path.join(self.output_path, "{}.jpg".format(name))
+        if linked_to is None:
+            with open(path, "wb") as f:
+                f.write(b"x" * byte_size)
+        else:
+            os.link(os.path.join(self.output_path, "{}.jpg".format(linked_to)), path)
+        return url
+
+    def evict(self, **quota):
+        return RedditWallpaperChooser.eviction.evict(
+            self.cache, self.files, self.output_path, os.path.join(self.output_path, "variants"), **quota
+        )
+
+    def listing(self):
+        quarantine_path = os.path.join(self.output_path, constants.QUARANTINE_FOLDER)
+        return sorted(set(os.listdir(self.output_path)) - {constants.QUARANTINE_FOLDER}), os.listdir(quarantine_path)
+
+    async def test_hard_links_count_once(self):
+        first = self.store("a", 100, 1)
+        linked = self.store("b", 100, 2, linked_to="a")
+        self.store("c", 100, 3)
+
+        # Evicting "a" frees nothing while "b" is linked to it.
+        evicted = await self.evict(max_total_bytes=150)
+
+        self.assertEqual(evicted, {first, linked})
+        self.assertEqual(self.listing()[0], [".index.sqlite3", "c.jpg"])
+
+    async def test_partial_and_quarantined_bytes_come_from_the_index(self):
+        self.store("a", 100, 1)
+        url = "https://i.redd.it/q.jpg"
+        with open(os.path.join(self.output_path, constants.QUARANTINE_FOLDER, utils.url_id(url)), "wb") as f:
+            f.write(b"x" * 80)
+        self.cache.reject(url, "not a complete JPEG/PNG image", 80)
+        for name, updated_at in (("fresh", time.time()), ("stale", 0)):
+            with open(os.path.join(self.output_path, ".{}.part".format(name)), "wb") as f:
+                f.write(b"x" * 50)
+            self.cache.set_partial(name, RedditWallpaperChooser.cache.PartialEntry(
+                "https://i.redd.it/{}.jpg".format(name), None, 50, updated_at
+            ))
+
+        # The stale partial download is deleted, then the quarantined file, which does not fit.
+        evicted = await self.evict(max_total_bytes=160)
+
+        self.assertEqual(evicted, set())
+        self.assertEqual(self.listing(), ([".fresh.part", ".index.sqlite3", "a.jpg"], []))
+        self.assertEqual(set(self.cache.partials), {"fresh"})
+        self.assertEqual(self.cache.quarantined, {})
+        self.assertIn(url, self.cache.rejected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Tests of the Reddit API rate limiter, with a fake clock and against the local fake Reddit.
+"""
+
+import asyncio
+import time
+import unittest
+
+import RedditWallpaperChooser.ratelimit
+from benchmarks import fake_server
+import aiohttp
+
+__author__ = 'aldur'
+
+
+class FakeClock(object):
+
+    """A clock that only moves when slept on."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestPacing(unittest.IsolatedAsyncioTestCase):
+
+    def limiter(self, requests_per_minute=60, burst=2):
+        self.clock = FakeClock()
+        return RedditWallpaperChooser.ratelimit.RateLimiter(
+            requests_per_minute, burst, max_retries=0, clock=self.clock, sleep=self.clock.sleep,
+        )
+
+    async def test_burst_then_configured_rate(self):
+        limiter = self.limiter(requests_per_minute=60, burst=2)
+        times = []
+        for _ in range(5):
+            await limiter.acquire()
+            times.append(self.clock.now)
+        self.assertEqual(times, [0.0, 0.0, 1.0, 2.0, 3.0])
+
+    async def test_headers_slow_down(self):
+        limiter = self.limiter(requests_per_minute=600, burst=1)
+        limiter.update({"X-Ratelimit-Remaining": "10", "X-Ratelimit-Reset": "100"})
+        self.assertAlmostEqual(limiter.rate, 0.1)
+
+        await limiter.acquire()
+        await limiter.acquire()
+        self.assertAlmostEqual(self.clock.now, 10.0)
+
+    async def test_exhausted_window_blocks_until_reset(self):
+        limiter = self.limiter(requests_per_minute=600, burst=5)
+        limiter.update({"X-Ratelimit-Remaining": "0", "X-Ratelimit-Reset": "30"})
+
+        await limiter.acquire()
+        self.assertAlmostEqual(self.clock.now, 30.0)
+
+    def test_lock_created_in_running_loop(self):
+        limiter = RedditWallpaperChooser.ratelimit.RateLimiter(60, 1, 0)
+        self.assertIsNone(limiter._lock)
+        asyncio.run(limiter.acquire())
+
+
+class TestAgainstFakeReddit(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server = fake_server.FakeReddit(pages=1, per_page=5, rate_limit=3, rate_window=1.0)
+        await self.server.start()
+        self.url = self.server.api_url.format("wallpapers", "hot")
+        self.session = aiohttp.ClientSession()
+
+        self.sleeps = []
+
+        async def sleep(seconds):
+            self.sleeps.append(seconds)
+            await asyncio.sleep(seconds)
+
+        self.sleep = sleep
+
+    async def asyncTearDown(self):
+        await self.session.close()
+        await self.server.stop()
+
+    async def _get(self, limiter):
+        response = await limiter.get(self.session, self.url)
+        response.release()
+        return response.status
+
+    async def test_follows_rate_limit_headers(self):
+        limiter = RedditWallpaperChooser.ratelimit.RateLimiter(6000, 1, max_retries=0, sleep=self.sleep)
+        start = time.monotonic()
+        statuses = [await self._get(limiter) for _ in range(5)]
+
+        self.assertEqual(statuses, [200] * 5)
+        self.assertEqual(self.server.throttled_requests, 0)
+        # The window allows 3 requests: the 4th one waits for the reset.
+        self.assertGreater(time.monotonic() - start, 0.9)
+
+    async def test_backoff_on_429(self):
+        # The burst sends 4 requests before any rate limit header is known: one is throttled.
+        limiter = RedditWallpaperChooser.ratelimit.RateLimiter(6000, 4, max_retries=3, sleep=self.sleep)
+        statuses = await asyncio.gather(*(self._get(limiter) for _ in range(4)))
+
+        self.assertEqual(statuses, [200] * 4)
+        self.assertGreaterEqual(self.server.throttled_requests, 1)
+        self.assertEqual(self.server.listing_requests, 4 + self.server.throttled_requests)
+        # The retry waited for the end of the window announced by the 429.
+        self.assertGreater(sum(self.sleeps), 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
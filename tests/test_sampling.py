@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Tests of the weighted choice of the stored wallpapers.
+"""
+
+import random
+import tempfile
+import unittest
+
+import RedditWallpaperChooser.cache
+import RedditWallpaperChooser.sampling
+from RedditWallpaperChooser import utils
+
+__author__ = 'aldur'
+
+
+class TestWeightedSampler(unittest.TestCase):
+
+    def test_bulk_build_matches_adds(self):
+        rng = random.Random(0)
+        for n in (0, 1, 2, 7, 16, 33):
+            weights = [rng.random() for _ in range(n)]
+            built = RedditWallpaperChooser.sampling.WeightedSampler(range(n), weights)
+            added = RedditWallpaperChooser.sampling.WeightedSampler()
+            for item, item_weight in enumerate(weights):
+                added.add(item, item_weight)
+
+            for sampler in (built, added):
+                sampler.add(n, 1.0)
+            for a, b in zip(built._tree, added._tree):
+                self.assertAlmostEqual(a, b)
+
+
+class TestChooser(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        cache = RedditWallpaperChooser.cache.CacheIndex(self.tmp.name)
+        rng = random.Random(0)
+        for i in range(500):
+            cache.add(RedditWallpaperChooser.cache.CacheEntry(
+                url="https://i.redd.it/{}.jpg".format(i), id=str(i), title=None,
+                subreddit=rng.choice(("EarthPorn", "wallpapers", "spaceporn", None)),
+                width=rng.choice((1280, 1920, 2560, 3840, 0)), height=rng.choice((720, 1080, 1200, 1440, 2160)),
+                image_type="jpg", byte_size=1, downloaded_at=i, content_hash=None, last_used=None, score=i,
+                linked_to=None,
+            ))
+        cache.close()
+
+    def test_index_filters_as_memory(self):
+        preloaded = RedditWallpaperChooser.cache.CacheIndex(self.tmp.name)
+        lazy = RedditWallpaperChooser.cache.CacheIndex(self.tmp.name, preload=False)
+        self.addCleanup(preloaded.close)
+        self.addCleanup(lazy.close)
+        chooser = RedditWallpaperChooser.sampling.Chooser(preloaded, ratio_tolerance=0.0)
+
+        for subreddits, min_size, target_ratio, tolerance in (
+                ((), None, None, 0.0),
+                ({"earthporn", "spaceporn"}, None, None, 0.0),
+                ((), utils.Size(1920, 1080), round(16 / 9, 5), 0.0),
+                ({"wallpapers"}, utils.Size(2560, 1200), round(16 / 9, 5), 0.1),
+        ):
+            chooser.ratio_tolerance = tolerance
+            expected = {
+                entry.url for entry in preloaded.entries.values()
+                if chooser._fits(entry, subreddits, min_size, target_ratio)
+            }
+            selected = {c.url for c in lazy.select(subreddits, min_size, target_ratio, tolerance)}
+            self.assertEqual(selected, expected)
+
+    def test_lazy_choice_loads_the_chosen_wallpaper(self):
+        lazy = RedditWallpaperChooser.cache.CacheIndex(self.tmp.name, preload=False)
+        self.addCleanup(lazy.close)
+        chooser = RedditWallpaperChooser.sampling.Chooser(lazy, RedditWallpaperChooser.sampling.CHOOSE_SCORE)
+
+        entry = chooser.choose({"earthporn"})
+
+        self.assertEqual(entry.subreddit, "EarthPorn")
+        self.assertIsNotNone(entry.last_used)
+        self.assertEqual(list(lazy.entries), [entry.url])
+
+
+if __name__ == '__main__':
+    unittest.main()